@@ -4,6 +4,7 @@ visualizer = dict(
     type='LatentGraphVisualizer',
     dataset='c80_phase',
     save_graphs=True,
+    shard_graphs=True,
     draw=False,
 )
 
@@ -168,7 +168,8 @@ optim_wrapper = dict(
 auto_scale_lr = dict(enable=False)
 
 # hooks
-custom_hooks = [dict(type="CopyDetectorBackbone"), dict(type="FreezeHook")]
+custom_hooks = [dict(type="CopyDetectorBackbone"), dict(type="FreezeHook"),
+        dict(type="FlushLGWriter")]
 metric_key = 'ds_video_average_precision' if 'video' in test_evaluator['agg'] else 'ds_average_precision'
 default_hooks = dict(
     checkpoint=dict(
@@ -4,6 +4,7 @@ visualizer = dict(
     type='LatentGraphVisualizer',
     dataset='cholecT50',
     save_graphs=True,
+    shard_graphs=True,
     draw=False,
 )
 
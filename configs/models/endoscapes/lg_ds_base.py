@@ -162,7 +162,8 @@ optim_wrapper = dict(
 auto_scale_lr = dict(enable=False)
 
 # hooks
-custom_hooks = [dict(type="CopyDetectorBackbone"), dict(type="FreezeHook")]
+custom_hooks = [dict(type="CopyDetectorBackbone"), dict(type="FreezeHook"),
+        dict(type="FlushLGWriter")]
 default_hooks = dict(
     checkpoint=dict(save_best='endoscapes/ds_average_precision'),
     visualization=dict(draw=False),
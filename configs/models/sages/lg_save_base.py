@@ -4,6 +4,7 @@ visualizer = dict(
     type='LatentGraphVisualizer',
     dataset='endoscapes',
     save_graphs=True,
+    shard_graphs=True,
     draw=False,
 )
 
@@ -44,8 +44,11 @@ visualizer = dict(
     type='SAMQueryVisualizer',
     prefix='endoscapes',
     draw=False,
+    shard_queries=True,
 )
 
+custom_hooks = [dict(type="FreezeHook"), dict(type="FlushLGWriter")]
+
 default_hooks = dict(
     visualization=dict(
         draw=True,
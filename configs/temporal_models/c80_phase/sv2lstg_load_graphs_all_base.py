@@ -23,3 +23,8 @@ optim_wrapper = dict(
 train_cfg = dict(
     max_epochs=10,
 )
+
+# pack saved graphs of each batch in dataloader workers, transfer them from pinned memory
+train_dataloader = dict(collate_fn=dict(type='lg_collate'), pin_memory=True)
+val_dataloader = dict(collate_fn=dict(type='lg_collate'), pin_memory=True)
+test_dataloader = dict(collate_fn=dict(type='lg_collate'), pin_memory=True)
@@ -0,0 +1,9 @@
+_base_ = 'sv2lstg_load_graphs_all_base.py'
+
+# opt-in: batch whole videos of similar length, capping the number of padded frames per batch.
+# this changes the training setup of sv2lstg_load_graphs_all_base (batch size 4 instead of 1,
+# same lr), so results are not directly comparable
+train_dataloader = dict(
+    batch_size=4,
+    batch_sampler=dict(type='VideoLengthBatchSampler', max_frames=4000),
+)
@@ -0,0 +1,10 @@
+_base_ = 'sv2lstg_load_graphs_all_base.py'
+
+# opt-in: process videos in chunks to bound memory; chunk history covers the temporal edge range,
+# and chunk context covers the receptive field of the causal tcn. this changes the training
+# objective of sv2lstg_load_graphs_all_base: each step trains on num_train_chunks random chunks
+# per video, with temporal context before the chunk history reduced to pooled img feats
+_base_.sv2lstg_model.chunk_size = 256
+_base_.sv2lstg_model.chunk_history = 10
+_base_.sv2lstg_model.chunk_context = 1024
+_base_.sv2lstg_model.num_train_chunks = 4
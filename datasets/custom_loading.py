@@ -6,18 +6,53 @@ from mmdet.datasets.transforms import LoadAnnotations
 from mmdet.datasets.transforms.loading import LoadTrackAnnotations
 from mmdet.datasets.transforms.frame_sampling import UniformRefFrameSample, BaseFrameSample
 from mmengine.dataset import ClassBalancedDataset, ConcatDataset
+from mmengine.dataset.base_dataset import force_full_init
 from mmengine.dist import get_dist_info, sync_random_seed
-from mmengine.fileio import get
-from mmcv.transforms import LoadImageFromFile
-from typing import List, Union, Sized, Optional, Any, Dict
+from mmengine.fileio import get, get_local_path, isdir, list_dir_or_file
+from mmengine.logging import print_log
+from mmengine.structures import BaseDataElement
+from mmcv.transforms import LoadImageFromFile, BaseTransform
+from typing import List, Union, Sized, Optional, Any, Dict, Tuple, Iterator
 import numpy as np
 import math
 import random
 import os
 import torch
-from collections import defaultdict
+from torch.utils.data import BatchSampler, Sampler
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 import imagesize
+import cv2
+import atexit
+import hashlib
+import shutil
+import pickle
+
+_io_thread_pool = None
+_io_thread_pool_pid = None
+
+def get_io_thread_pool(num_threads: int) -> ThreadPoolExecutor:
+    """Get the thread pool for blocking reads, shared by all transforms of the process (the
+    first caller sets the number of threads)."""
+    global _io_thread_pool, _io_thread_pool_pid
+
+    # threads don't survive fork, so each (worker) process creates its own pool
+    if _io_thread_pool is None or _io_thread_pool_pid != os.getpid():
+        _io_thread_pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='io')
+        _io_thread_pool_pid = os.getpid()
+
+    return _io_thread_pool
+
+def get_video_frame_source(img_path: str, video_dir: str,
+        video_name_tmpl: str = 'video{:02d}.mp4') -> Tuple[str, int]:
+    """Get the source video and frame index of an extracted frame, whose basename is
+    expected to be {video_id}_{frame_id}.jpg (frame_id at the native frame rate).
+    """
+    video_id, frame_id = os.path.splitext(os.path.basename(img_path))[0].split('_')[-2:]
+    video_path = os.path.join(video_dir, video_name_tmpl.format(int(video_id)))
+
+    return video_path, int(frame_id)
 
 @TRANSFORMS.register_module()
 class LoadAnnotationsWithDS(LoadAnnotations):
@@ -63,44 +98,600 @@ class LoadTrackAnnotationsWithDS(LoadTrackAnnotations):
 
 @TRANSFORMS.register_module()
 class LoadLG(LoadImageFromFile):
+    """Load the saved latent graph of a frame.
+
+    Img files are not read: the img shape is taken from the graph (ori_shape) or from the
+    annotations (height, width), and only read from the img file if neither is available
+    (or if read_img_shape is True).
+
+    With prefetch=True, reads go through a thread pool shared by all transforms of the
+    (worker) process. LoadLG can then also be placed before TransformBroadcaster, to load all
+    frames of a clip concurrently, and graphs of upcoming clips hinted by the dataset (see
+    prefetch_offset of TrackCustomKeyframeSampler) are fetched in the background.
+
+    Graphs saved to shard files (shard_graphs=True in LatentGraphVisualizer) are found through
+    the export manifests and the .idx index files of the listed shards, and read from the byte
+    range of each graph. Graphs listed in later exports override earlier ones, and graphs not
+    listed in any manifest are read from {img id}.npz.
+
+    Args:
+        saved_graph_dir (str): directory of the saved graphs ({img id}.npz, or .lgs shards).
+        load_keyframes_only (bool): only load graphs of keyframes.
+        skip_keys (List): node/edge keys to drop from loaded graphs.
+        read_img_shape (bool): always read the img shape from the img file.
+        prefetch (bool): load graphs asynchronously.
+        num_io_threads (int): number of threads of the shared pool.
+        max_prefetched (int): max number of graphs fetched ahead of time.
+    """
     def __init__(self, saved_graph_dir: str = '', load_keyframes_only: bool = False,
-            skip_keys: List = [], **kwargs):
+            skip_keys: List = [], read_img_shape: bool = False, prefetch: bool = False,
+            num_io_threads: int = 16, max_prefetched: int = 256, **kwargs):
         super(LoadLG, self).__init__(**kwargs)
         self.saved_graph_dir = saved_graph_dir
         self.load_keyframes_only = load_keyframes_only
         self.skip_keys = skip_keys
+        self.read_img_shape = read_img_shape
+        self.prefetch = prefetch
+        self.num_io_threads = num_io_threads
+        self.max_prefetched = max_prefetched
+
+        # graph path -> future of graphs being fetched ahead of time
+        self._prefetched = OrderedDict()
+
+        # img id -> (shard path, offset, num bytes) of graphs saved to shards (loaded lazily)
+        self._shard_index = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_prefetched'] = OrderedDict()
+
+        return state
+
+    def _get_graph_path(self, img_id) -> str:
+        return os.path.join(self.saved_graph_dir, str(img_id) + '.npz')
+
+    def _get_shard_index(self) -> Dict:
+        if self._shard_index is None:
+            self._shard_index = {}
+            if not isdir(self.saved_graph_dir, backend_args=self.backend_args):
+                return self._shard_index
+
+            # only graphs listed in export manifests (lg_{export}_{rank}.manifest), graphs of
+            # later exports override earlier ones, stale shards are ignored
+            manifests = list_dir_or_file(self.saved_graph_dir, list_dir=False,
+                    suffix='.manifest', backend_args=self.backend_args)
+            for manifest in sorted(manifests, key=lambda m: int(m.split('_')[1])):
+                manifest = pickle.loads(get(os.path.join(self.saved_graph_dir, manifest),
+                    backend_args=self.backend_args))
+                for img_id in manifest['npz_img_ids']:
+                    self._shard_index[img_id] = None
+
+                for shard in manifest['shards']:
+                    shard_path = os.path.join(self.saved_graph_dir, shard)
+                    shard_index = pickle.loads(get(shard_path.replace('.lgs', '.idx'),
+                        backend_args=self.backend_args))
+                    for img_id, (offset, num_bytes) in shard_index.items():
+                        self._shard_index[img_id] = (shard_path, offset, num_bytes)
+
+        return self._shard_index
+
+    def _read_graph(self, graph_path: str) -> bytes:
+        img_id = os.path.basename(graph_path).replace('.npz', '')
+        shard_entry = self._get_shard_index().get(img_id, None)
+        if shard_entry is None:
+            return get(graph_path, backend_args=self.backend_args)
+
+        shard_path, offset, num_bytes = shard_entry
+        with get_local_path(shard_path, backend_args=self.backend_args) as local_path:
+            with open(local_path, 'rb') as f:
+                f.seek(offset)
+                return f.read(num_bytes)
+
+    def _load_lg(self, graph_path: str) -> BaseDataElement:
+        graph_bytes = self._read_graph(graph_path)
+        with np.load(BytesIO(graph_bytes), allow_pickle=True) as f:
+            lg = f['arr_0'].item()
+
+        del graph_bytes
+
+        # remove unwanted keys
+        for k in self.skip_keys:
+            if k in lg.nodes:
+                del lg.nodes[k]
+            if k in lg.edges:
+                del lg.edges[k]
+
+        return lg.to_tensor()
+
+    def _get_graph_paths(self, results: dict) -> List[Optional[str]]:
+        # graph path of each frame of a clip (or single frame), None if graph is not loaded
+        if isinstance(results['id'], list):
+            img_ids = results['id']
+            key_frame_flags = results.get('key_frame_flags', [True] * len(img_ids))
+        else:
+            img_ids = [results['id']]
+            key_frame_flags = [results.get('key_frame_flags', True)]
+
+        return [self._get_graph_path(i) if (f or not self.load_keyframes_only) else None \
+                for i, f in zip(img_ids, key_frame_flags)]
+
+    def prefetch_clip(self, results: dict) -> None:
+        """Start loading the graphs of an upcoming clip (output of the frame sampler)."""
+        if not self.prefetch:
+            return
+
+        pool = get_io_thread_pool(self.num_io_threads)
+        self._get_shard_index() # load index before reading in threads
+        graph_paths = [p for p in self._get_graph_paths(results) if p is not None]
+        for graph_path in graph_paths[:self.max_prefetched]:
+            if graph_path in self._prefetched:
+                self._prefetched.move_to_end(graph_path)
+                continue
+
+            self._prefetched[graph_path] = pool.submit(self._load_lg, graph_path)
+            if len(self._prefetched) > self.max_prefetched:
+                self._prefetched.popitem(last=False)[1].cancel()
+
+    def transform(self, results: dict) -> dict:
+        is_clip = isinstance(results['id'], list)
+        graph_paths = self._get_graph_paths(results)
+        img_paths = results['img_path'] if is_clip else [results['img_path']]
+
+        if self.prefetch:
+            # issue all reads of the clip at once, reusing graphs that were prefetched
+            pool = get_io_thread_pool(self.num_io_threads)
+            self._get_shard_index() # load index before reading in threads
+            lg_futures = [None if p is None else self._prefetched.pop(p, None) or \
+                    pool.submit(self._load_lg, p) for p in graph_paths]
+            lgs = [torch.zeros(0) if f is None else f.result() for f in lg_futures]
+        else:
+            lgs = [torch.zeros(0) if p is None else self._load_lg(p) for p in graph_paths]
+
+        # img shape from graph or annotations, read from img file only if missing
+        if 'height' in results and 'width' in results:
+            ann_shapes = list(zip(results['height'], results['width'])) if is_clip \
+                    else [(results['height'], results['width'])]
+        else:
+            ann_shapes = [None] * len(img_paths)
+
+        img_shapes = []
+        for lg, ann_shape in zip(lgs, ann_shapes):
+            if self.read_img_shape:
+                img_shapes.append(None)
+            elif isinstance(lg, BaseDataElement) and 'ori_shape' in lg:
+                img_shapes.append(tuple(lg.ori_shape))
+            else:
+                img_shapes.append(ann_shape)
+
+        missing_inds = [i for i, s in enumerate(img_shapes) if s is None]
+        if self.prefetch:
+            img_sizes = pool.map(imagesize.get, [img_paths[i] for i in missing_inds])
+        else:
+            img_sizes = map(imagesize.get, [img_paths[i] for i in missing_inds])
+
+        for i, img_size in zip(missing_inds, img_sizes):
+            img_shapes[i] = img_size[::-1]
+
+        if is_clip:
+            results['lg'] = lgs
+            results['img_shape'] = img_shapes
+            results['ori_shape'] = img_shapes
+        else:
+            results['lg'] = lgs[0]
+            results['img_shape'] = img_shapes[0]
+            results['ori_shape'] = img_shapes[0]
+
+        return results
+
+@TRANSFORMS.register_module()
+class LoadFramesFromVideo(LoadImageFromFile):
+    """Load frames by decoding them from the source videos instead of extracted image files.
+
+    Works on a single frame (img_path is a str) or on a whole clip (img_path is a list, i.e.
+    placed after the frame sampler and before TransformBroadcaster), in which case the frames
+    of the clip are decoded in one sequential pass through the video. The source of each frame
+    is read from video_path/video_frame_id (set by the dataset when video_dir is given), or
+    parsed from img_path. Decoded frames and open videos are cached per worker.
+
+    Args:
+        video_dir (str): directory containing the videos, used when parsing img_path.
+        video_name_tmpl (str): template to get the video filename from the video id.
+        max_cached_frames (int): max number of decoded frames to cache.
+        max_open_videos (int): max number of videos to keep open.
+        max_seek_gap (int): frames ahead of the current position are reached by decoding
+            forward if they are at most max_seek_gap frames away, otherwise by seeking.
+    """
+    def __init__(self, video_dir: str = '', video_name_tmpl: str = 'video{:02d}.mp4',
+            max_cached_frames: int = 64, max_open_videos: int = 4, max_seek_gap: int = 500,
+            **kwargs):
+        super(LoadFramesFromVideo, self).__init__(**kwargs)
+        self.video_dir = video_dir
+        self.video_name_tmpl = video_name_tmpl
+        self.max_cached_frames = max_cached_frames
+        self.max_open_videos = max_open_videos
+        self.max_seek_gap = max_seek_gap
+
+        # per-worker caches, created lazily since video readers can't be pickled
+        self._frame_cache = OrderedDict()
+        self._readers = OrderedDict()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_frame_cache'] = OrderedDict()
+        state['_readers'] = OrderedDict()
+
+        return state
+
+    def _get_reader(self, video_path: str) -> List:
+        if video_path in self._readers:
+            self._readers.move_to_end(video_path)
+        else:
+            cap = cv2.VideoCapture(video_path)
+            if not cap.isOpened():
+                raise FileNotFoundError('Unable to open video: {}'.format(video_path))
+
+            # store reader with the index of the next frame it will decode
+            self._readers[video_path] = [cap, 0]
+            if len(self._readers) > self.max_open_videos:
+                self._readers.popitem(last=False)[1][0].release()
+
+        return self._readers[video_path]
+
+    def _decode_frames(self, video_path: str, frame_ids: List[int]) -> Dict[int, np.ndarray]:
+        reader = self._get_reader(video_path)
+        cap, pos = reader
+
+        frames = {}
+        for frame_id in sorted(set(frame_ids)):
+            # seek backwards or far ahead, otherwise skip frames without retrieving them
+            if frame_id < pos or frame_id - pos > self.max_seek_gap:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, frame_id)
+                pos = frame_id
+
+            while pos < frame_id and cap.grab():
+                pos += 1
+
+            success, frame = cap.read()
+            if not success:
+                break
+
+            pos += 1
+            frames[frame_id] = frame
+
+        reader[1] = pos
+
+        return frames
+
+    def _cache_frame(self, key: Tuple[str, int], frame: np.ndarray) -> None:
+        self._frame_cache[key] = frame
+        if len(self._frame_cache) > self.max_cached_frames:
+            self._frame_cache.popitem(last=False)
 
     def transform(self, results: dict) -> dict:
-        if self.load_keyframes_only and not results['key_frame_flags']:
-            results['lg'] = torch.zeros(0)
+        is_clip = isinstance(results['img_path'], list)
+        img_paths = results['img_path'] if is_clip else [results['img_path']]
+        if 'video_path' in results:
+            video_paths = results['video_path'] if is_clip else [results['video_path']]
+            video_frame_ids = results['video_frame_id'] if is_clip else [results['video_frame_id']]
+            sources = list(zip(video_paths, video_frame_ids))
+        else:
+            sources = [get_video_frame_source(p, self.video_dir, self.video_name_tmpl) for p in img_paths]
+
+        # get cached frames, group remaining frames by video
+        frames = {}
+        frames_to_decode = defaultdict(list)
+        for source in sources:
+            if source in self._frame_cache:
+                self._frame_cache.move_to_end(source)
+                frames[source] = self._frame_cache[source]
+            else:
+                frames_to_decode[source[0]].append(source[1])
+
+        for video_path, frame_ids in frames_to_decode.items():
+            for frame_id, frame in self._decode_frames(video_path, frame_ids).items():
+                frames[(video_path, frame_id)] = frame
+                self._cache_frame((video_path, frame_id), frame)
+
+        imgs = []
+        for img_path, source in zip(img_paths, sources):
+            if source not in frames:
+                if self.ignore_empty:
+                    return None
+                raise IOError('Unable to decode frame {} of {} ({})'.format(source[1],
+                    source[0], img_path))
+
+            # copy so that in-place transforms don't modify cached frames
+            img = frames[source].copy()
+            if self.to_float32:
+                img = img.astype(np.float32)
+
+            imgs.append(img)
+
+        if is_clip:
+            results['img'] = imgs
+            results['img_shape'] = [img.shape[:2] for img in imgs]
+            results['ori_shape'] = [img.shape[:2] for img in imgs]
         else:
-            graph_path = os.path.join(self.saved_graph_dir, str(results['id']) + '.npz')
-            graph_bytes = get(graph_path, backend_args=self.backend_args)
-            with np.load(BytesIO(graph_bytes), allow_pickle=True) as f:
-                lg = f['arr_0'].item()
+            results['img'] = imgs[0]
+            results['img_shape'] = imgs[0].shape[:2]
+            results['ori_shape'] = imgs[0].shape[:2]
+
+        return results
+
+class SharedFrameCache:
+    """Cache of decoded frames shared across processes (e.g. DataLoader workers).
+
+    Each frame is stored as a .npy file in a shared memory directory (/dev/shm by default),
+    indexed by img_path. Files are written atomically, so no locking is needed between
+    workers. When the cache exceeds max_bytes, least recently used frames are evicted until
+    it is back under (1 - evict_ratio) * max_bytes. Each process checks the cache size after
+    writing evict_ratio * max_bytes, so the cache can temporarily exceed max_bytes by that
+    amount per worker.
+
+    Args:
+        cache_dir (str): shared memory directory to store frames in, specific to the process
+            that creates the cache (and its workers) by default.
+        max_bytes (int): byte budget of the cache.
+        evict_ratio (float): fraction of the budget to free when evicting.
+        persistent (bool): keep the cache after the process that created it exits.
+        log_interval (int): log hit rate every log_interval lookups (0 to disable).
+    """
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: int = 8 * 1024 ** 3,
+            evict_ratio: float = 0.1, persistent: bool = False, log_interval: int = 0):
+        if cache_dir is None:
+            # per run, so that concurrent runs don't serve or clear each other's frames
+            cache_dir = '/dev/shm/surglatentgraph_frame_cache_{}'.format(os.getpid())
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.evict_ratio = evict_ratio
+        self.log_interval = log_interval
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # per-process stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes_since_check = 0
+
+        self._owner_pid = os.getpid()
+        if not persistent:
+            atexit.register(self.clear)
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        path = self._get_path(key)
+        try:
+            img = np.load(path)
+            os.utime(path) # mark as recently used
+            self.hits += 1
+        except (OSError, ValueError): # not cached or evicted
+            img = None
+            self.misses += 1
+
+        if self.log_interval > 0 and (self.hits + self.misses) % self.log_interval == 0:
+            print_log('SharedFrameCache (pid {}): {}'.format(os.getpid(), self.stats()),
+                    logger='current')
+
+        return img
+
+    def put(self, key: str, img: np.ndarray) -> None:
+        path = self._get_path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, img)
+            os.replace(tmp_path, path)
+        except OSError: # e.g. shared memory is full, skip caching this frame
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        self._bytes_since_check += img.nbytes
+        if self._bytes_since_check >= self.evict_ratio * self.max_bytes:
+            self._bytes_since_check = 0
+            self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npy'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError: # evicted by another worker
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total_bytes = sum(e[1] for e in entries)
+        if total_bytes <= self.max_bytes:
+            return
+
+        target_bytes = (1 - self.evict_ratio) * self.max_bytes
+        for _, size, path in sorted(entries):
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
 
-            del graph_bytes
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hits / max(lookups, 1),
+                evictions=self.evictions)
 
-            # remove unwanted keys
-            for k in self.skip_keys:
-                if k in lg.nodes:
-                    del lg.nodes[k]
-                if k in lg.edges:
-                    del lg.edges[k]
+    def clear(self) -> None:
+        # only the process that created the cache removes it (not dataloader workers)
+        if os.getpid() == self._owner_pid:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
 
-            results['lg'] = lg.to_tensor()
+@TRANSFORMS.register_module()
+class LoadImageWithSharedCache(BaseTransform):
+    """Wrap a LoadImageFromFile-compatible transform (e.g. LoadImageFromFile,
+    LoadFramesFromVideo) with a SharedFrameCache, so that frames shared by overlapping clips
+    are only decoded once across all DataLoader workers. Supports single frames and clips.
+
+    Args:
+        transform (dict): config of the loading transform to wrap.
+        **cache_kwargs: arguments of SharedFrameCache. By default, cache_dir is specific to
+            the run and to the config of the wrapped transform (e.g. color_type, to_float32).
+            A given cache_dir should be specific to the loading settings.
+    """
+    def __init__(self, transform: dict, **cache_kwargs):
+        self.loader = TRANSFORMS.build(transform)
+        if cache_kwargs.get('cache_dir', None) is None:
+            loader_key = hashlib.sha1(repr(sorted(transform.items())).encode()).hexdigest()[:12]
+            cache_kwargs['cache_dir'] = '/dev/shm/surglatentgraph_frame_cache_{}_{}'.format(
+                    os.getpid(), loader_key)
+
+        self.cache = SharedFrameCache(**cache_kwargs)
+
+    def transform(self, results: dict) -> dict:
+        is_clip = isinstance(results['img_path'], list)
+        img_paths = results['img_path'] if is_clip else [results['img_path']]
+        imgs = [self.cache.get(p) for p in img_paths]
+
+        # load only missing frames with wrapped transform, and cache them
+        missing = [i for i, img in enumerate(imgs) if img is None]
+        if len(missing) > 0:
+            if is_clip:
+                # per-frame fields (img_path, video_path, video_frame_id, ...) of missing frames
+                sub_results = {k: [v[i] for i in missing] if isinstance(v, list) and \
+                        len(v) == len(img_paths) else v for k, v in results.items()}
+            else:
+                sub_results = results.copy()
+
+            sub_results = self.loader(sub_results)
+            if sub_results is None:
+                return None
+
+            loaded_imgs = sub_results['img'] if is_clip else [sub_results['img']]
+            for i, img in zip(missing, loaded_imgs):
+                self.cache.put(img_paths[i], img)
+                imgs[i] = img
 
-        # img size
-        results['img_shape'] = imagesize.get(results['img_path'])[::-1]
-        results['ori_shape'] = results['img_shape']
+        if is_clip:
+            results['img'] = imgs
+            results['img_shape'] = [img.shape[:2] for img in imgs]
+            results['ori_shape'] = [img.shape[:2] for img in imgs]
+        else:
+            results['img'] = imgs[0]
+            results['img_shape'] = imgs[0].shape[:2]
+            results['ori_shape'] = imgs[0].shape[:2]
 
         return results
 
+class AnnotationCacheMixin:
+    """Cache the parsed annotations of a dataset on disk.
+
+    The serialized data list (mmengine's data_bytes/data_address) and the attributes listed in
+    ann_cache_attrs are saved to ann_cache_dir, keyed by the hash of the annotation file and
+    of the dataset settings. Later runs load them as read-only memmaps instead of parsing the
+    JSON, and dataloader workers share the mapped pages. Requires serialize_data=True.
+    """
+    ann_cache_version = 1
+    ann_cache_attrs = ('cat_ids', 'cat2label')
+
+    def _get_ann_cache_path(self) -> Optional[str]:
+        if self.ann_cache_dir is None or not self.serialize_data or not os.path.isfile(self.ann_file):
+            return None
+
+        key = hashlib.sha1()
+        with open(self.ann_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                key.update(chunk)
+
+        # settings that change the data list
+        settings = (type(self).__name__, self.ann_cache_version, self.data_root, self.data_prefix,
+                self.filter_cfg, self._indices, self.test_mode, self._metainfo.get('classes'),
+                getattr(self, 'video_dir', None), getattr(self, 'video_name_tmpl', None))
+        key.update(repr(settings).encode())
+
+        return os.path.join(self.ann_cache_dir, '{}_{}'.format(os.path.splitext(
+            os.path.basename(self.ann_file))[0], key.hexdigest()))
+
+    def _load_ann_cache(self) -> bool:
+        """Load data list and cached attributes if a cache exists, returns whether it was loaded."""
+        self._ann_cache_path = self._get_ann_cache_path()
+        if self._ann_cache_path is None or not os.path.isdir(self._ann_cache_path):
+            return False
+
+        self._load_ann_cache_arrays()
+        with open(os.path.join(self._ann_cache_path, 'attrs.pkl'), 'rb') as f:
+            for k, v in pickle.load(f).items():
+                setattr(self, k, v)
+
+        return True
+
+    def _load_ann_cache_arrays(self) -> None:
+        self.data_bytes = np.load(os.path.join(self._ann_cache_path, 'data_bytes.npy'), mmap_mode='r')
+        self.data_address = np.load(os.path.join(self._ann_cache_path, 'data_address.npy'),
+                mmap_mode='r')
+
+    def _save_ann_cache(self) -> None:
+        if self._ann_cache_path is None:
+            return
+
+        # write to a tmp dir and rename, so concurrent ranks don't read partial caches
+        tmp_path = '{}.{}.tmp'.format(self._ann_cache_path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        np.save(os.path.join(tmp_path, 'data_bytes.npy'), self.data_bytes)
+        np.save(os.path.join(tmp_path, 'data_address.npy'), self.data_address)
+        with open(os.path.join(tmp_path, 'attrs.pkl'), 'wb') as f:
+            pickle.dump({k: getattr(self, k) for k in self.ann_cache_attrs if hasattr(self, k)}, f)
+
+        try:
+            os.rename(tmp_path, self._ann_cache_path)
+        except OSError: # already written by another rank
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def __getstate__(self):
+        # reopen memmaps in spawned workers instead of pickling their contents
+        state = self.__dict__.copy()
+        if isinstance(state.get('data_bytes'), np.memmap):
+            del state['data_bytes'], state['data_address']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'data_bytes' not in state and self._fully_initialized and self.serialize_data:
+            self._load_ann_cache_arrays()
+
 @DATASETS.register_module()
-class CocoDatasetWithDS(CocoDataset):
+class CocoDatasetWithDS(AnnotationCacheMixin, CocoDataset):
+    def __init__(self, *args, video_dir: str = None, video_name_tmpl: str = 'video{:02d}.mp4',
+            ann_cache_dir: str = None, **kwargs):
+        # if video_dir is set, store source video and frame index of each img (LoadFramesFromVideo)
+        self.video_dir = video_dir
+        self.video_name_tmpl = video_name_tmpl
+
+        # if ann_cache_dir is set, cache parsed annotations there (AnnotationCacheMixin)
+        self.ann_cache_dir = ann_cache_dir
+        super().__init__(*args, **kwargs)
+
+    def full_init(self) -> None:
+        if self._fully_initialized:
+            return
+
+        if not self._load_ann_cache():
+            super().full_init()
+            self._save_ann_cache()
+
+        self._fully_initialized = True
+
     def parse_data_info(self, raw_data_info: dict) -> Union[dict, List[dict]]:
         data_info = super().parse_data_info(raw_data_info)
 
+        if self.video_dir is not None:
+            data_info['video_path'], data_info['video_frame_id'] = get_video_frame_source(
+                    data_info['img_path'], self.video_dir, self.video_name_tmpl)
+
         # get ds labels
         if 'ds' in raw_data_info['raw_img_info']:
             data_info['ds'] = raw_data_info['raw_img_info']['ds']
@@ -114,10 +705,27 @@ class CocoDatasetWithDS(CocoDataset):
         return data_info
 
 @DATASETS.register_module()
-class VideoDatasetWithDS(BaseVideoDataset):
+class VideoDatasetWithDS(AnnotationCacheMixin, BaseVideoDataset):
+    ann_cache_attrs = ('cat_ids', 'cat2label', '_video_lengths', '_is_ds_keyframe', '_keyframe_ids',
+            '_keyframe_video_inds', '_keyframe_offsets')
+
+    def __init__(self, *args, video_dir: str = None, video_name_tmpl: str = 'video{:02d}.mp4',
+            ann_cache_dir: str = None, **kwargs):
+        # if video_dir is set, store source video and frame index of each img (LoadFramesFromVideo)
+        self.video_dir = video_dir
+        self.video_name_tmpl = video_name_tmpl
+
+        # if ann_cache_dir is set, cache parsed annotations there (AnnotationCacheMixin)
+        self.ann_cache_dir = ann_cache_dir
+        super().__init__(*args, **kwargs)
+
     def parse_data_info(self, raw_data_info: dict) -> Union[dict, List[dict]]:
         data_info = super().parse_data_info(raw_data_info)
 
+        if self.video_dir is not None:
+            data_info['video_path'], data_info['video_frame_id'] = get_video_frame_source(
+                    data_info['img_path'], self.video_dir, self.video_name_tmpl)
+
         # get ds labels
         data_info['ds'] = raw_data_info['raw_img_info']['ds']
 
@@ -129,6 +737,39 @@ class VideoDatasetWithDS(BaseVideoDataset):
 
         return data_info
 
+    def full_init(self) -> None:
+        if self._fully_initialized:
+            return
+
+        if not self._load_ann_cache():
+            super().full_init()
+            self._build_keyframe_index()
+            self._save_ann_cache()
+
+        self._fully_initialized = True
+
+    def _build_keyframe_index(self) -> None:
+        """Build a compact index of the frames of all videos (video lengths, frame ids,
+        is_ds_keyframe flags and per-video keyframe offsets), so that keyframe queries don't
+        need to deserialize and copy the data info of every video."""
+        video_lengths, frame_ids, is_ds_keyframe = [], [], []
+        for i in range(len(self)):
+            images = self.get_data_info(i)['images']
+            video_lengths.append(len(images))
+            frame_ids.extend([x['frame_id'] for x in images])
+            is_ds_keyframe.extend([bool(x['is_ds_keyframe']) for x in images])
+
+        self._video_lengths = np.array(video_lengths, dtype=np.int64)
+        self._is_ds_keyframe = np.array(is_ds_keyframe, dtype=bool)
+
+        # keyframe ids of all videos, split by video using keyframe offsets
+        frame_video_inds = np.repeat(np.arange(len(video_lengths)), self._video_lengths)
+        self._keyframe_ids = np.array(frame_ids, dtype=np.int64)[self._is_ds_keyframe]
+        self._keyframe_video_inds = frame_video_inds[self._is_ds_keyframe]
+        self._keyframe_offsets = np.concatenate([[0], np.cumsum(np.bincount(
+            self._keyframe_video_inds, minlength=len(video_lengths)))])
+
+    @force_full_init
     def get_keyframes_per_video(self, idx):
         """Get all keyframes in one video.
 
@@ -138,10 +779,33 @@ class VideoDatasetWithDS(BaseVideoDataset):
         Returns:
             List[int]: a list of all keyframes in the video
         """
-        data_info = self.get_data_info(idx)['images']
-        keyframe_ids = [x['frame_id'] for x in data_info if x['is_ds_keyframe']]
+        start, end = self._keyframe_offsets[idx], self._keyframe_offsets[idx + 1]
+
+        return self._keyframe_ids[start:end].tolist()
+
+    @force_full_init
+    def get_all_keyframes(self) -> Tuple[np.ndarray]:
+        """Get the video index and frame id of all keyframes in the dataset.
+
+        Returns:
+            Tuple[np.ndarray]: video indices and frame ids of all keyframes
+        """
+        return self._keyframe_video_inds, self._keyframe_ids
+
+    @force_full_init
+    def get_num_keyframes_per_video(self) -> np.ndarray:
+        """Get the number of keyframes in each video."""
+        return np.diff(self._keyframe_offsets)
 
-        return keyframe_ids
+    @force_full_init
+    def get_len_per_video(self, idx):
+        return int(self._video_lengths[idx])
+
+    @property
+    @force_full_init
+    def num_all_imgs(self):
+        """Get the number of all the images in this video dataset."""
+        return int(self._video_lengths.sum())
 
     def prepare_data(self, idx) -> Any:
         """Get date processed by ``self.pipeline``. Note that ``idx`` is a
@@ -158,6 +822,10 @@ class VideoDatasetWithDS(BaseVideoDataset):
         Returns:
             Any: Depends on ``self.pipeline``.
         """
+        upcoming_idx = None
+        if isinstance(idx, PrefetchIndex):
+            idx, upcoming_idx = idx.idx, idx.upcoming_idx
+
         if isinstance(idx, tuple):
             assert len(idx) == 2, 'The length of idx must be 2: '
             '(video_index, frame_index)'
@@ -194,29 +862,90 @@ class VideoDatasetWithDS(BaseVideoDataset):
         if frame_idx is not None:
             data_info['key_frame_id'] = frame_idx
 
-        return self.pipeline(data_info)
+        data = self.pipeline(data_info)
+
+        # hint loading transforms at the upcoming sample, so they can fetch it in the background
+        if upcoming_idx is not None:
+            self._prefetch(upcoming_idx)
+
+        return data
+
+    def _prefetch(self, idx) -> None:
+        """Run the frame sampler (first transform of the pipeline) on sample idx, and pass the
+        sampled clip to the prefetch_clip method of the loading transforms in the pipeline."""
+        if not hasattr(self, '_prefetch_transforms'):
+            self._prefetch_transforms = []
+            transforms = list(self.pipeline.transforms)
+            while len(transforms) > 0:
+                t = transforms.pop(0)
+                if callable(getattr(t, 'prefetch_clip', None)):
+                    self._prefetch_transforms.append(t)
+
+                # transform wrappers (e.g. TransformBroadcaster) hold a Compose of transforms
+                sub_transforms = getattr(t, 'transforms', [])
+                transforms.extend(getattr(sub_transforms, 'transforms', sub_transforms))
+
+        frame_sampler = self.pipeline.transforms[0]
+        if len(self._prefetch_transforms) == 0 or not isinstance(frame_sampler, BaseFrameSample):
+            return
+
+        video_idx, frame_idx = idx if isinstance(idx, tuple) else (idx, None)
+        data_info = self.get_data_info(video_idx)
+        if frame_idx is not None:
+            data_info['key_frame_id'] = frame_idx
+
+        # don't consume the random state used by the pipeline
+        random_state = random.getstate()
+        clip = frame_sampler(data_info)
+        random.setstate(random_state)
+
+        for t in self._prefetch_transforms:
+            t.prefetch_clip(clip)
 
     @property
+    @force_full_init
     def num_total_keyframes(self):
         """Get the number of all the keyframes in this video dataset."""
-        return sum(
-            [len([x for x in self.get_data_info(i)['images'] if x['is_ds_keyframe']]) \
-                    for i in range(len(self))])
+        return int(self._keyframe_offsets[-1])
+
+class PrefetchIndex:
+    """Sampler index along with the index of an upcoming sample to prefetch."""
+    def __init__(self, idx: Union[int, Tuple[int]], upcoming_idx: Union[int, Tuple[int]]):
+        self.idx = idx
+        self.upcoming_idx = upcoming_idx
 
 @DATA_SAMPLERS.register_module()
 class TrackCustomKeyframeSampler(TrackImgSampler):
-    """Code to sample a keyframe from the entire dataset"""
+    """Code to sample a keyframe from the entire dataset
+
+    In test mode, videos are split across ranks according to shard_by: 'videos' splits them
+    by count, 'keyframes'/'frames' balance the total number of keyframes/frames per rank
+    (greedy longest-processing-time assignment), 'auto' uses 'frames' if load_video else
+    'keyframes'.
+
+    If prefetch_offset > 0, each index is yielded along with the index sampled prefetch_offset
+    samples later, so that the dataset can start loading it (see LoadLG). Batches are assigned
+    round-robin to dataloader workers, so prefetch_offset = num_workers * batch_size hints each
+    worker at its own next batch.
+    """
     def __init__(
         self,
         dataset: Sized,
         seed: Optional[int] = None,
         load_video: bool = False,
+        shard_by: str = 'auto',
+        prefetch_offset: int = 0,
     ) -> None:
         rank, world_size = get_dist_info()
         self.rank = rank
         self.world_size = world_size
         self.epoch = 0
         self.load_video = load_video
+        self.prefetch_offset = prefetch_offset
+        if shard_by == 'auto':
+            shard_by = 'frames' if load_video else 'keyframes'
+        assert shard_by in ['videos', 'keyframes', 'frames'], f'invalid shard_by {shard_by}'
+        self.shard_by = shard_by
         if seed is None:
             self.seed = sync_random_seed()
         else:
@@ -267,8 +996,7 @@ class TrackCustomKeyframeSampler(TrackImgSampler):
                 if num_videos < self.world_size:
                     raise ValueError(f'only {num_videos} videos loaded,'
                                      f'but {self.world_size} gpus were given.')
-                chunks = np.array_split(
-                    list(range(num_videos)), self.world_size)
+                chunks = self._shard_videos(num_videos)
                 for videos_inds in chunks:
                     indices_chunk = []
                     for video_ind in videos_inds:
@@ -282,13 +1010,11 @@ class TrackCustomKeyframeSampler(TrackImgSampler):
                     self.indices.append(indices_chunk)
 
             else:
-                for video_ind in range(num_videos):
-                    if self.load_video:
-                        self.indices.extend([video_ind])
-                    else:
-                        self.indices.extend([
-                            (video_ind, frame_ind) for frame_ind in self.dataset.get_keyframes_per_video(video_ind)
-                        ])
+                if self.load_video:
+                    self.indices.extend(range(num_videos))
+                else:
+                    video_inds, keyframe_ids = self.dataset.get_all_keyframes()
+                    self.indices.extend(zip(video_inds.tolist(), keyframe_ids.tolist()))
 
         if self.test_mode:
             self.num_samples = len(self.indices[self.rank])
@@ -299,6 +1025,121 @@ class TrackCustomKeyframeSampler(TrackImgSampler):
                 math.ceil(len(self.indices) * 1.0 / self.world_size))
             self.total_size = self.num_samples * self.world_size
 
+    def __iter__(self) -> Iterator:
+        indices = list(super().__iter__())
+        if self.prefetch_offset > 0:
+            indices = [PrefetchIndex(idx, indices[i + self.prefetch_offset]) \
+                    if i + self.prefetch_offset < len(indices) else idx \
+                    for i, idx in enumerate(indices)]
+
+        return iter(indices)
+
+    def _shard_videos(self, num_videos: int) -> List[List[int]]:
+        # load of each video (keyframes or frames), also used to report the expected load
+        if self.shard_by == 'frames' or (self.shard_by == 'videos' and self.load_video):
+            load_name = 'frames'
+            video_loads = np.array([self.dataset.get_len_per_video(i) for i in range(num_videos)])
+        else:
+            load_name = 'keyframes'
+            video_loads = self.dataset.get_num_keyframes_per_video()
+
+        if self.shard_by == 'videos':
+            chunks = [c.tolist() for c in np.array_split(list(range(num_videos)), self.world_size)]
+        else:
+            # assign longest videos first, each to the rank with the lowest load so far (ties
+            # broken by number of videos so that every rank gets a video)
+            chunks = [[] for _ in range(self.world_size)]
+            rank_loads = np.zeros(self.world_size, dtype=np.int64)
+            for video_ind in np.argsort(-video_loads, kind='stable'):
+                r = min(range(self.world_size), key=lambda r: (rank_loads[r], len(chunks[r])))
+                chunks[r].append(int(video_ind))
+                rank_loads[r] += video_loads[video_ind]
+
+            chunks = [sorted(c) for c in chunks]
+
+        rank_loads = [int(sum(video_loads[c])) for c in chunks]
+        print_log('TrackCustomKeyframeSampler: expected {} per rank (shard_by={}): {}, '
+                'max/mean: {:.2f}'.format(load_name, self.shard_by, rank_loads,
+                    max(rank_loads) / max(np.mean(rank_loads), 1)), logger='current')
+
+        return chunks
+
+@DATA_SAMPLERS.register_module()
+class VideoLengthBatchSampler(BatchSampler):
+    """Batch whole videos (AllFramesSample / load_video) by length, with a frame budget.
+
+    Videos are shuffled, collected into pools of pool_size, and sorted by length within each
+    pool so that videos of similar length are batched together. Batches hold at most batch_size
+    videos and at most max_frames padded frames (batch size x longest video); a video longer
+    than max_frames forms its own batch. Batches are built from the indices of all ranks (using
+    the seed and epoch of the sampler) and then split across ranks, so that every rank gets the
+    same number of batches.
+
+    Args:
+        sampler (TrackCustomKeyframeSampler): sampler over the video dataset, indices can be
+            video indices or (video index, frame index) tuples.
+        batch_size (int): max number of videos in a batch.
+        max_frames (int): max number of padded frames in a batch.
+        pool_size (int): number of videos to sort by length at once.
+    """
+    def __init__(self, sampler: Sampler, batch_size: int, max_frames: int,
+            pool_size: int = 32) -> None:
+        if not isinstance(sampler, Sampler):
+            raise TypeError('sampler should be an instance of ``Sampler``, '
+                            f'but got {sampler}')
+        assert isinstance(sampler.dataset, VideoDatasetWithDS), \
+                'VideoLengthBatchSampler is only supported for VideoDatasetWithDS'
+
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.max_frames = max_frames
+        self.pool_size = pool_size
+
+    def _get_video_length(self, idx) -> int:
+        video_ind = idx[0] if isinstance(idx, tuple) else idx
+        return self.sampler.dataset.get_len_per_video(video_ind)
+
+    def _make_batches(self) -> List[List]:
+        sampler = self.sampler
+        if sampler.test_mode:
+            indices = list(sampler.indices[sampler.rank])
+        else:
+            rng = random.Random(sampler.seed + sampler.epoch)
+            indices = rng.sample(sampler.indices, len(sampler.indices))
+
+        batches = []
+        for pool_start in range(0, len(indices), self.pool_size):
+            pool = sorted(indices[pool_start:pool_start + self.pool_size],
+                    key=self._get_video_length)
+
+            # pool is sorted, so the last video added to a batch is the longest
+            batch = []
+            for idx in pool:
+                if len(batch) == self.batch_size or (len(batch) > 0 and \
+                        (len(batch) + 1) * self._get_video_length(idx) > self.max_frames):
+                    batches.append(batch)
+                    batch = []
+
+                batch.append(idx)
+
+            if len(batch) > 0:
+                batches.append(batch)
+
+        if not sampler.test_mode:
+            # shuffle batches and repeat some so that they can be split evenly across ranks
+            rng.shuffle(batches)
+            num_extra = -len(batches) % sampler.world_size
+            batches = batches + batches[:num_extra]
+            batches = batches[sampler.rank::sampler.world_size]
+
+        return batches
+
+    def __iter__(self) -> Iterator[List]:
+        yield from self._make_batches()
+
+    def __len__(self) -> int:
+        return len(self._make_batches())
+
 @TRANSFORMS.register_module()
 class UniformRefFrameSampleWithPad(UniformRefFrameSample):
     """Code to load all images and metadata for a clip given a keyframe"""
@@ -1,16 +1,21 @@
 from mmdet.registry import METRICS
 from mmdet.evaluation.metrics import CocoMetric
 from mmdet.structures.bbox import scale_boxes
+from model.predictor_heads.modules.loss import roi_ssim
 from mmengine.structures import BaseDataElement
 from mmengine.logging import MMLogger
+from mmengine.dist import (all_gather_object, broadcast_object_list, collect_results,
+        get_rank, get_world_size, is_main_process)
 from typing import Dict, Sequence
 import torchmetrics.functional as MF
 from torchmetrics.functional import multiscale_structural_similarity_index_measure as ms_ssim, structural_similarity_index_measure as ssim
 import torch
 from torch import Tensor
 import torchvision.transforms.functional as TF
-from torchmetrics import AveragePrecision as AP, Precision, Recall, F1Score
+import torch.nn.functional as F
 import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import io
 import cv2
 import numpy as np
@@ -18,7 +23,7 @@ import networkx as nx
 import matplotlib.pyplot as plt
 from matplotlib import font_manager
 from matplotlib import rc
-from typing import List
+from typing import List, Optional, Tuple
 
 @METRICS.register_module()
 class CocoMetricRGD(CocoMetric):
@@ -26,7 +31,9 @@ class CocoMetricRGD(CocoMetric):
             num_classes: int, additional_metrics: List = [], clip_eval: bool = False,
             pred_per_frame: bool = False, save_lg: bool = False, num_thresholds: int = 10,
             task_type: str = 'multilabel', agg: str = 'frame', ds_per_class: bool = True,
-            save_reconstructions: bool = False, **kwargs):
+            save_reconstructions: bool = False, online: bool = False, num_ap_bins: int = 1000,
+            spill_dir: str = None, num_io_threads: int = 8, max_pending_io: int = 64,
+            ds_out_format: str = 'txt', **kwargs):
 
         super().__init__(**kwargs)
         self.ssim_roi = SSIM_RoI(data_range=1, size_average=True, channel=3)
@@ -43,6 +50,24 @@ class CocoMetricRGD(CocoMetric):
         self.num_classes = num_classes
         self.num_thresholds = num_thresholds
         self.save_reconstructions = save_reconstructions
+        self.ds_out_format = ds_out_format # 'txt' or 'npz' (binary, with the img id of each pred)
+        self.ds_per_video = 'per_video' in agg if task_type == 'multilabel' else 'video' in agg
+
+        # online mode: accumulate per-video confusion matrices (multiclass)/score histograms with
+        # num_ap_bins bins (multilabel AP), and ssim, in process instead of keeping all results,
+        # ds preds are only kept (spilled to spill_dir) if spill_dir is set
+        self.online = online
+        self.num_ap_bins = num_ap_bins
+        self.spill_dir = spill_dir
+        self.spill_files = None
+        self.reset_online_state()
+
+        # gt imgs for reconstruction metrics are loaded (and ssim computed) in a background
+        # thread pool during process, with at most max_pending_io pending imgs
+        self.num_io_threads = num_io_threads
+        self.max_pending_io = max_pending_io
+        self.io_pool = None
+        self.pending_io = []
 
         # fonts
         try:
@@ -62,6 +87,8 @@ class CocoMetricRGD(CocoMetric):
     def process(self, data_batch: Dict, data_samples: Sequence[dict]) -> None:
         if self.save_lg:
             pass
+        elif self.online:
+            self.process_online(data_batch, data_samples)
         else:
             if len(self.metrics) > 0:
                 super().process(data_batch, data_samples)
@@ -121,8 +148,210 @@ class CocoMetricRGD(CocoMetric):
                     p['is_ds_keyframe'] = data_sample['is_ds_keyframe']
                     g['is_ds_keyframe'] = data_sample['is_ds_keyframe']
 
+                if 'reconstruction' in data_sample and 'reconstruction' in self.additional_metrics:
+                    # compute ssim in the background, stored in p before results are collected
+                    self.submit_reconstruction_ssim(p, data_sample)
+
             self.results[-1 * len(data_samples):] = zip(gts, preds)
 
+            self.resolve_pending_io(self.max_pending_io)
+
+    def process_online(self, data_batch: Dict, data_samples: Sequence[dict]) -> None:
+        """Accumulate the statistics needed for the ds and reconstruction metrics of a batch,
+        instead of keeping all results until the end of the epoch (only detection results are
+        kept if detection metrics are computed)."""
+        if len(self.metrics) > 0:
+            super().process(data_batch, data_samples)
+
+        for data_sample in data_samples:
+            if 'pred_ds' in data_sample:
+                self.update_ds_state(data_sample['pred_ds'].detach().cpu(), data_sample['ds'],
+                        data_sample['img_id'], data_sample.get('video_id', None))
+
+            if 'reconstruction' not in data_sample:
+                continue
+
+            if 'reconstruction' in self.additional_metrics:
+                # compute ssim in the background, accumulated when done
+                self.submit_reconstruction_ssim(None, data_sample)
+
+            if self.save_reconstructions and self.outfile_prefix is not None:
+                self.pending_io.append((None, self.get_io_pool().submit(self.save_reconstruction,
+                    data_sample['reconstruction'].detach().cpu(), data_sample['img_id'],
+                    self.outfile_prefix)))
+
+        self.resolve_pending_io(self.max_pending_io)
+
+    def get_io_pool(self) -> ThreadPoolExecutor:
+        if self.io_pool is None:
+            self.io_pool = ThreadPoolExecutor(max_workers=self.num_io_threads,
+                    thread_name_prefix='metric_io')
+
+        return self.io_pool
+
+    def submit_reconstruction_ssim(self, result: dict, data_sample: dict) -> None:
+        # load gt img and compute ssim of the reconstruction in the io pool
+        boxes = None
+        if self.use_pred_boxes_recon:
+            boxes = Tensor(data_sample['pred_instances']['bboxes'])
+
+        future = self.get_io_pool().submit(self.reconstruction_ssim,
+                data_sample['reconstruction'].detach().cpu(), data_sample['img_id'], boxes)
+        self.pending_io.append((result, future))
+
+    def resolve_pending_io(self, max_pending: int = 0) -> None:
+        # wait for the oldest pending imgs, until at most max_pending are left, and store their
+        # ssim in their result (or accumulate it in online mode)
+        while len(self.pending_io) > max_pending:
+            result, future = self.pending_io.pop(0)
+            ssim_vals = future.result()
+            if ssim_vals is None:
+                continue
+
+            ssim_val, ssim_roi = ssim_vals
+            if result is not None:
+                result['ssim'], result['ssim_roi'] = ssim_val, ssim_roi
+
+            else:
+                self.online_state['ssim'] += [ssim_val.item(), 1]
+                if not ssim_roi.isnan():
+                    self.online_state['ssim_roi'] += [ssim_roi.item(), 1]
+
+    def update_ds_state(self, pred_ds: Tensor, gt_ds: np.ndarray, img_id: int,
+            video_id: int = None) -> None:
+        # confusion matrices (multiclass) or score histograms (multilabel) of each video, and
+        # spilled preds/gt
+        key = video_id if self.ds_per_video else 0
+        if 'multitask' in self.task_type:
+            if 'multiclass' in self.task_type:
+                preds = pred_ds.max(-1).indices
+                gt = Tensor(gt_ds).long()
+                stats = segment_confusion_matrices(preds, gt, torch.arange(gt.shape[-1]),
+                        gt.shape[-1], 3)
+            else:
+                raise NotImplementedError
+
+        elif self.task_type == 'multilabel':
+            preds = pred_ds.sigmoid().view(-1, self.num_classes)
+            gt = Tensor(gt_ds).round().long().view(-1, self.num_classes)
+            stats = score_histograms(preds, gt, self.num_ap_bins)
+
+        elif self.task_type == 'multiclass':
+            preds = pred_ds.argmax(-1).view(-1)
+            gt = Tensor(gt_ds.astype(float)).view(-1).long()
+            stats = segment_confusion_matrices(preds, gt, torch.zeros_like(gt), 1,
+                    self.num_classes)[0]
+
+        else:
+            raise NotImplementedError("Metrics not defined for task type {}".format(self.task_type))
+
+        ds_state = self.online_state['ds']
+        ds_state[key] = ds_state[key] + stats if key in ds_state else stats
+
+        if self.spill_dir is not None:
+            # append to flat files of this rank, read back as memmaps in results2json
+            self.online_state['spill_shapes'] = (tuple(pred_ds.shape), tuple(np.shape(gt_ds)))
+            spill_files = self.get_spill_files()
+            spill_files['pred_ds'].write(pred_ds.float().numpy().tobytes())
+            spill_files['gt_ds'].write(np.asarray(gt_ds, dtype=np.float64).tobytes())
+            spill_files['img_ids'].write(np.asarray([img_id], dtype=np.int64).tobytes())
+
+    def get_spill_files(self) -> Dict:
+        # buffered append handles of the spill files of this rank, opened once per evaluation
+        if self.spill_files is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.spill_files = {name: open(os.path.join(self.spill_dir,
+                f'{name}_{get_rank()}.bin'), 'ab', buffering=1 << 20) \
+                        for name in ['pred_ds', 'gt_ds', 'img_ids']}
+
+        return self.spill_files
+
+    def close_spill_files(self) -> None:
+        if self.spill_files is not None:
+            for f in self.spill_files.values():
+                f.close()
+
+            self.spill_files = None
+
+    def reset_online_state(self) -> None:
+        self.online_state = dict(ds=OrderedDict(), ssim=np.zeros(2), ssim_roi=np.zeros(2),
+                spill_shapes=None)
+        if self.spill_dir is not None:
+            self.close_spill_files()
+            for name in ['pred_ds', 'gt_ds', 'img_ids']:
+                spill_file = os.path.join(self.spill_dir, f'{name}_{get_rank()}.bin')
+                if os.path.exists(spill_file):
+                    os.remove(spill_file)
+
+    def load_spilled_ds(self):
+        # memmap spilled preds/gt/img ids of all ranks
+        pred_shape, gt_shape = self.online_state['spill_shapes']
+        spilled = dict(pred_ds=[], gt_ds=[], img_ids=[])
+        dtypes = dict(pred_ds=np.float32, gt_ds=np.float64, img_ids=np.int64)
+        shapes = dict(pred_ds=pred_shape, gt_ds=gt_shape, img_ids=())
+        for rank in range(get_world_size()):
+            if not os.path.exists(os.path.join(self.spill_dir, f'pred_ds_{rank}.bin')):
+                continue
+
+            for k, v in spilled.items():
+                spill_file = os.path.join(self.spill_dir, f'{k}_{rank}.bin')
+                v.append(np.memmap(spill_file, dtype=dtypes[k], mode='r').reshape(-1, *shapes[k]))
+
+        if len(spilled['pred_ds']) == 1:
+            return [v[0] for v in spilled.values()]
+
+        return [np.concatenate(v) for v in spilled.values()]
+
+    def evaluate(self, size: int) -> dict:
+        self.resolve_pending_io()
+        if not self.online:
+            metrics = super().evaluate(size)
+
+            # wait for writes submitted by results2json (overlapped with compute_metrics)
+            self.resolve_pending_io()
+
+            return metrics
+
+        # flush spill files of this rank before they are read in results2json (the gather
+        # below syncs ranks)
+        self.close_spill_files()
+
+        # merge accumulated statistics of all ranks
+        states = all_gather_object(self.online_state)
+        self.online_state = dict(ds=OrderedDict(), ssim=sum(s['ssim'] for s in states),
+                ssim_roi=sum(s['ssim_roi'] for s in states),
+                spill_shapes=next((s['spill_shapes'] for s in states if s['spill_shapes']), None))
+        for s in states:
+            for k, v in s['ds'].items():
+                ds_state = self.online_state['ds']
+                ds_state[k] = ds_state[k] + v if k in ds_state else v
+
+        # self.results only holds detection results in online mode
+        results = []
+        if len(self.metrics) > 0:
+            results = collect_results(self.results, size, self.collect_device,
+                    tmpdir=self.collect_dir)
+
+        if is_main_process():
+            _metrics = self.compute_metrics(results)
+            if self.prefix:
+                _metrics = {'/'.join((self.prefix, k)): v for k, v in _metrics.items()}
+
+            metrics = [_metrics]
+        else:
+            metrics = [None]
+
+        broadcast_object_list(metrics)
+
+        # wait for writes submitted by results2json
+        self.resolve_pending_io()
+
+        # reset
+        self.results.clear()
+        self.reset_online_state()
+
+        return metrics[0]
+
     def compute_metrics(self, results: list) -> Dict[str, float]:
         if self.save_lg: # skip eval if we are saving
             return {}
@@ -136,236 +365,251 @@ class CocoMetricRGD(CocoMetric):
         logger: MMLogger = MMLogger.get_current_instance()
         logger_info = []
 
+        if self.online:
+            if self.outfile_prefix is not None:
+                self.results2json([r[1] for r in results], self.outfile_prefix)
+
+            # reconstruction metrics
+            ssim_sum, num_ssim = self.online_state['ssim']
+            if num_ssim > 0:
+                ssim_roi_sum, num_ssim_roi = self.online_state['ssim_roi']
+                ssim_val = float(ssim_sum / num_ssim)
+                ssim_roi = float(ssim_roi_sum / num_ssim_roi) if num_ssim_roi > 0 else float('nan')
+                logger_info += [f'ssim: {ssim_val:.4f}', f'ssim_roi: {ssim_roi:.4f}']
+                eval_results['ssim'] = ssim_val
+                eval_results['ssim_roi'] = ssim_roi
+
+            # ds metrics
+            if len(self.online_state['ds']) > 0:
+                eval_results.update(self.compute_ds_metrics(self.online_ds_stats(), logger_info))
+
+            logger.info(' '.join(logger_info))
+            return eval_results
+
         # load data
-        img_paths = self._coco_api.load_imgs(self.img_ids)
         gts, preds = list(map(list, zip(*results)))
 
         if self.outfile_prefix is not None:
             result_files = self.results2json(preds, self.outfile_prefix, gts=gts)
 
-        # compute reconstruction metrics
+        # compute reconstruction metrics (ssim of each img is computed in process)
         if 'reconstruction' in preds[0] and 'reconstruction' in self.additional_metrics:
-            # read img, convert to rgb, 0-1 normalize
-            gt_img_paths = [os.path.join(self.data_root, self.data_prefix, i['file_name']) for i in img_paths]
+            ssim_val = torch.mean(torch.stack([p['ssim'] for p in preds])).detach().cpu().item()
+            ssim_roi = torch.nanmean(torch.stack([p['ssim_roi'] for p in preds])).cpu().item()
+            logger_info += [f'ssim: {ssim_val:.4f}', f'ssim_roi: {ssim_roi:.4f}']
+            eval_results['ssim'] = ssim_val
+            eval_results['ssim_roi'] = ssim_roi
 
-            # get boxes
-            if self.use_pred_boxes_recon:
-                recon_boxes = [Tensor(r[1]['bboxes']) for r in results]
-            else:
-                ann_ids_by_img = [self._coco_api.get_ann_ids(i) for i in self.img_ids]
-                ann_info_by_img = [[self._coco_api.load_anns(a_id)[0] for a_id in i_id] for i_id in ann_ids_by_img]
-                recon_boxes = [Tensor([g['bbox'] for g in a]) for a in ann_info_by_img]
+        # TODO compute graph metrics
+
+        # compute DS metrics
+        if 'ds' in preds[0]:
+            eval_results.update(self.compute_ds_metrics(self.ds_stats(preds, gts), logger_info))
 
-            orig_img_shape = [gts[0]['height'], gts[0]['width']]
+        logger.info(' '.join(logger_info))
+        return eval_results
 
-            ssim_vals = []
-            for pred, gt_path, b in zip(preds, gt_img_paths, recon_boxes):
-                # load
-                g = torch.from_numpy(cv2.imread(gt_path)).permute(2, 0, 1).flip(0) / 255
+    def get_gt_boxes(self, img_id: int) -> Tensor:
+        ann_info = [self._coco_api.load_anns(a_id)[0] for a_id in self._coco_api.get_ann_ids(img_id)]
+        return Tensor([g['bbox'] for g in ann_info])
 
-                # resize pred img to gt_img size
-                p = TF.resize(pred['reconstruction'].detach(), g.shape[-2:])
+    def reconstruction_ssim(self, recon: Tensor, img_id: int, boxes: Tensor = None) -> Tuple[Tensor]:
+        # ssim and ssim roi of a reconstructed img (with gt boxes if boxes is None)
+        img_info = self._coco_api.load_imgs([img_id])[0]
+        if boxes is None:
+            boxes = self.get_gt_boxes(img_id)
 
-                # resize gt img to pred img size
-                #g = TF.resize(g, p.shape[-2:])
+        # read img, convert to rgb, 0-1 normalize
+        gt_path = os.path.join(self.data_root, self.data_prefix, img_info['file_name'])
+        g = torch.from_numpy(cv2.imread(gt_path)).permute(2, 0, 1).flip(0) / 255
 
-                # compute img ssim
-                ssim_vals.append(ssim(p.unsqueeze(0), g.unsqueeze(0)))
+        # resize pred img to gt_img size
+        p = TF.resize(recon.detach(), g.shape[-2:])
 
-                # compute ssim roi
+        return ssim(p.unsqueeze(0), g.unsqueeze(0)), self.ssim_roi(p.unsqueeze(0), g.unsqueeze(0), [boxes])
 
-                # rescale boxes
-                #sf = (Tensor(list(p.shape[-2:])) / Tensor(orig_img_shape)).flip(0)
-                #if b.shape[0] != 0:
-                #    scaled_b = scale_boxes(b, sf).round()
-                #else:
-                #    scaled_b = b
-                self.ssim_roi.update(p.unsqueeze(0), g.unsqueeze(0), [b])
+    def ds_stats(self, preds: list, gts: list) -> Tensor:
+        """Per-video/per-task statistics that ds metrics are computed from: confusion matrices
+        (multiclass, num_videos or num_tasks x C x C) or APs (multilabel, num_videos x C)."""
+        if 'multitask' in self.task_type:
+            if 'multiclass' in self.task_type:
+                ds_preds = torch.stack([p['ds'] for p in preds]).max(-1).indices
+                ds_gt = torch.stack([Tensor(g['ds']) for g in gts]).long()
 
-            ssim_val = torch.mean(torch.stack(ssim_vals)).detach().cpu().item()
-            ssim_roi = self.ssim_roi.compute().cpu().item()
-            self.ssim_roi.reset()
-            logger_info += [f'ssim: {ssim_val:.4f}', f'ssim_roi: {ssim_roi:.4f}']
-            eval_results['ssim'] = ssim_val
-            eval_results['ssim_roi'] = ssim_roi
+                # one confusion matrix per task
+                num_tasks = ds_gt.shape[-1]
+                task_ids = torch.arange(num_tasks).repeat(ds_gt.shape[0])
+                return segment_confusion_matrices(ds_preds.flatten(), ds_gt.flatten(), task_ids,
+                        num_tasks, 3)
 
-        # TODO compute graph metrics
+            else:
+                raise NotImplementedError
 
-        # compute DS metrics
-        if 'per_video' in self.agg:
+        # segment (video) id of each frame, all frames are one segment if not per video
+        segment_ids = torch.zeros(len(preds), dtype=torch.long)
+        if self.ds_per_video:
             vid_ids = torch.tensor([p['video_id'] for p in preds])
+            _, segment_ids = torch.unique_consecutive(vid_ids, return_inverse=True)
 
-        if 'ds' in preds[0]:
-            if 'multitask' in self.task_type:
-                if 'multiclass' in self.task_type:
-                    ds_preds = torch.stack([p['ds'] for p in preds]).max(-1).indices
-                    ds_gt = torch.stack([Tensor(g['ds']) for g in gts])
-
-                    # compute precision, recall, f1
-                    torch_prec = Precision(task='multiclass', average='macro', num_classes=3)
-                    torch_rec = Recall(task='multiclass', average='macro', num_classes=3)
-                    torch_f1 = F1Score(task='multiclass', average='macro', num_classes=3)
-
-                    ds_prec = [torch_prec(ds_preds[:, i], ds_gt[:, i]) for i in range(ds_gt.shape[-1])]
-                    ds_rec = [torch_rec(ds_preds[:, i], ds_gt[:, i]) for i in range(ds_gt.shape[-1])]
-                    ds_f1 = [torch_f1(ds_preds[:, i], ds_gt[:, i]) for i in range(ds_gt.shape[-1])]
-
-                    # log
-                    if self.ds_per_class:
-                        for i in range(len(ds_prec)):
-                            logger_info.append(f'ds_prec_C{i+1}: {ds_prec[i]:.4f}')
-                            logger_info.append(f'ds_rec_C{i+1}: {ds_rec[i]:.4f}')
-                            logger_info.append(f'ds_f1_C{i+1}: {ds_f1[i]:.4f}')
-                            eval_results[f'ds_precision_C{i+1}'] = ds_prec[i]
-                            eval_results[f'ds_recall_C{i+1}'] = ds_rec[i]
-                            eval_results[f'ds_f1_C{i+1}'] = ds_f1[i]
-
-                    ds_prec = sum(ds_prec) / len(ds_prec)
-                    ds_rec = sum(ds_rec) / len(ds_rec)
-                    ds_f1 = sum(ds_f1) / len(ds_f1)
-
-                    logger_info.append(f'ds_precision: {ds_prec:.4f}')
-                    logger_info.append(f'ds_recall: {ds_rec:.4f}')
-                    logger_info.append(f'ds_f1: {ds_f1:.4f}')
-                    eval_results['ds_precision'] = ds_prec
-                    eval_results['ds_recall'] = ds_rec
-                    eval_results['ds_f1'] = ds_f1
+        num_segments = int(segment_ids.max()) + 1
 
-                else:
-                    raise NotImplementedError
+        if self.task_type == 'multilabel':
+            ds_preds = torch.stack([p['ds'] for p in preds]).sigmoid()
+            ds_gt = torch.stack([Tensor(g['ds']).round() for g in gts]).long()
 
-            else:
-                if self.task_type == 'multilabel':
-                    torch_ap = AP(task='multilabel', num_labels=self.num_classes, average='none')
-                    ds_preds = torch.stack([p['ds'] for p in preds]).sigmoid()
-                    ds_gt = torch.stack([Tensor(g['ds']).round() for g in gts]).long()
-
-                    if 'per_video' in self.agg:
-                        # split ds_preds, gt by video
-                        _, vid_lengths = torch.unique_consecutive(vid_ids, return_counts=True)
-                        ds_preds_per_vid = ds_preds.split(vid_lengths.tolist())
-                        ds_gt_per_vid = ds_gt.split(vid_lengths.tolist())
-                        aps = []
-                        for p, gt in zip(ds_preds_per_vid, ds_gt_per_vid):
-                            aps.append(torch_ap(p, gt))
-
-                        ds_vid_ap_per_class = torch.stack(aps).nanmean(0)
-                        if self.ds_per_class:
-                            for ind, i in enumerate(ds_vid_ap_per_class):
-                                logger_info.append(f'ds_vid_ap_C{ind+1}: {i:.4f}')
-                                eval_results[f'ds_vid_ap_C{ind+1}'] = i
-
-                        if 'per_class' in self.agg:
-                            ds_vid_ap = ds_vid_ap_per_class.nanmean()
-                            ds_vid_ap_std = ds_vid_ap_per_class[~ds_vid_ap_per_class.isnan()].std()
-
-                        else:
-                            ds_per_vid_ap = torch.stack(aps).nanmean(1)
-                            ds_vid_ap = ds_per_vid_ap.nanmean()
-                            ds_vid_ap_std = ds_per_vid_ap[~ds_per_vid_ap.isnan()].std()
-
-                        logger_info.append(f'ds_vid_ap: {ds_vid_ap} +- {ds_vid_ap_std}')
-                        eval_results['ds_video_average_precision'] = ds_vid_ap
-                        eval_results['ds_video_average_precision_std'] = ds_vid_ap_std
+            # AP of each video and class (num_videos x num_classes) in one pass
+            return segment_average_precision(ds_preds, ds_gt, segment_ids, num_segments)
 
-                    else:
-                        ds_ap = torch_ap(ds_preds, ds_gt)
-
-                        # log overall
-                        logger_info.append(f'ds_average_precision: {torch.nanmean(ds_ap):.4f}')
-                        eval_results['ds_average_precision'] = torch.nanmean(ds_ap)
-
-                        if self.ds_per_class:
-                            # log component-wise
-                            for ind, i in enumerate(ds_ap):
-                                logger_info.append(f'ds_average_precision_C{ind+1}: {i:.4f}')
-                                eval_results['ds_average_precision_C{}'.format(ind+1)] = i
-
-                elif self.task_type == 'multiclass':
-                    # get preds and gt
-                    ds_preds = torch.stack([p['ds'] for p in preds]).argmax(-1).view(-1)
-                    ds_gt = torch.stack([Tensor(g['ds'].astype(float)).view(-1) for g in gts]).long().view(-1)
-
-                    # define
-                    torch_prec = Precision(task='multiclass', average='none', num_classes=self.num_classes)
-                    torch_rec = Recall(task='multiclass', average='none', num_classes=self.num_classes)
-                    torch_f1 = F1Score(task='multiclass', average='none', num_classes=self.num_classes)
-
-                    if 'video' in self.agg:
-                        # split ds_preds, gt by video
-                        _, vid_lengths = torch.unique_consecutive(vid_ids, return_counts=True)
-                        ds_preds_per_vid = ds_preds.split(vid_lengths.tolist())
-                        ds_gt_per_vid = ds_gt.split(vid_lengths.tolist())
-                        precs = []
-                        recs = []
-                        f1s = []
-                        for p, gt in zip(ds_preds_per_vid, ds_gt_per_vid):
-                            precs.append(torch_prec(p, gt))
-                            recs.append(torch_rec(p, gt))
-                            f1s.append(torch_f1(p, gt))
-
-                        if self.ds_per_class:
-                            ds_vid_prec_per_class = torch.stack(precs).nanmean(0)
-                            ds_vid_rec_per_class = torch.stack(recs).nanmean(0)
-                            ds_vid_f1_per_class = torch.stack(f1s).nanmean(0)
-                            for i in range(len(ds_vid_prec_per_class)):
-                                logger_info.append(f'ds_vid_prec_C{i+1}: {ds_vid_prec_per_class[i]:.4f}')
-                                logger_info.append(f'ds_vid_rec_C{i+1}: {ds_vid_rec_per_class[i]:.4f}')
-                                logger_info.append(f'ds_vid_f1_C{i+1}: {ds_vid_f1_per_class[i]:.4f}')
-                                eval_results[f'ds_video_precision_C{i+1}'] = ds_vid_prec_per_class[i]
-                                eval_results[f'ds_video_recall_C{i+1}'] = ds_vid_rec_per_class[i]
-                                eval_results[f'ds_video_f1_C{i+1}'] = ds_vid_f1_per_class[i]
-
-                        ds_per_vid_prec = torch.stack(precs).nanmean(1)
-                        ds_vid_prec = ds_per_vid_prec.nanmean(0)
-                        ds_vid_prec_std = ds_per_vid_prec[~ds_per_vid_prec.isnan()].std(0)
-
-                        ds_per_vid_rec = torch.stack(recs).nanmean(1)
-                        ds_vid_rec = ds_per_vid_rec.nanmean(0)
-                        ds_vid_rec_std = ds_per_vid_rec[~ds_per_vid_rec.isnan()].std(0)
-
-                        ds_per_vid_f1 = torch.stack(f1s).nanmean(1)
-                        ds_vid_f1 = ds_per_vid_f1.nanmean(0)
-                        ds_vid_f1_std = ds_per_vid_f1[~ds_per_vid_f1.isnan()].std(0)
-
-                        logger_info.append(f'ds_video_precision: {ds_vid_prec:.4f} +- {ds_vid_prec_std:.4f}')
-                        logger_info.append(f'ds_video_recall: {ds_vid_rec:.4f} +- {ds_vid_rec_std:.4f}')
-                        logger_info.append(f'ds_video_f1: {ds_vid_f1:.4f} +- {ds_vid_f1_std:.4f}')
-                        eval_results['ds_video_precision'] = ds_vid_prec
-                        eval_results['ds_video_precision_std'] = ds_vid_prec_std
-                        eval_results['ds_video_recall'] = ds_vid_rec
-                        eval_results['ds_video_recall_std'] = ds_vid_rec_std
-                        eval_results['ds_video_f1'] = ds_vid_f1
-                        eval_results['ds_video_f1_std'] = ds_vid_f1_std
+        elif self.task_type == 'multiclass':
+            # get preds and gt
+            ds_preds = torch.stack([p['ds'] for p in preds]).argmax(-1).view(-1)
+            ds_gt = torch.stack([Tensor(g['ds'].astype(float)).view(-1) for g in gts]).long().view(-1)
+            segment_ids = segment_ids.repeat_interleave(ds_gt.shape[0] // len(preds))
 
-                    else:
-                        # compute
-                        ds_prec = torch_prec(ds_preds, ds_gt)
-                        ds_rec = torch_rec(ds_preds, ds_gt)
-                        ds_f1 = torch_f1(ds_preds, ds_gt)
-
-                        if self.ds_per_class:
-                            # log component-wise
-                            for ind, i in enumerate(ds_prec):
-                                logger_info.append(f'ds_precision_C{ind+1}: {i:.4f}')
-                                logger_info.append(f'ds_recall_C{ind+1}: {i:.4f}')
-                                logger_info.append(f'ds_f1_C{ind+1}: {i:.4f}')
-                                eval_results['ds_precision_C{}'.format(ind+1)] = i
-                                eval_results['ds_recall_C{}'.format(ind+1)] = i
-                                eval_results['ds_f1_C{}'.format(ind+1)] = i
-
-                        # log
-                        logger_info.append(f'ds_precision: {torch.nanmean(ds_prec):.4f}')
-                        logger_info.append(f'ds_recall: {torch.nanmean(ds_rec):.4f}')
-                        logger_info.append(f'ds_f1: {torch.nanmean(ds_f1):.4f}')
-                        eval_results['ds_precision'] = torch.nanmean(ds_prec)
-                        eval_results['ds_recall'] = torch.nanmean(ds_rec)
-                        eval_results['ds_f1'] = torch.nanmean(ds_f1)
+            # one confusion matrix per video
+            return segment_confusion_matrices(ds_preds, ds_gt, segment_ids, num_segments,
+                    self.num_classes)
+
+        else:
+            raise NotImplementedError("Metrics not defined for task type {}".format(self.task_type))
+
+    def online_ds_stats(self) -> Tensor:
+        # same as ds_stats, from accumulated confusion matrices/score histograms
+        stats = torch.stack(list(self.online_state['ds'].values()))
+        if 'multitask' in self.task_type:
+            return stats.sum(0)
+
+        if self.task_type == 'multilabel':
+            return histogram_average_precision(stats)
+
+        return stats
+
+    def compute_ds_metrics(self, ds_stats: Tensor, logger_info: list) -> Dict[str, float]:
+        eval_results = {}
+        if 'multitask' in self.task_type:
+            # precision, recall, f1 of all tasks
+            ds_prec, ds_rec, ds_f1 = [macro_average(s, ds_stats) for s in multiclass_scores(ds_stats)]
+            ds_prec, ds_rec, ds_f1 = ds_prec.unbind(0), ds_rec.unbind(0), ds_f1.unbind(0)
+
+            # log
+            if self.ds_per_class:
+                for i in range(len(ds_prec)):
+                    logger_info.append(f'ds_prec_C{i+1}: {ds_prec[i]:.4f}')
+                    logger_info.append(f'ds_rec_C{i+1}: {ds_rec[i]:.4f}')
+                    logger_info.append(f'ds_f1_C{i+1}: {ds_f1[i]:.4f}')
+                    eval_results[f'ds_precision_C{i+1}'] = ds_prec[i]
+                    eval_results[f'ds_recall_C{i+1}'] = ds_rec[i]
+                    eval_results[f'ds_f1_C{i+1}'] = ds_f1[i]
+
+            ds_prec = sum(ds_prec) / len(ds_prec)
+            ds_rec = sum(ds_rec) / len(ds_rec)
+            ds_f1 = sum(ds_f1) / len(ds_f1)
+
+            logger_info.append(f'ds_precision: {ds_prec:.4f}')
+            logger_info.append(f'ds_recall: {ds_rec:.4f}')
+            logger_info.append(f'ds_f1: {ds_f1:.4f}')
+            eval_results['ds_precision'] = ds_prec
+            eval_results['ds_recall'] = ds_rec
+            eval_results['ds_f1'] = ds_f1
+
+        elif self.task_type == 'multilabel':
+            aps = ds_stats
+            if self.ds_per_video:
+                ds_vid_ap_per_class = aps.nanmean(0)
+                if self.ds_per_class:
+                    for ind, i in enumerate(ds_vid_ap_per_class):
+                        logger_info.append(f'ds_vid_ap_C{ind+1}: {i:.4f}')
+                        eval_results[f'ds_vid_ap_C{ind+1}'] = i
+
+                if 'per_class' in self.agg:
+                    ds_vid_ap = ds_vid_ap_per_class.nanmean()
+                    ds_vid_ap_std = ds_vid_ap_per_class[~ds_vid_ap_per_class.isnan()].std()
 
                 else:
-                    raise NotImplementedError("Metrics not defined for task type {}".format(self.task_type))
+                    ds_per_vid_ap = aps.nanmean(1)
+                    ds_vid_ap = ds_per_vid_ap.nanmean()
+                    ds_vid_ap_std = ds_per_vid_ap[~ds_per_vid_ap.isnan()].std()
+
+                logger_info.append(f'ds_vid_ap: {ds_vid_ap} +- {ds_vid_ap_std}')
+                eval_results['ds_video_average_precision'] = ds_vid_ap
+                eval_results['ds_video_average_precision_std'] = ds_vid_ap_std
+
+            else:
+                ds_ap = aps[0]
+
+                # log overall
+                logger_info.append(f'ds_average_precision: {torch.nanmean(ds_ap):.4f}')
+                eval_results['ds_average_precision'] = torch.nanmean(ds_ap)
+
+                if self.ds_per_class:
+                    # log component-wise
+                    for ind, i in enumerate(ds_ap):
+                        logger_info.append(f'ds_average_precision_C{ind+1}: {i:.4f}')
+                        eval_results['ds_average_precision_C{}'.format(ind+1)] = i
+
+        elif self.task_type == 'multiclass':
+            # precision, recall, f1 of each video and class (num_videos x num_classes)
+            precs, recs, f1s = multiclass_scores(ds_stats)
+
+            if self.ds_per_video:
+                if self.ds_per_class:
+                    ds_vid_prec_per_class = precs.nanmean(0)
+                    ds_vid_rec_per_class = recs.nanmean(0)
+                    ds_vid_f1_per_class = f1s.nanmean(0)
+                    for i in range(len(ds_vid_prec_per_class)):
+                        logger_info.append(f'ds_vid_prec_C{i+1}: {ds_vid_prec_per_class[i]:.4f}')
+                        logger_info.append(f'ds_vid_rec_C{i+1}: {ds_vid_rec_per_class[i]:.4f}')
+                        logger_info.append(f'ds_vid_f1_C{i+1}: {ds_vid_f1_per_class[i]:.4f}')
+                        eval_results[f'ds_video_precision_C{i+1}'] = ds_vid_prec_per_class[i]
+                        eval_results[f'ds_video_recall_C{i+1}'] = ds_vid_rec_per_class[i]
+                        eval_results[f'ds_video_f1_C{i+1}'] = ds_vid_f1_per_class[i]
+
+                ds_per_vid_prec = precs.nanmean(1)
+                ds_vid_prec = ds_per_vid_prec.nanmean(0)
+                ds_vid_prec_std = ds_per_vid_prec[~ds_per_vid_prec.isnan()].std(0)
+
+                ds_per_vid_rec = recs.nanmean(1)
+                ds_vid_rec = ds_per_vid_rec.nanmean(0)
+                ds_vid_rec_std = ds_per_vid_rec[~ds_per_vid_rec.isnan()].std(0)
+
+                ds_per_vid_f1 = f1s.nanmean(1)
+                ds_vid_f1 = ds_per_vid_f1.nanmean(0)
+                ds_vid_f1_std = ds_per_vid_f1[~ds_per_vid_f1.isnan()].std(0)
+
+                logger_info.append(f'ds_video_precision: {ds_vid_prec:.4f} +- {ds_vid_prec_std:.4f}')
+                logger_info.append(f'ds_video_recall: {ds_vid_rec:.4f} +- {ds_vid_rec_std:.4f}')
+                logger_info.append(f'ds_video_f1: {ds_vid_f1:.4f} +- {ds_vid_f1_std:.4f}')
+                eval_results['ds_video_precision'] = ds_vid_prec
+                eval_results['ds_video_precision_std'] = ds_vid_prec_std
+                eval_results['ds_video_recall'] = ds_vid_rec
+                eval_results['ds_video_recall_std'] = ds_vid_rec_std
+                eval_results['ds_video_f1'] = ds_vid_f1
+                eval_results['ds_video_f1_std'] = ds_vid_f1_std
+
+            else:
+                ds_prec, ds_rec, ds_f1 = precs[0], recs[0], f1s[0]
+
+                if self.ds_per_class:
+                    # log component-wise
+                    for ind, i in enumerate(ds_prec):
+                        logger_info.append(f'ds_precision_C{ind+1}: {i:.4f}')
+                        logger_info.append(f'ds_recall_C{ind+1}: {i:.4f}')
+                        logger_info.append(f'ds_f1_C{ind+1}: {i:.4f}')
+                        eval_results['ds_precision_C{}'.format(ind+1)] = i
+                        eval_results['ds_recall_C{}'.format(ind+1)] = i
+                        eval_results['ds_f1_C{}'.format(ind+1)] = i
+
+                # log
+                logger_info.append(f'ds_precision: {torch.nanmean(ds_prec):.4f}')
+                logger_info.append(f'ds_recall: {torch.nanmean(ds_rec):.4f}')
+                logger_info.append(f'ds_f1: {torch.nanmean(ds_f1):.4f}')
+                eval_results['ds_precision'] = torch.nanmean(ds_prec)
+                eval_results['ds_recall'] = torch.nanmean(ds_rec)
+                eval_results['ds_f1'] = torch.nanmean(ds_f1)
+
+        else:
+            raise NotImplementedError("Metrics not defined for task type {}".format(self.task_type))
 
-        logger.info(' '.join(logger_info))
         return eval_results
 
     def results2json(self, results: Sequence[dict], outfile_prefix: str, gts: Sequence[dict] = None) -> dict:
@@ -377,87 +621,246 @@ class CocoMetricRGD(CocoMetric):
         else:
             result_files = {}
 
-        if 'reconstruction' in results[0] and self.save_reconstructions:
-            recon_imgs = []
-            img_ids = []
-            for idx, result in enumerate(results):
-                img_ids.append(result['img_id'])
-                recon_imgs.append(result['reconstruction'])
-
-            # save recon imgs
-            if not os.path.exists(os.path.join(outfile_prefix, 'reconstructions')):
-                os.makedirs(os.path.join(outfile_prefix, 'reconstructions'))
-
-            for img_id, r in zip(img_ids, recon_imgs):
-                # resize img
-                r = TF.resize(r, (480, 854))
-                cv2_img = (r.flip(0).permute(1, 2, 0) * 255).cpu().numpy().astype(np.uint8) # BGR, 0-255
-                outname = os.path.join(outfile_prefix, 'reconstructions', str(img_id) + '.jpg')
-                cv2.imwrite(outname, cv2_img)
+        if self.save_reconstructions and (self.online or 'reconstruction' in results[0]):
+            # recon imgs are written by the io pool (already submitted in process in online mode)
+            for result in ([] if self.online else results):
+                self.pending_io.append((None, self.get_io_pool().submit(self.save_reconstruction,
+                    result['reconstruction'], result['img_id'], outfile_prefix)))
 
             result_files['reconstruction'] = os.path.join(outfile_prefix, 'reconstructions')
 
-        if 'ds' in results[0]:
+        # get ds preds (spilled to disk in online mode)
+        pred_ds, gt_ds, img_ids = None, None, None
+        if self.online:
+            if self.spill_dir is not None and self.online_state['spill_shapes'] is not None:
+                self.close_spill_files()
+                pred_ds, gt_ds, img_ids = self.load_spilled_ds()
+                pred_ds = torch.from_numpy(pred_ds)
+
+        elif 'ds' in results[0]:
+            pred_ds = torch.stack([r['ds'] for r in results])
+            img_ids = np.array([r['img_id'] for r in results])
+            if gts is not None:
+                gt_ds = np.stack([g['ds'] for g in gts])
+
+        if pred_ds is not None:
             # save ds preds
-            pred_ds = torch.stack([r['ds'] for r in results]).sigmoid()
+            pred_ds = pred_ds.sigmoid()
 
             if not os.path.exists(outfile_prefix):
                 os.makedirs(outfile_prefix)
 
-            if pred_ds.ndim > 2:
-                pred_outname = os.path.join(outfile_prefix, 'pred_ds.npy')
-                np.save(pred_outname, pred_ds.detach().cpu().numpy())
-            else:
-                pred_outname = os.path.join(outfile_prefix, 'pred_ds.txt')
-                np.savetxt(pred_outname, pred_ds.detach().cpu().numpy())
+            threshs = None
+            # calibration only supported for single task, multilabel classification
+            if gt_ds is not None and 'multitask' not in self.task_type and 'multilabel' in self.task_type:
+                threshs = self.calibrate_thresholds(pred_ds, torch.from_numpy(gt_ds))
 
-            if gts is not None:
-                gt_ds = np.stack([g['ds'] for g in gts])
-                gt_outname = os.path.join(outfile_prefix, 'gt_ds.txt')
-                np.savetxt(gt_outname, gt_ds)
+            # write in the io pool
+            if self.ds_out_format == 'npz':
+                result_files['ds'] = os.path.join(outfile_prefix, 'pred_ds.npz')
+            else:
+                result_files['ds'] = os.path.join(outfile_prefix, 'pred_ds.npy' if pred_ds.ndim > 2 \
+                        else 'pred_ds.txt')
 
-                # calibration only supported for single task, multilabel classification
-                if 'multitask' not in self.task_type and 'multilabel' in self.task_type:
-                    # calibrate thresholds and save
-                    threshs = self.calibrate_thresholds(pred_ds, torch.from_numpy(gt_ds))
-                    thresh_outname = os.path.join(outfile_prefix, 'threshs.txt')
-                    np.savetxt(thresh_outname, threshs)
+            self.pending_io.append((None, self.get_io_pool().submit(self.save_ds, outfile_prefix,
+                pred_ds.detach().cpu().numpy(), gt_ds, img_ids, threshs)))
 
         return result_files
 
-    def calibrate_thresholds(self, pred_ds: torch.Tensor, gt_ds: torch.Tensor):
-        threshs = torch.linspace(0, 1, self.num_thresholds)
-        selected_threshs = []
-        for c in range(pred_ds.shape[1]):
-            gts = gt_ds[:, c].int()
-            metric_vals = []
-            for t in threshs:
-                preds = (pred_ds[:, c] > t).int()
-                metric_vals.append(MF.classification.accuracy(preds, gts, task='multiclass',
-                        num_classes=2, average='macro').detach().cpu().item())
+    def save_ds(self, outfile_prefix: str, pred_ds: np.ndarray, gt_ds: np.ndarray = None,
+            img_ids: np.ndarray = None, threshs: np.ndarray = None) -> None:
+        if self.ds_out_format == 'npz':
+            # binary, with the img id of each row
+            ds_results = dict(pred_ds=pred_ds, img_ids=img_ids, gt_ds=gt_ds, threshs=threshs)
+            np.savez(os.path.join(outfile_prefix, 'pred_ds.npz'),
+                    **{k: v for k, v in ds_results.items() if v is not None})
+            return
+
+        if pred_ds.ndim > 2:
+            np.save(os.path.join(outfile_prefix, 'pred_ds.npy'), pred_ds)
+        else:
+            np.savetxt(os.path.join(outfile_prefix, 'pred_ds.txt'), pred_ds)
+
+        if gt_ds is not None:
+            np.savetxt(os.path.join(outfile_prefix, 'gt_ds.txt'), gt_ds)
 
-            selected_threshs.append(threshs[metric_vals.index(max(metric_vals))])
+        if threshs is not None:
+            np.savetxt(os.path.join(outfile_prefix, 'threshs.txt'), threshs)
 
-        return np.array(selected_threshs)
+    def save_reconstruction(self, recon: Tensor, img_id: int, outfile_prefix: str) -> None:
+        if not os.path.exists(os.path.join(outfile_prefix, 'reconstructions')):
+            os.makedirs(os.path.join(outfile_prefix, 'reconstructions'), exist_ok=True)
+
+        # resize img
+        r = TF.resize(recon, (480, 854))
+        cv2_img = (r.flip(0).permute(1, 2, 0) * 255).cpu().numpy().astype(np.uint8) # BGR, 0-255
+        outname = os.path.join(outfile_prefix, 'reconstructions', str(img_id) + '.jpg')
+        cv2.imwrite(outname, cv2_img)
+
+    def calibrate_thresholds(self, pred_ds: torch.Tensor, gt_ds: torch.Tensor):
+        """Select the threshold of each class that maximizes its balanced accuracy (macro
+        accuracy of preds > thresh), among num_thresholds evenly spaced thresholds in [0, 1],
+        or among all scores (exact optimum) if num_thresholds <= 0."""
+        scores = pred_ds.float().T.contiguous() # C x N
+        gts = gt_ds.T.int()
+        N = scores.shape[1]
+
+        # number of positives among the k lowest scores of each class
+        sorted_scores, order = scores.sort(-1)
+        pos_below = F.pad(gts.gather(-1, order).cumsum(-1), (1, 0))
+
+        if self.num_thresholds > 0:
+            threshs = torch.linspace(0, 1, self.num_thresholds).expand(scores.shape[0], -1)
+        else:
+            threshs = F.pad(sorted_scores, (1, 0))
+
+        # confusion matrix at each threshold
+        num_below = torch.searchsorted(sorted_scores, threshs.contiguous(), right=True)
+        fn = pos_below.gather(-1, num_below)
+        tn = num_below - fn
+        tp = pos_below[:, -1:] - fn
+        fp = (N - num_below) - tp
+
+        # macro accuracy (mean recall of both classes, ignoring classes that are neither in the
+        # gt nor predicted), as in torchmetrics
+        recalls = torch.stack([tn / (tn + fp).clamp(min=1), tp / (tp + fn).clamp(min=1)], -1)
+        weights = torch.stack([tn + fn + fp, tp + fp + fn], -1).gt(0).float()
+        bal_acc = (weights * recalls / weights.sum(-1, keepdim=True)).sum(-1)
+
+        # first best threshold
+        selected_threshs = threshs.gather(-1, bal_acc.argmax(-1, keepdim=True)).squeeze(-1)
+
+        return selected_threshs.numpy()
+
+def segment_confusion_matrices(preds: Tensor, gt: Tensor, segment_ids: Tensor, num_segments: int,
+        num_classes: int) -> Tensor:
+    """Confusion matrix (gt x pred) of each segment (e.g. video) of a set of multiclass
+    predictions, computed in one pass.
+
+    Returns:
+        Tensor: num_segments x num_classes x num_classes
+    """
+    inds = (segment_ids * num_classes + gt) * num_classes + preds
+    conf = torch.bincount(inds, minlength=num_segments * num_classes * num_classes)
+
+    return conf.view(num_segments, num_classes, num_classes)
+
+def multiclass_scores(conf: Tensor) -> Tuple[Tensor]:
+    """Per-class precision, recall, f1 (... x num_classes) from confusion matrices, with the
+    torchmetrics convention (0 when the denominator is 0)."""
+    tp = conf.diagonal(dim1=-2, dim2=-1).float()
+    fp = conf.sum(-2) - tp
+    fn = conf.sum(-1) - tp
+
+    precision = tp / (tp + fp).clamp(min=1)
+    recall = tp / (tp + fn).clamp(min=1)
+    f1 = 2 * tp / (2 * tp + fp + fn).clamp(min=1)
+
+    return precision, recall, f1
+
+def macro_average(scores: Tensor, conf: Tensor) -> Tensor:
+    """Macro average of per-class scores, ignoring classes that are neither in the gt nor
+    predicted (as in torchmetrics)."""
+    tp = conf.diagonal(dim1=-2, dim2=-1)
+    weights = ((conf.sum(-2) + conf.sum(-1) - tp) > 0).float()
+
+    return (scores * weights).sum(-1) / weights.sum(-1).clamp(min=1)
+
+def segment_average_precision(preds: Tensor, gt: Tensor, segment_ids: Tensor,
+        num_segments: int) -> Tensor:
+    """Multilabel AP of each segment (e.g. video) and class, computed for all segments and
+    classes in one pass (same as torchmetrics AveragePrecision with thresholds=None applied to
+    each segment; nan for classes without positives).
+
+    Args:
+        preds (Tensor): N x C scores
+        gt (Tensor): N x C binary labels
+        segment_ids (Tensor): N segment id of each sample
+
+    Returns:
+        Tensor: num_segments x C
+    """
+    N = preds.shape[0]
+
+    # sort scores of each class (descending) within each segment
+    order = preds.argsort(0, descending=True)
+    order = order.gather(0, segment_ids[order].sort(dim=0, stable=True).indices)
+    scores = preds.gather(0, order)
+    targets = gt.gather(0, order).double()
+    sorted_segment_ids = segment_ids.sort().values
+
+    # number of preds and tps above each threshold (within segment)
+    seg_counts = torch.bincount(segment_ids, minlength=num_segments)
+    seg_starts = seg_counts.cumsum(0) - seg_counts
+    rank = torch.arange(N) - seg_starts[sorted_segment_ids] + 1
+    tps = targets.cumsum(0)
+    tps = tps - F.pad(tps, (0, 0, 1, 0))[seg_starts][sorted_segment_ids]
+    precision = tps / rank.unsqueeze(-1)
+
+    # precision of each sample is that of the last sample with the same score (ties share a
+    # threshold)
+    is_last = torch.ones_like(scores, dtype=torch.bool)
+    is_last[:-1] = (scores[1:] != scores[:-1]) | \
+            (sorted_segment_ids[1:] != sorted_segment_ids[:-1]).unsqueeze(-1)
+    last_inds = torch.where(is_last, torch.arange(N).unsqueeze(-1), N)
+    last_inds = last_inds.flip(0).cummin(0).values.flip(0)
+    precision = precision.gather(0, last_inds)
+
+    # AP = sum_n (R_n - R_{n-1}) P_n
+    num_pos = torch.zeros(num_segments, preds.shape[1], dtype=torch.double).index_add_(0,
+            sorted_segment_ids, targets)
+    ap = torch.zeros_like(num_pos).index_add_(0, sorted_segment_ids, targets * precision) / num_pos
+
+    return ap.float()
+
+def score_histograms(preds: Tensor, gt: Tensor, num_bins: int) -> Tensor:
+    """Histograms of the scores (in [0, 1]) of negatives and positives of each class.
+
+    Returns:
+        Tensor: C x num_bins x 2 (negative, positive counts)
+    """
+    C = preds.shape[1]
+    bins = (preds * num_bins).long().clamp(0, num_bins - 1)
+    inds = (torch.arange(C).unsqueeze(0) * num_bins + bins) * 2 + gt
+    hist = torch.bincount(inds.flatten(), minlength=C * num_bins * 2)
+
+    return hist.view(C, num_bins, 2)
+
+def histogram_average_precision(hists: Tensor) -> Tensor:
+    """AP from score histograms (... x num_bins x 2), i.e. AP with scores quantized to
+    num_bins thresholds (nan for classes without positives)."""
+    # count preds and tps above each threshold (descending)
+    hists = hists.flip(-2).double()
+    pos = hists[..., 1]
+    tps = pos.cumsum(-1)
+    precision = tps / hists.sum(-1).cumsum(-1).clamp(min=1)
+
+    # AP = sum_n (R_n - R_{n-1}) P_n
+    ap = (pos * precision).sum(-1) / pos.sum(-1)
+
+    return ap.float()
 
 class SSIM_RoI:
-    def __init__(self, data_range, size_average, channel):
+    def __init__(self, data_range, size_average, channel, output_size: Optional[int] = None,
+            min_size: int = 12):
         self.running_vals = []
+        # native crops by default; with output_size, patches are resampled to that size,
+        # which is faster but not comparable with ssim_roi values of native crops
+        self.output_size = output_size
+        self.min_size = min_size
 
     def __call__(self, pred_imgs, gt_imgs, gt_boxes):
-        all_pred_patches, all_gt_patches, fixed_boxes = self.crop_boxes(pred_imgs,
-                gt_imgs, gt_boxes)
+        # boxes are xywh, compute ssim b/w all pred and gt patches in one batched call
+        xyxy_boxes = []
+        for b in gt_boxes:
+            b = b.view(-1, 4).clone()
+            b[:, 2:] += b[:, :2]
+            xyxy_boxes.append(b)
 
-        # compute ssim b/w each pred patch and gt patch
-        ssim_vals = []
-        for pred_patches, gt_patches in zip(all_pred_patches, all_gt_patches):
-            for p, g in zip(pred_patches, gt_patches):
-                p_mod = p.unsqueeze(0)
-                g_mod = g.unsqueeze(0)
-                ssim_val = ssim(p_mod, g_mod)
-                ssim_vals.append(ssim_val)
+        ssim_vals, valid = roi_ssim(pred_imgs, gt_imgs, xyxy_boxes, output_size=self.output_size,
+                min_size=self.min_size)
 
-        return torch.mean(Tensor(ssim_vals))
+        return torch.mean(ssim_vals[valid])
 
     def update(self, pred_imgs, gt_imgs, gt_boxes):
         v = self.__call__(pred_imgs, gt_imgs, gt_boxes)
@@ -468,50 +871,3 @@ class SSIM_RoI:
 
     def reset(self):
         self.running_vals = []
-
-    def crop_boxes(self, pred_imgs, gt_imgs, boxes, min_size=12):
-        boxes_per_img = [len(b) for b in boxes]
-        new_image_shape = pred_imgs.shape[-2:]
-
-        # resize boxes based on reconstructed img size
-        boxes = torch.cat(boxes).round()
-        if boxes.shape[0] == 0:
-            return [[]], [[]], boxes
-
-        # pad small boxes
-        small_box_inds_x = torch.nonzero(boxes[:, 2] < min_size).flatten()
-        small_box_inds_y = torch.nonzero(boxes[:, 3] < min_size).flatten()
-        if small_box_inds_x.shape[0] > 0:
-            # pad to at least min_size x min_size box
-            x1 = boxes[small_box_inds_x, 0]
-            x2 = x1 + boxes[small_box_inds_x, 2]
-            h_pad = min_size - (x2 - x1)
-            new_x2 = torch.minimum(x2 + h_pad, torch.ones(1).to(boxes) * new_image_shape[1])
-            extra_h_pad = min_size - (new_x2 - x1)
-            new_x1 = torch.maximum(x1 - extra_h_pad, torch.zeros_like(x1))
-
-            boxes[small_box_inds_x, 0] = new_x1
-            boxes[small_box_inds_x, 2] = new_x2 - new_x1
-
-        if small_box_inds_y.shape[0] > 0:
-            # pad to at least min_sizexmin_size box
-            y1 = boxes[small_box_inds_y, 1]
-            y2 = y1 + boxes[small_box_inds_y, 3]
-            v_pad = min_size - (y2 - y1)
-            new_y2 = torch.minimum(y2 + v_pad, torch.ones(1).to(boxes) * new_image_shape[0])
-            extra_v_pad = min_size - (new_y2 - y1)
-            new_y1 = torch.maximum(y1 - extra_v_pad, torch.zeros_like(y1))
-
-            boxes[small_box_inds_y, 1] = new_y1
-            boxes[small_box_inds_y, 3] = new_y2 - new_y1
-
-        # cast and split
-        boxes = boxes.int().split(boxes_per_img)
-
-        # get all gt and pred patches (List[List[Tensor]])
-        all_pred_patches = [[img[:, b[1]:b[1] + b[3], b[0]:b[0] + b[2]] for b in boxes[ind]] \
-                for ind, img in enumerate(pred_imgs)]
-        all_gt_patches = [[img[:, b[1]:b[1] + b[3], b[0]:b[0] + b[2]] for b in boxes[ind]] \
-                for ind, img in enumerate(gt_imgs)]
-
-        return all_pred_patches, all_gt_patches, boxes
@@ -141,3 +141,11 @@ class ClearGPUMem(Hook):
 
     def after_test_iter(self, runner, **kwargs) -> None:
         torch.cuda.empty_cache()
+
+@HOOKS.register_module()
+class FlushLGWriter(Hook):
+    """Wait for the outputs written in the background by the visualizer (latent graphs of
+    LatentGraphVisualizer, queries of SAMQueryVisualizer) to be written at the end of test."""
+    def after_test(self, runner) -> None:
+        if hasattr(runner.visualizer, 'flush'):
+            runner.visualizer.flush()
@@ -11,6 +11,7 @@ from mmdet.structures import SampleList, OptSampleList
 from mmdet.structures.bbox import scale_boxes
 from mmdet.utils import ConfigType
 from mmdet.models.detectors.base import BaseDetector
+from .predictor_heads.modules.utils import construct_layout
 
 @MODELS.register_module()
 class DeepCVS(BaseDetector):
@@ -78,38 +79,9 @@ class DeepCVS(BaseDetector):
         self.use_gt_dets = use_gt_dets
 
     def _construct_layout(self, layout_size, classes, boxes, masks=None):
-        box_layout = torch.zeros(len(boxes), self.num_nodes, *layout_size).to(boxes[0].device)
-        mask_layout = None
-
-        # build box layout from boxes, classes (used with backgroundized img as input to reconstructor)
-        for img_id, (label, box) in enumerate(zip(classes, boxes)):
-            for instance_id, (l, b) in enumerate(zip(label, box.round().int())):
-                box_layout[img_id][instance_id, b[1]:b[3], b[0]:b[2]] = l + 1 # labels are 0-indexed
-
-        if masks is not None:
-            mask_layouts = []
-            for ind, (label, mask) in enumerate(zip(classes, masks)):
-                mask_layouts.append(mask.int() * (label + 1).unsqueeze(-1).unsqueeze(-1))
-
-            mask_layout = pad_sequence(mask_layouts, batch_first=True)
-
-            # to construct layout, one hot encode mask_layout, max across instance dim
-            mask_ohl = F.one_hot(mask_layout, self.detector_num_classes + 1)
-            if mask_ohl.shape[1] == 0:
-                layout = torch.zeros(*mask_ohl.transpose(1, -1).shape[:-1]).to(mask_ohl.device).float()
-            else:
-                layout = mask_ohl.transpose(1, -1).max(-1).values.float()
-
-        else:
-            box_ohl = F.one_hot(box_layout.long(), self.detector_num_classes + 1)
-            layout = box_ohl.transpose(1, -1).max(-1).values.float()
-
-        # one hot layout is based on box layout
-        one_hot_layout = (box_layout > 0).int() # stack of instance box masks
-        box_ohl = F.one_hot(box_layout.long(), self.detector_num_classes + 1)
-        box_layout = box_ohl.transpose(1, -1).max(-1).values.float()
-
-        return box_layout, layout, one_hot_layout
+        # box layout, layout (from masks if available), and stack of instance box masks
+        return construct_layout(classes, boxes, layout_size, self.num_nodes,
+                self.detector_num_classes, masks)
 
     def _forward(self, batch_inputs: Tensor, batch_data_samples: SampleList) -> Tensor:
         with torch.no_grad():
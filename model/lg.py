@@ -21,9 +21,10 @@ from mmengine.model.base_module import Sequential
 from .predictor_heads.reconstruction import ReconstructionHead
 from .predictor_heads.modules.loss import ReconstructionLoss
 from .predictor_heads.modules.layers import build_mlp
+from .predictor_heads.modules.semantic import SemanticFeatEncoder
 from .predictor_heads.graph import GraphHead
 from .predictor_heads.ds import DSHead
-from .predictor_heads.modules.utils import dense_mask_to_polygon_mask
+from .predictor_heads.modules.utils import batched_mask_to_polygon_mask, radial_mask_to_polygon_mask
 from .roi_extractors.sg_single_level_roi_extractor import SgSingleRoIExtractor
 from mmdet.models.layers.transformer.utils import coordinate_to_encoding
 
@@ -50,7 +51,8 @@ class LGDetector(BaseDetector):
             sem_feat_use_class_logits: bool = True, sem_feat_use_bboxes: bool = True,
             sem_feat_use_masks: bool = True, mask_polygon_num_points: int = 16,
             mask_augment: bool = True, force_encode_semantics: bool = False,
-            trainable_neck_cfg: OptConfigType = None, **kwargs):
+            trainable_neck_cfg: OptConfigType = None, mask_polygon_method: str = 'contour',
+            semantic_cache_size: int = 0, **kwargs):
         super().__init__(**kwargs)
 
         self.num_classes = num_classes
@@ -122,6 +124,11 @@ class LGDetector(BaseDetector):
             self.sem_feat_use_masks = sem_feat_use_masks
             self.mask_augment = mask_augment
             self.mask_polygon_num_points = mask_polygon_num_points
+            if mask_polygon_method not in ['radial', 'contour', 'contour_arc_length']:
+                raise ValueError("mask_polygon_method must be one of 'radial', 'contour' or "
+                        "'contour_arc_length', got '{}'".format(mask_polygon_method))
+
+            self.mask_polygon_method = mask_polygon_method
             self.semantic_feat_size = semantic_feat_size
 
             # compute sem_input_dim
@@ -146,6 +153,15 @@ class LGDetector(BaseDetector):
             edge_dim_list = [edge_sem_input_dim] + dim_list[1:]
             self.edge_semantic_feat_projector = build_mlp(edge_dim_list, batch_norm='batch')
 
+            # batched encoder of semantic feats, shared with SV2LSTG (not a submodule, so
+            # projector weights are saved as before)
+            self.semantic_encoder = SemanticFeatEncoder(self.semantic_feat_projector,
+                    self.edge_semantic_feat_projector, num_classes,
+                    use_bboxes=self.sem_feat_use_bboxes,
+                    use_class_logits=self.sem_feat_use_class_logits,
+                    use_masks=self.sem_feat_use_masks, masks_to_polygons=self.masks_to_polygons,
+                    cache_size=semantic_cache_size)
+
     def loss(self, batch_inputs: Tensor, batch_data_samples: SampleList):
         if self.detector.training:
             losses = self.detector.loss(batch_inputs, batch_data_samples)
@@ -476,72 +492,38 @@ class LGDetector(BaseDetector):
             if 'masks' in results[0].pred_instances:
                 masks = [r.pred_instances.masks for r in results]
 
-        # compute semantic feat
-        c = pad_sequence(classes, batch_first=True)
-        b = pad_sequence(boxes, batch_first=True)
-        s = pad_sequence(scores, batch_first=True)
-        b_norm = b / Tensor(results[0].ori_shape).flip(0).repeat(2).to(b.device)
-        c_one_hot = F.one_hot(c, num_classes=self.num_classes)
-
-        sem_feat_input = []
-        if self.sem_feat_use_bboxes:
-            sem_feat_input.append(b_norm)
-
-        if self.sem_feat_use_class_logits:
-            sem_feat_input.append(c_one_hot)
-
-        # process masks
-        if self.sem_feat_use_masks:
-            # iterate through masks and convert to polygon mask
-            polygon_masks = self.masks_to_polygons(masks)
-
-            # process masks
-            polygon_masks = pad_sequence(polygon_masks, batch_first=True) # B x N x P x 2
-            polygon_masks_norm = polygon_masks / Tensor(results[0].ori_shape).flip(0).to(polygon_masks.device)
-
-            sem_feat_input.append(polygon_masks_norm.flatten(start_dim=-2))
-
-        sem_feat_input.append(s.unsqueeze(-1))
-
-        sem_feat_input = torch.cat(sem_feat_input, -1).flatten(end_dim=1)
-        if sem_feat_input.shape[0] == 1:
-            s = self.semantic_feat_projector(torch.cat([sem_feat_input, sem_feat_input]))[0]
-        else:
-            s = self.semantic_feat_projector(sem_feat_input)
-
-        feats.semantic_feats = s.view(b_norm.shape[0], b_norm.shape[1], s.shape[-1])
+        # compute node semantic feats
+        feats.semantic_feats = self.semantic_encoder.encode_nodes(boxes, classes, scores, masks,
+                results[0].ori_shape)
 
         if graph is not None:
             # compute edge semantic feats
-            eb_norm = torch.cat(graph.edges.boxes) / Tensor(results[0].batch_input_shape).flip(0).repeat(2).to(graph.edges.boxes[0].device) # make 0-1
-            edge_sem_input = torch.cat([eb_norm, graph.edges.class_logits.detach()], -1) # detach class logits to prevent backprop
-            if edge_sem_input.shape[1] == 1:
-                edge_sem_feats = self.edge_semantic_feat_projector(edge_sem_input.repeat(2, 1))[0].unsqueeze(0)
-            else:
-                edge_sem_feats = self.edge_semantic_feat_projector(edge_sem_input)
-
-            graph.edges.semantic_feats = edge_sem_feats
+            graph.edges.semantic_feats = self.semantic_encoder.encode_edges(
+                    torch.cat(graph.edges.boxes), graph.edges.class_logits,
+                    results[0].batch_input_shape)
 
     def masks_to_polygons(self, masks: List[Tensor]) -> List[Tensor]:
-        polygon_masks = []
-        for m in masks:
-            p_m = []
-            if m.shape[0] > 0:
-                for i in m:
-                    p_m_i = dense_mask_to_polygon_mask(i, self.mask_polygon_num_points)
-                    if self.training and self.mask_augment: # only augment mask at train time
-                        p_m_i = torch.roll(p_m_i, torch.randint(p_m_i.shape[0], (1,)).item(), 0)
-
-                    p_m.append(p_m_i)
-
-                p_m = torch.stack(p_m) # N x P x 2
-
-            else:
-                p_m = torch.zeros(0, self.mask_polygon_num_points, 2).to(m.device)
+        # convert masks of all imgs at once (per img if mask sizes differ)
+        if len(set(m.shape[1:] for m in masks)) > 1:
+            return [p for m in masks for p in self.masks_to_polygons([m])]
+
+        all_masks = torch.cat(masks)
+        if self.mask_polygon_method == 'radial':
+            polygon_masks = radial_mask_to_polygon_mask(all_masks, self.mask_polygon_num_points)
+        elif self.mask_polygon_method in ['contour', 'contour_arc_length']:
+            polygon_masks = batched_mask_to_polygon_mask(all_masks, self.mask_polygon_num_points,
+                    arc_length=self.mask_polygon_method == 'contour_arc_length')
+        else:
+            raise NotImplementedError
 
-            polygon_masks.append(p_m)
+        if self.training and self.mask_augment: # only augment mask at train time
+            # roll points of each polygon by a random offset
+            P = polygon_masks.shape[1]
+            shifts = torch.randint(P, (polygon_masks.shape[0], 1)).to(polygon_masks.device)
+            inds = (torch.arange(P, device=polygon_masks.device) - shifts) % P
+            polygon_masks = polygon_masks.gather(1, inds.unsqueeze(-1).expand(-1, -1, 2))
 
-        return polygon_masks
+        return list(polygon_masks.split([m.shape[0] for m in masks]))
 
     def box_perturbation(self, boxes: List[Tensor], image_shape: Tuple):
         boxes_per_img = [len(b) for b in boxes]
@@ -5,11 +5,12 @@ from mmdet.utils import ConfigType, OptConfigType, InstanceList, OptMultiConfig
 from mmengine.structures import BaseDataElement
 from mmdet.structures import SampleList
 from .modules.gnn import GNNHead
-from .modules.layers import build_mlp, PositionalEncoding
+from .modules.layers import build_mlp, apply_mlp, PositionalEncoding
 from .modules.utils import *
 from .modules.mstcn import MultiStageModel as MSTCN
 import torch
 from torch import Tensor
+from torch.nn.utils.rnn import pad_sequence
 from torch_scatter import scatter_mean, scatter_max
 import torch.nn.functional as F
 from typing import List, Union, Tuple
@@ -124,18 +125,11 @@ class DSHead(BaseModule, metaclass=ABCMeta):
                 input_edge_viz_feats = torch.cat([input_edge_viz_feats, graph.edges.gnn_viz_feats], -1)
 
             # project node feats
-            if input_node_viz_feats.flatten(end_dim=1).shape[0] == 1:
-                node_viz_feats = self.node_viz_feat_projector(input_node_viz_feats.flatten(end_dim=1).repeat(2, 1))[0].view(
-                        input_node_viz_feats.shape[0], input_node_viz_feats.shape[1], self.final_viz_feat_size)
-            else:
-                node_viz_feats = self.node_viz_feat_projector(input_node_viz_feats.flatten(end_dim=1)).view(
-                        input_node_viz_feats.shape[0], input_node_viz_feats.shape[1], self.final_viz_feat_size)
+            node_viz_feats = apply_mlp(self.node_viz_feat_projector, input_node_viz_feats.flatten(end_dim=1)).view(
+                    input_node_viz_feats.shape[0], input_node_viz_feats.shape[1], self.final_viz_feat_size)
 
             # project edge feats
-            if input_edge_viz_feats.shape[0] == 1:
-                edge_viz_feats = self.edge_viz_feat_projector(input_edge_viz_feats.repeat(2, 1))[0].unsqueeze(0)
-            else:
-                edge_viz_feats = self.edge_viz_feat_projector(input_edge_viz_feats)
+            edge_viz_feats = apply_mlp(self.edge_viz_feat_projector, input_edge_viz_feats)
 
             node_feats.append(node_viz_feats)
             edge_feats.append(edge_viz_feats)
@@ -146,18 +140,11 @@ class DSHead(BaseModule, metaclass=ABCMeta):
 
         if self.final_sem_feat_size > 0:
             input_node_sem_feats = feats.semantic_feats
-            if input_node_sem_feats.flatten(end_dim=1).shape[0] == 1:
-                node_sem_feats = self.node_sem_feat_projector(input_node_sem_feats.flatten(end_dim=1).repeat(2, 1))[0].view(
-                        input_node_sem_feats.shape[0], input_node_sem_feats.shape[1], self.final_sem_feat_size)
-            else:
-                node_sem_feats = self.node_sem_feat_projector(input_node_sem_feats.flatten(end_dim=1)).view(
-                        input_node_sem_feats.shape[0], input_node_sem_feats.shape[1], self.final_sem_feat_size)
+            node_sem_feats = apply_mlp(self.node_sem_feat_projector, input_node_sem_feats.flatten(end_dim=1)).view(
+                    input_node_sem_feats.shape[0], input_node_sem_feats.shape[1], self.final_sem_feat_size)
 
             input_edge_sem_feats = graph.edges.semantic_feats
-            if input_edge_sem_feats.shape[0] == 1:
-                edge_sem_feats = self.edge_sem_feat_projector(input_edge_sem_feats.repeat(2, 1))[0].unsqueeze(0)
-            else:
-                edge_sem_feats = self.edge_sem_feat_projector(input_edge_sem_feats)
+            edge_sem_feats = apply_mlp(self.edge_sem_feat_projector, input_edge_sem_feats)
 
             node_feats.append(node_sem_feats)
             edge_feats.append(edge_sem_feats)
@@ -168,12 +155,8 @@ class DSHead(BaseModule, metaclass=ABCMeta):
 
         # get img feats
         img_feats = feats.bb_feats[-1] if self.img_feat_key == 'bb' else feats.fpn_feats[-1]
-        if img_feats.shape[0] == 1:
-            img_feats = self.img_feat_projector(F.adaptive_avg_pool2d(img_feats,
-                1).squeeze(-1).squeeze(-1).repeat(2, 1))[0].unsqueeze(0)
-        else:
-            img_feats = self.img_feat_projector(F.adaptive_avg_pool2d(img_feats,
-                1).squeeze(-1).squeeze(-1))
+        img_feats = apply_mlp(self.img_feat_projector, F.adaptive_avg_pool2d(img_feats,
+            1).squeeze(-1).squeeze(-1))
 
         perturbed_ds_preds = {}
         if self.semantic_loss_weight > 0 and self.final_sem_feat_size > 0:
@@ -215,10 +198,7 @@ class DSHead(BaseModule, metaclass=ABCMeta):
         # combine two types of feats
         if self.use_img_feats:
             pre_fusion_feat = torch.cat([img_feats, graph_feats], -1)
-            if pre_fusion_feat.shape[0] == 1:
-                final_feats = self.img_graph_feat_fusion(pre_fusion_feat.repeat(2, 1))[0].unsqueeze(0)
-            else:
-                final_feats = self.img_graph_feat_fusion(pre_fusion_feat)
+            final_feats = apply_mlp(self.img_graph_feat_fusion, pre_fusion_feat)
 
         else:
             final_feats = graph_feats
@@ -227,10 +207,7 @@ class DSHead(BaseModule, metaclass=ABCMeta):
             ds_feats = self.ds_predictor_head(final_feats)
             ds_preds = torch.stack([p(ds_feats) for p in self.ds_predictor], 1)
         else:
-            if final_feats.shape[0] == 1:
-                ds_preds = self.ds_predictor(final_feats.repeat(2, 1))[0].unsqueeze(0)
-            else:
-                ds_preds = self.ds_predictor(final_feats)
+            ds_preds = apply_mlp(self.ds_predictor, final_feats)
 
         return ds_preds
 
@@ -388,6 +365,9 @@ class STDSHead(DSHead):
             self.pe = PositionalEncoding(self.img_feat_size, batch_first=True,
                     return_enc_only=True, dropout=0)
 
+        # positional encoding tables, keyed by (T, dim, device)
+        self._pos_embed_cache = {}
+
         # construct temporal model
         self.temporal_arch = temporal_arch
         if self.use_temporal_model:
@@ -420,35 +400,53 @@ class STDSHead(DSHead):
         node_feats = [f for f in node_feats if f is not None]
         edge_feats = [f for f in edge_feats if f is not None]
 
+        # pooled img feats of frames preceding the input (chunked per-video processing)
+        img_context = feats.get('temporal_context', None)
+
+        # number of (unpadded) frames of each video, if videos in batch were padded
+        frames_per_video = feats.get('frames_per_video', None)
+
+        # compute node indices once for all forward passes on this batch
+        node_inds = self._compute_node_inds(graph.nodes.nodes_per_img, N, img_feats.device)
+
         # run forward pass with all the components to get ds preds
-        ds_preds = self.forward(graph, node_feats, edge_feats, img_feats)
+        ds_preds = self.forward(graph, node_feats, edge_feats, img_feats, node_inds=node_inds,
+                img_context=img_context, frames_per_video=frames_per_video)
 
         # perturb features and get auxiliary preds
         perturbed_ds_preds = {}
         if self.training:
             if self.semantic_loss_weight > 0 and self.final_sem_feat_size > 0:
                 graph_sem_feats_only = self.feature_perturbation(node_feats, edge_feats, img_feats, 'sem')
-                perturbed_ds_preds['graph_sem'] = self.forward(graph, *graph_sem_feats_only)
+                perturbed_ds_preds['graph_sem'] = self.forward(graph, *graph_sem_feats_only,
+                        node_inds=node_inds, frames_per_video=frames_per_video)
             if self.viz_loss_weight > 0 and self.final_viz_feat_size > 0:
                 graph_viz_feats_only = self.feature_perturbation(node_feats, edge_feats, img_feats, 'viz')
-                perturbed_ds_preds['graph_viz'] = self.forward(graph, *graph_viz_feats_only)
+                perturbed_ds_preds['graph_viz'] = self.forward(graph, *graph_viz_feats_only,
+                        node_inds=node_inds, frames_per_video=frames_per_video)
             if self.img_loss_weight > 0 and self.use_img_feats:
                 img_feats_only = self.feature_perturbation(node_feats, edge_feats, img_feats, 'img')
-                perturbed_ds_preds['img'] = self.forward(graph, *img_feats_only)
+                perturbed_ds_preds['img'] = self.forward(graph, *img_feats_only,
+                        node_inds=node_inds, img_context=img_context,
+                        frames_per_video=frames_per_video)
             if self.edited_graph_loss_weight > 0:
                 perturbed_ds_preds['edited_graph'] = self.forward(graph, node_feats,
-                        edge_feats, img_feats, True)
+                        edge_feats, img_feats, True, img_context=img_context,
+                        frames_per_video=frames_per_video)
 
         return ds_preds, perturbed_ds_preds
 
-    def forward(self, graph, node_feats, edge_feats, img_feats, edit_graph: bool = False):
+    def forward(self, graph, node_feats, edge_feats, img_feats, edit_graph: bool = False,
+            node_inds: Tuple[Tensor] = None, img_context: Tensor = None,
+            frames_per_video: List[int] = None):
         # get dims
         B, T, N, _ = graph.nodes.feats.shape
 
         # add positional embedding to node feats
         node_feats = torch.cat(node_feats, -1)
         if self.use_node_positional_embedding:
-            pos_embed = self.node_pe(torch.zeros(1, T, node_feats.shape[-1]).to(node_feats.device))
+            pos_embed = self._get_pos_embed(self.node_pe, T, node_feats.shape[-1],
+                    node_feats.device)
 
             # add to node_feats
             node_feats = node_feats + pos_embed.unsqueeze(2)
@@ -457,34 +455,47 @@ class STDSHead(DSHead):
         graph.edges.feats = torch.cat(edge_feats, -1)
         dgl_g = self.gnn(graph)
 
-        # edit graph
+        # edit graph, node indices change so recompute them for the edited graph
         if edit_graph:
             dgl_g, nodes_per_img = self._edit_graph(dgl_g, graph.nodes.nodes_per_img)
-        else:
-            nodes_per_img = graph.nodes.nodes_per_img
+            node_inds = self._compute_node_inds(nodes_per_img, N, node_feats.device,
+                    num_nodes=dgl_g.num_nodes())
+        elif node_inds is None:
+            node_inds = self._compute_node_inds(graph.nodes.nodes_per_img, N,
+                    node_feats.device, num_nodes=dgl_g.num_nodes())
+
+        node_to_img, padded_node_inds = node_inds
 
         # get node features and pool to get graph feats
-        orig_node_feats = torch.cat([f[:npi.int().item()] for clip_node_feats, clip_nodes_per_img in zip(
-            graph.nodes.feats, nodes_per_img) for f, npi in zip(clip_node_feats, clip_nodes_per_img)])
+        orig_node_feats = graph.nodes.feats.flatten(end_dim=2)[padded_node_inds]
         node_feats = dgl_g.ndata['feats'] + orig_node_feats # skip connection
 
         # pool node feats by img
-        node_to_img = torch.cat([ind * T + torch.arange(T).repeat_interleave(n.int()).long().to(
-            node_feats.device) for ind, n in enumerate(nodes_per_img)])
-        graph_feats = torch.zeros(B * T, node_feats.shape[-1]).to(node_feats.device)
+        graph_feats = torch.zeros(B * T, node_feats.shape[-1], device=node_feats.device)
         scatter_mean(node_feats, node_to_img, dim=0, out=graph_feats)
 
         # combine two types of feats
         if self.use_img_feats:
             if self.use_temporal_model:
-                if self.temporal_arch == 'tcn':
-                    tcn_output = self.img_feat_temporal_model(img_feats.permute(0, 2, 1))
-                    img_feats = tcn_output.sum(0).permute(0, 2, 1) # sum across stages
+                # run temporal model over preceding frames too, only keep output for input frames
+                if img_context is not None:
+                    img_feats = torch.cat([img_context, img_feats], 1)
+
+                if frames_per_video is None or (self.temporal_arch == 'tcn' and self.causal):
+                    img_feats = self._temporal_predict(img_feats)
                 else:
-                    img_feats = img_feats + self.img_feat_temporal_model(img_feats) # temporal model and skip connection
+                    # padded frames (at the end of each video) would affect the output on valid
+                    # frames of non-causal/recurrent models, so run each video separately
+                    num_context = img_context.shape[1] if img_context is not None else 0
+                    img_feats = torch.cat([F.pad(self._temporal_predict(
+                        x[:num_context + t].unsqueeze(0)), (0, 0, 0, x.shape[0] - num_context - t)) \
+                                for x, t in zip(img_feats, frames_per_video)])
+
+                if img_context is not None:
+                    img_feats = img_feats[:, -T:]
 
             elif self.use_positional_embedding:
-                pos_embed = self.pe(torch.zeros(1, T, img_feats.shape[-1]).to(img_feats.device))
+                pos_embed = self._get_pos_embed(self.pe, T, img_feats.shape[-1], img_feats.device)
                 img_feats = img_feats + pos_embed
 
             # project img feats and fuse with graph feats
@@ -520,11 +531,23 @@ class STDSHead(DSHead):
 
         return ds_preds
 
+    def _temporal_predict(self, img_feats: Tensor) -> Tensor:
+        if self.temporal_arch == 'tcn':
+            tcn_output = self.img_feat_temporal_model(img_feats.permute(0, 2, 1))
+            return tcn_output.sum(0).permute(0, 2, 1) # sum across stages
+
+        return img_feats + self.img_feat_temporal_model(img_feats) # temporal model and skip connection
+
     def loss(self, graph: BaseDataElement, feats: BaseDataElement,
             batch_data_samples: SampleList) -> Tensor:
         ds_preds, perturbed_ds_preds = self.predict(graph, feats)
-        ds_gt = torch.stack([torch.stack([torch.from_numpy(b.ds) for b in vds]) \
-                for vds in batch_data_samples]).to(ds_preds.device)
+        # videos in batch may differ in length, so pad gt to the (padded) length of the preds
+        ds_gt = pad_sequence([torch.stack([torch.from_numpy(b.ds) for b in vds]) \
+                for vds in batch_data_samples], batch_first=True).to(ds_preds.device)
+        num_frames = torch.tensor([len(vds) for vds in batch_data_samples], device=ds_preds.device)
+
+        # leading history frames of each video (chunked per-video training) are not scored
+        num_history = feats.get('num_history_frames', 0)
 
         if self.loss_consensus == 'mode':
             ds_gt = ds_gt.float().round().long()
@@ -538,16 +561,20 @@ class STDSHead(DSHead):
         # reshape preds and gt according to prediction settings
         if not self.pred_per_frame:
             # keep only last gt per clip
-            ds_gt = ds_gt[:, -1]
+            ds_gt = ds_gt[torch.arange(ds_gt.shape[0], device=ds_gt.device), num_frames - 1]
             is_ds_keyframe = None
         else:
-            ds_gt = ds_gt.flatten(end_dim=1)
-            ds_preds = ds_preds.flatten(end_dim=1)
+            # drop padded and history frames
+            frame_inds = torch.arange(ds_gt.shape[1], device=ds_gt.device)
+            valid = (frame_inds < num_frames.unsqueeze(-1)) & (frame_inds >= num_history)
+            ds_gt = ds_gt[valid]
+            ds_preds = ds_preds[valid]
             for k, v in perturbed_ds_preds.items():
-                perturbed_ds_preds[k] = v.flatten(end_dim=1)
+                perturbed_ds_preds[k] = v[valid]
 
             # use is_ds_keyframe to downweight contribution of pseudolabels
-            is_ds_keyframe = Tensor([b.is_ds_keyframe for vds in batch_data_samples for b in vds]).float().to(ds_gt.device)
+            is_ds_keyframe = Tensor([b.is_ds_keyframe for vds in batch_data_samples \
+                    for b in vds[num_history:]]).float().to(ds_gt.device)
             is_ds_keyframe[is_ds_keyframe == 0] = self.pseudolabel_loss_weight
             is_ds_keyframe = is_ds_keyframe / is_ds_keyframe.sum()
 
@@ -589,6 +616,40 @@ class STDSHead(DSHead):
 
         return loss
 
+    def _compute_node_inds(self, nodes_per_img: List[Tensor], N: int, device: torch.device,
+            num_nodes: int = None) -> Tuple[Tensor]:
+        """Compute the img id of each node and its index in the flattened B x T x N
+        padded node tensor, without any per-frame host syncs.
+
+        Args:
+            nodes_per_img (List[Tensor]): number of nodes in each frame, one tensor per clip
+            N (int): padded number of nodes per frame
+            device (torch.device): device to put the indices on
+            num_nodes (int): total number of nodes, computed from nodes_per_img if None
+        """
+        npi = torch.stack(nodes_per_img).flatten().long()
+        if num_nodes is None:
+            num_nodes = int(npi.sum()) # nodes_per_img is on cpu unless the graph was edited
+
+        npi = npi.to(device, non_blocking=True)
+        node_to_img = torch.arange(npi.shape[0], device=device).repeat_interleave(npi,
+                output_size=num_nodes)
+
+        # position of each node within its img
+        img_offsets = torch.cumsum(npi, 0) - npi
+        node_pos = torch.arange(num_nodes, device=device) - img_offsets[node_to_img]
+
+        return node_to_img, node_to_img * N + node_pos
+
+    def _get_pos_embed(self, pe: PositionalEncoding, T: int, dim: int,
+            device: torch.device) -> Tensor:
+        key = (T, dim, device)
+        if key not in self._pos_embed_cache:
+            with torch.no_grad():
+                self._pos_embed_cache[key] = pe(torch.zeros(1, T, dim, device=device))
+
+        return self._pos_embed_cache[key]
+
     def _create_temporal_model(self):
         if self.temporal_arch.lower() == 'transformer':
             pe = PositionalEncoding(d_model=2048, batch_first=True)
@@ -636,45 +697,37 @@ class STDSHead(DSHead):
         return ds_preds
 
     def _edit_graph(self, batched_graph, nodes_per_img):
-        # split graph into clip graphs
-        node_labels = batched_graph.ndata['labels']
+        device = batched_graph.device
+        num_nodes = batched_graph.num_nodes()
+        if num_nodes == 0:
+            return batched_graph, nodes_per_img
+
+        # flat frame id (clip id * T + frame id in clip) and clip id for each node
+        B, T = len(nodes_per_img), nodes_per_img[0].shape[0]
+        npi = torch.stack(nodes_per_img).flatten().long().to(device)
+        node_to_frame = torch.arange(B * T, device=device).repeat_interleave(npi,
+                output_size=num_nodes)
+        node_to_clip = node_to_frame // T
+
+        node_labels = batched_graph.ndata['labels'].long()
         node_features = batched_graph.ndata['feats']
-        nodes_per_clip = batched_graph.batch_num_nodes()
-        edges_per_clip = batched_graph.batch_num_edges()
         edge_flats = torch.stack(batched_graph.edges(), -1)
-        clip_graphs = dgl.unbatch(batched_graph)
 
-        # compute node degrees and split by frame
-        node_degrees_frame = [(g.in_degrees() + g.out_degrees()).split(npi.int().tolist()) for g, npi in zip(clip_graphs, nodes_per_img)]
+        # segment id for each (frame, class) pair in the batch
+        segment_keys = node_to_frame * (node_labels.max() + 1) + node_labels
+        _, segment_ids = torch.unique(segment_keys, return_inverse=True)
 
-        # split labels, node_degrees by frame
-        node_labels_frame = [g.split(npi.int().tolist()) for g, npi in zip(node_labels.long().split(nodes_per_clip.tolist()), nodes_per_img)]
-
-        # compute the instance of each class that has max degree in each frame
-        max_degree_inds = [[scatter_max(d, l)[1] for d, l in zip(ndf, nlf)] for ndf, nlf in zip(node_degrees_frame, node_labels_frame)]
+        # compute the instance of each class that has max degree in each frame (all segments at once)
+        node_degrees = batched_graph.in_degrees() + batched_graph.out_degrees()
+        _, max_degree_inds = scatter_max(node_degrees, segment_ids, dim=0)
 
         # compute the node that each node was reduced to (either the same node or maps to another node of the same class)
-        node_reassignment_map = [[m[c] for m, c in zip(mc, nc)] for mc, nc in zip(max_degree_inds, node_labels_frame)]
-
-        # if we want to keep all instances of an object class, set that
-        keep_instance_inds = (node_labels.unsqueeze(-1) == (torch.tensor(self.keep_all_instances).to(node_labels) - 1)).any(-1)
-        keep_instance_inds_frame = [x.split(npi.int().tolist()) for x, npi in zip(keep_instance_inds.split(
-            nodes_per_clip.tolist()), nodes_per_img)]
+        node_reassignment_map = max_degree_inds[segment_ids]
 
-        # get the indices where the actual degree matches the max degree
-        inds_to_keep_frame = [[torch.cat([m[m < len(l)], torch.where(k)[0]]).unique() for d, l, k, m in zip(
-            ndf, nlf, kiif, md)] for ndf, nlf, kiif, md in zip(node_degrees_frame,
-                    node_labels_frame, keep_instance_inds_frame, max_degree_inds)]
-
-        # inds_to_keep_frame -> inds_to_keep
-        frame_offsets = [torch.tensor([0] + npi.int()[:-1].tolist()).cumsum(0) for npi in nodes_per_img]
-        clip_offsets = torch.tensor([0] + [sum(npi.int()) for npi in nodes_per_img[:-1]]).cumsum(0)
-        inds_to_keep = [[i + o + co for i, o in zip(clip_inds, fo)] for clip_inds, fo, co in zip(
-            inds_to_keep_frame, frame_offsets, clip_offsets)]
-
-        # flatten node reassignment map and add offsets
-        node_reassignment_map = torch.cat([torch.cat([n + o + co for n, o in zip(nrm, fo)]) for nrm, fo, co in zip(
-            node_reassignment_map, frame_offsets, clip_offsets)])
+        # keep max degree instances, and all instances of classes in keep_all_instances
+        keep_mask = (node_labels.unsqueeze(-1) == (torch.tensor(self.keep_all_instances).to(node_labels) - 1)).any(-1)
+        keep_mask[max_degree_inds] = True
+        inds_to_keep = torch.where(keep_mask)[0]
 
         if self.combine_nodes:
             # use node reassignment map to combine node features, set in batched graph
@@ -684,21 +737,19 @@ class STDSHead(DSHead):
 
         if self.reassign_edges:
             # use node reassignment map to edit edge flats
-            updated_edge_flats = node_reassignment_map[edge_flats[edge_flats[:, 0].sort().indices]]
+            updated_edge_flats = node_reassignment_map[edge_flats]
 
             # get inds where edge was updated
-            updated_inds = torch.where((edge_flats[edge_flats[:, 0].sort().indices] != updated_edge_flats).any(-1))[0]
+            updated_inds = torch.where((edge_flats != updated_edge_flats).any(-1))[0]
 
             # of these inds, select unique inds, filter updated_edge_flats
             _, idx, counts = updated_edge_flats[updated_inds].unique(dim=0,
                     return_counts=True, return_inverse=True)
-            unique_inds = updated_inds[torch.where(counts[idx] <= 1)] # stores the id of the original edge from which we want to copy the edge data
+            unique_inds = updated_inds[counts[idx] <= 1] # stores the id of the original edge from which we want to copy the edge data
             updated_edge_flats = updated_edge_flats[unique_inds]
 
             # get remaining edge data, filter with unique_inds
-            updated_edge_data = {}
-            for k in batched_graph.edata.keys():
-                updated_edge_data.update({k: batched_graph.edata[k][unique_inds]})
+            updated_edge_data = {k: v[unique_inds] for k, v in batched_graph.edata.items()}
 
             # add edges to graph
             batched_graph = dgl.add_edges(batched_graph, updated_edge_flats[:, 0],
@@ -707,26 +758,20 @@ class STDSHead(DSHead):
             # remove self loops that may have been added
             batched_graph = batched_graph.remove_self_loop()
             if self.gnn_cfg.add_self_loops:
-                batched_graph = batched_graph.add_self_loops()
+                batched_graph = batched_graph.add_self_loop()
 
         # now only keep inds_to_keep in batched_graph, recompute nodes_per_img
-        edited_nodes_per_img = [Tensor([len(x) for x in i]) for i in inds_to_keep]
-        inds_to_keep_tensor = torch.cat([torch.cat(i) for i in inds_to_keep])
-        edited_batched_graph = batched_graph.subgraph(inds_to_keep_tensor)
-
-        # finally update batch nodes per img and batch edges per img
-        batch_num_nodes = torch.tensor([sum(x) for x in edited_nodes_per_img])
-        if not self.reassign_edges:
-            # compute batch num edges
-            edges_to_keep = (edge_flats.unsqueeze(-1) == inds_to_keep_tensor).any(-1).all(-1)
-            batch_num_edges = torch.tensor([x.sum() for x in edges_to_keep.split(edges_per_clip.tolist())])
-        else:
-            # compute batch_num_edges
-            all_edge_flats = torch.stack(batched_graph.edges(), -1)
-            edge_to_clip = (all_edge_flats.unsqueeze(-1) >= batch_num_nodes.to(all_edge_flats.device).cumsum(0)).sum(-1).max(-1).values
-            _, batch_num_edges = edge_to_clip.unique(sorted=True, return_counts=True)
+        edited_batched_graph = batched_graph.subgraph(inds_to_keep)
+        edited_nodes_per_img = torch.zeros(B * T, device=device).index_add_(0,
+                node_to_frame, keep_mask.float()).view(B, T)
+
+        # finally update batch nodes per clip and batch edges per clip
+        edited_node_to_clip = node_to_clip[inds_to_keep]
+        batch_num_nodes = torch.bincount(edited_node_to_clip, minlength=B)
+        batch_num_edges = torch.bincount(edited_node_to_clip[edited_batched_graph.edges()[0]],
+                minlength=B)
 
-        edited_batched_graph.set_batch_num_nodes(batch_num_nodes)
-        edited_batched_graph.set_batch_num_edges(batch_num_edges)
+        edited_batched_graph.set_batch_num_nodes(batch_num_nodes.to(edited_batched_graph.idtype))
+        edited_batched_graph.set_batch_num_edges(batch_num_edges.to(edited_batched_graph.idtype))
 
-        return edited_batched_graph, edited_nodes_per_img
+        return edited_batched_graph, list(edited_nodes_per_img)
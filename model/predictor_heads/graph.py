@@ -17,7 +17,7 @@ from torch import Tensor
 from torchvision.transforms import functional as TF, InterpolationMode
 import math
 import dgl
-from .modules.layers import build_mlp
+from .modules.layers import build_mlp, apply_mlp
 from .modules.gnn import GNNHead
 
 @MODELS.register_module()
@@ -82,14 +82,8 @@ class GraphHead(BaseModule, metaclass=ABCMeta):
     def _predict_edge_presence(self, node_features, nodes_per_img):
         # EDGE PREDICTION
         mlp_input = node_features.flatten(end_dim=1)
-        if mlp_input.shape[0] == 1:
-            sbj_feats = self.edge_mlp_sbj(torch.cat([mlp_input, mlp_input]))[0].unsqueeze(0)
-        else:
-            sbj_feats = self.edge_mlp_sbj(mlp_input)
-        if mlp_input.shape[0] == 1:
-            obj_feats = self.edge_mlp_obj(torch.cat([mlp_input, mlp_input]))[0].unsqueeze(0)
-        else:
-            obj_feats = self.edge_mlp_obj(mlp_input)
+        sbj_feats = apply_mlp(self.edge_mlp_sbj, mlp_input)
+        obj_feats = apply_mlp(self.edge_mlp_obj, mlp_input)
 
         sbj_feats = sbj_feats.view(len(node_features), -1,
                 sbj_feats.size(-1)) # B x N x F, where F is feature dimension
@@ -164,10 +158,7 @@ class GraphHead(BaseModule, metaclass=ABCMeta):
     def _predict_edge_classes(self, graph: BaseDataElement, batch_input_shape: tuple) -> BaseDataElement:
         # predict edge class
         edge_predictor_input = graph.edges.viz_feats + graph.edges.gnn_viz_feats
-        if edge_predictor_input.shape[0] == 1:
-            graph.edges.class_logits = self.edge_predictor(edge_predictor_input.repeat(2, 1))[0].unsqueeze(0)
-        else:
-            graph.edges.class_logits = self.edge_predictor(edge_predictor_input)
+        graph.edges.class_logits = apply_mlp(self.edge_predictor, edge_predictor_input)
 
         return graph
 
@@ -82,16 +82,15 @@ class GNNHead(BaseModule, metaclass=ABCMeta):
             g = dgl.graph(batch_edge_flats[:, -2:].unbind(1), num_nodes=sum(nodes_per_clip))
 
             # add attributes to graph
+            batch_npi = torch.stack(graph.nodes.nodes_per_img).to(device).unsqueeze(-1) # B x T x 1
             for k, v in graph.nodes.items():
                 skip_keys = ['nodes_per_img', 'viz_feats', 'gnn_viz_feats', 'instance_feats']
                 if k in skip_keys: continue
 
-                # for each img in each clip, remove padded nodes and concatenate all values for batch of clips
-                if torch.stack(graph.nodes.nodes_per_img).sum() > 0:
-                    g.ndata[k] = torch.cat([torch.cat([v_i[:n] for v_i, n in zip(cv,
-                        npi_i.int())]) for cv, npi_i in zip(v, graph.nodes.nodes_per_img)])
-                else:
-                    g.ndata[k] = torch.zeros(0, v.shape[-1]).to(v.device)
+                # remove padded nodes of each img in each clip, packing values for batch of clips
+                # (ordered by clip, then img, then node)
+                valid_nodes = torch.arange(v.shape[2], device=v.device) < batch_npi.to(v.device)
+                g.ndata[k] = v[valid_nodes]
 
             for k, v in graph.edges.items():
                 skip_keys = ['edges_per_img', 'edges_per_clip', 'batch_index', 'edge_flats',
@@ -234,6 +234,15 @@ def build_mlp(dim_list, activation='relu', batch_norm='none', dropout=0,
 
     return nn.Sequential(*layers)
 
+def apply_mlp(mlp: nn.Module, x: torch.Tensor) -> torch.Tensor:
+    """Apply an mlp to a batch of rows (N x D). Batch norm can't compute batch statistics
+    of a single row in train mode, so a single row is duplicated (in eval mode, batch norm
+    uses running statistics and rows are processed as is)."""
+    if mlp.training and x.shape[0] == 1:
+        return mlp(x.repeat(2, 1))[:1]
+
+    return mlp(x)
+
 def build_mask_net(dim, mask_size, scale_factor=2, output_dim=1, batch_norm=True):
     # mask prediction network
     layers, cur_size = [], 1
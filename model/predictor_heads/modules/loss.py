@@ -1,5 +1,6 @@
 from mmdet.registry import MODELS
-from typing import List, Tuple, Union
+from collections import defaultdict
+from typing import List, Optional, Tuple, Union
 import numpy as np
 import torch
 from torch import Tensor
@@ -7,14 +8,150 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torchvision.transforms import functional as TF, InterpolationMode
 from torchvision.models import resnet50, vgg16
+from torchvision.ops import roi_align
 from torchmetrics.functional import multiscale_structural_similarity_index_measure as ms_ssim, structural_similarity_index_measure as ssim
 
+def batched_ssim(preds: Tensor, target: Tensor, sigma: float = 1.5, k1: float = 0.01,
+        k2: float = 0.03) -> Tensor:
+    """SSIM of each img of a batch, same as torchmetrics ssim (gaussian kernel, data range
+    from the img) called on each img separately.
+
+    Returns:
+        Tensor: B
+    """
+    B, C = preds.shape[:2]
+    if B == 0:
+        return preds.new_zeros(0)
+
+    # data range of each img
+    data_range = torch.maximum(preds.flatten(1).amax(1) - preds.flatten(1).amin(1),
+            target.flatten(1).amax(1) - target.flatten(1).amin(1)).view(-1, 1, 1, 1)
+    c1 = (k1 * data_range).pow(2)
+    c2 = (k2 * data_range).pow(2)
+
+    # gaussian kernel
+    kernel_size = int(3.5 * sigma + 0.5) * 2 + 1
+    pad = (kernel_size - 1) // 2
+    dist = torch.arange((1 - kernel_size) / 2, (1 + kernel_size) / 2, dtype=preds.dtype,
+            device=preds.device)
+    gauss = torch.exp(-(dist / sigma).pow(2) / 2)
+    gauss = gauss / gauss.sum()
+    kernel = torch.outer(gauss, gauss).expand(C, 1, kernel_size, kernel_size)
+
+    preds = F.pad(preds, (pad, pad, pad, pad), mode='reflect')
+    target = F.pad(target, (pad, pad, pad, pad), mode='reflect')
+    outputs = F.conv2d(torch.cat([preds, target, preds * preds, target * target, preds * target]),
+            kernel, groups=C)
+    mu_pred, mu_target, pred_sq, target_sq, pred_target = outputs.split(B)
+
+    mu_pred_sq = mu_pred.pow(2)
+    mu_target_sq = mu_target.pow(2)
+    mu_pred_target = mu_pred * mu_target
+    upper = 2 * (pred_target - mu_pred_target) + c2
+    lower = (pred_sq - mu_pred_sq) + (target_sq - mu_target_sq) + c2
+    ssim_map = ((2 * mu_pred_target + c1) * upper) / ((mu_pred_sq + mu_target_sq + c1) * lower)
+    ssim_map = ssim_map[..., pad:-pad, pad:-pad]
+
+    return ssim_map.flatten(1).mean(1)
+
+def fix_boxes(boxes: List[Tensor], img_shape: Tuple[int, int],
+        min_size: int = 12) -> Tuple[Tensor, Tensor]:
+    """Round and clip the boxes (xyxy, in pixels) of all imgs of a batch to the img, and pad
+    them to at least min_size x min_size.
+
+    Returns:
+        boxes (Tensor): K x 4 fixed boxes
+        valid (Tensor): K mask of boxes that overlap the img
+    """
+    H, W = img_shape
+    boxes = torch.cat([b.view(-1, 4) for b in boxes]).round()
+
+    # clip, boxes that do not overlap the img are invalid
+    boxes[:, 0::2] = boxes[:, 0::2].clamp(0, W)
+    boxes[:, 1::2] = boxes[:, 1::2].clamp(0, H)
+    valid = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+
+    # pad small boxes to at least min_size x min_size
+    for lo, hi, size in [(0, 2, W), (1, 3, H)]:
+        x1, x2 = boxes[:, lo], boxes[:, hi]
+        new_x2 = torch.minimum(x1 + min_size, torch.ones_like(x1) * size)
+        new_x1 = torch.maximum(x1 - (min_size - (new_x2 - x1)), torch.zeros_like(x1))
+        small = (x2 - x1) < min_size
+        boxes[:, lo] = torch.where(small, new_x1, x1)
+        boxes[:, hi] = torch.where(small, new_x2, x2)
+
+    return boxes, valid
+
+def roi_patches(pred_imgs: Tensor, gt_imgs: Tensor, boxes: List[Tensor], output_size: int = 32,
+        min_size: int = 12) -> Tuple[Tensor, Tensor, Tensor, Tuple[Tensor]]:
+    """Resample the box patches of all imgs of a batch to output_size x output_size with
+    roi_align. Boxes (xyxy, in pixels) are clipped to the img and padded to at least
+    min_size x min_size.
+
+    Returns:
+        pred_patches (Tensor): K x C x output_size x output_size
+        gt_patches (Tensor): K x C x output_size x output_size
+        valid (Tensor): K mask of boxes that overlap the img
+        fixed_boxes (Tuple[Tensor]): padded (int) boxes of each img
+    """
+    boxes_per_img = [b.view(-1, 4).shape[0] for b in boxes]
+    batch_inds = torch.arange(len(boxes)).repeat_interleave(Tensor(boxes_per_img).long())
+    boxes, valid = fix_boxes([b.to(pred_imgs) for b in boxes], pred_imgs.shape[-2:], min_size)
+
+    rois = torch.cat([batch_inds.to(boxes).unsqueeze(-1), boxes], dim=1)
+    pred_patches = roi_align(pred_imgs, rois, output_size, aligned=True)
+    gt_patches = roi_align(gt_imgs.to(pred_imgs), rois, output_size, aligned=True)
+
+    return pred_patches, gt_patches, valid, boxes.int().split(boxes_per_img)
+
+def roi_ssim(pred_imgs: Tensor, gt_imgs: Tensor, boxes: List[Tensor],
+        output_size: Optional[int] = 32, min_size: int = 12) -> Tuple[Tensor, Tensor]:
+    """SSIM of all box patches of a batch of imgs, computed in batched calls.
+
+    With output_size=None, patches are cropped at native resolution (as torchmetrics ssim
+    on each crop), and patches of the same size are batched together. Otherwise, all patches
+    are resampled to output_size x output_size (see roi_patches) and computed in one call,
+    which is faster but gives different values than native crops.
+
+    Returns:
+        ssim_vals (Tensor): K ssim of each box patch
+        valid (Tensor): K mask of boxes that overlap the img
+    """
+    if output_size is not None:
+        pred_patches, gt_patches, valid, _ = roi_patches(pred_imgs, gt_imgs, boxes,
+                output_size=output_size, min_size=min_size)
+
+        return batched_ssim(pred_patches, gt_patches), valid
+
+    boxes_per_img = [b.view(-1, 4).shape[0] for b in boxes]
+    batch_inds = torch.arange(len(boxes)).repeat_interleave(Tensor(boxes_per_img).long()).tolist()
+    fixed_boxes, valid = fix_boxes([b.to(pred_imgs) for b in boxes], pred_imgs.shape[-2:],
+            min_size)
+    fixed_boxes = fixed_boxes.long().tolist()
+    gt_imgs = gt_imgs.to(pred_imgs)
+
+    # group boxes by crop size
+    groups = defaultdict(list)
+    for k, (x1, y1, x2, y2) in enumerate(fixed_boxes):
+        if valid[k]:
+            groups[(y2 - y1, x2 - x1)].append(k)
+
+    ssim_vals = pred_imgs.new_zeros(len(fixed_boxes))
+    for inds in groups.values():
+        crops = [(batch_inds[k], fixed_boxes[k]) for k in inds]
+        pred_patches = torch.stack([pred_imgs[i, :, y1:y2, x1:x2] for i, (x1, y1, x2, y2) in crops])
+        gt_patches = torch.stack([gt_imgs[i, :, y1:y2, x1:x2] for i, (x1, y1, x2, y2) in crops])
+        ssim_vals[inds] = batched_ssim(pred_patches, gt_patches)
+
+    return ssim_vals, valid
+
 @MODELS.register_module()
 class ReconstructionLoss(nn.Module):
     def __init__(self, l1_weight: float, deep_loss_weight: float, ssim_weight: float,
             perceptual_weight: float, box_loss_weight: float, recon_loss_weight: float,
             use_content: bool, use_style: bool, use_ssim: bool, use_l1: bool,
-            deep_loss_backbone: str = 'vgg', load_backbone_weights: str = None):
+            deep_loss_backbone: str = 'vgg', load_backbone_weights: str = None,
+            use_box_ssim_l1: bool = False):
         super(ReconstructionLoss, self).__init__()
 
         # store imnet mean and std
@@ -28,6 +165,10 @@ class ReconstructionLoss(nn.Module):
         self.use_ssim = use_ssim
         self.use_l1 = use_l1
 
+        # box ssim/l1 terms were always 0 (inverted check), so they are off by default to
+        # keep the objective of existing configs
+        self.use_box_ssim_l1 = use_box_ssim_l1
+
         # overall weights in final loss
         self.l1_weight = np.clip(l1_weight, 0, 1)
         self.deep_loss_weight = np.clip(deep_loss_weight, 0, 1)
@@ -90,33 +231,28 @@ class ReconstructionLoss(nn.Module):
     def forward(self, reconstructed_imgs, orig_imgs, boxes=None):
         # if boxes is supplied, crop patches and evaluate additional loss
         # NOTE expects boxes in xyxy format
-        if boxes is not None:
-            box_ssim_loss = []
-            box_l1_loss = []
-            box_deep_loss = []
-            all_pred_patches, all_gt_patches, fixed_boxes = self.crop_boxes(reconstructed_imgs,
+        if boxes is not None and not self.use_box_ssim_l1:
+            # only fixed boxes for the box deep loss
+            fixed_boxes = fix_boxes([b.to(reconstructed_imgs) for b in boxes],
+                    reconstructed_imgs.shape[-2:], min_size=12)[0].int().split(
+                    [b.view(-1, 4).shape[0] for b in boxes])
+            box_ssim_loss = torch.zeros(1).to(orig_imgs.device)
+            box_l1_loss = torch.zeros(1).to(orig_imgs.device)
+            total_box_loss = torch.zeros(1).to(orig_imgs.device)
+
+        elif boxes is not None:
+            # resample all box patches to the same size, and compute box losses in one call
+            pred_patches, gt_patches, valid, fixed_boxes = roi_patches(reconstructed_imgs,
                     orig_imgs, boxes, min_size=12)
+            pred_patches, gt_patches = pred_patches[valid], gt_patches[valid]
 
-            pred_patch_batch, gt_patch_batch, mask_batch = [], [], []
-            for pred_img, gt_img in zip(all_pred_patches, all_gt_patches):
-                for p_patch, gt_patch in zip(pred_img, gt_img):
-                    if self.use_ssim:
-                        box_ssim_loss.append(1 - ssim(p_patch.unsqueeze(0), gt_patch.unsqueeze(0)))
-                    else:
-                        box_ssim_loss.append(torch.zeros(1).squeeze().to(orig_imgs.device))
-
-                    if self.use_l1:
-                        box_l1_loss.append(F.mse_loss(p_patch, gt_patch))
-                    else:
-                        box_l1_loss.append(torch.zeros(1).squeeze().to(orig_imgs.device))
-
-            if len(box_ssim_loss) == 0:
-                box_ssim_loss = sum(box_ssim_loss) / (len(box_ssim_loss) + 1e-5)
+            if self.use_ssim and pred_patches.shape[0] > 0:
+                box_ssim_loss = (1 - batched_ssim(pred_patches, gt_patches)).mean()
             else:
                 box_ssim_loss = torch.zeros(1).to(orig_imgs.device)
 
-            if len(box_l1_loss) == 0:
-                box_l1_loss = sum(box_l1_loss) / (len(box_l1_loss) + 1e-5)
+            if self.use_l1 and pred_patches.shape[0] > 0:
+                box_l1_loss = F.mse_loss(pred_patches, gt_patches)
             else:
                 box_l1_loss = torch.zeros(1).to(orig_imgs.device)
 
@@ -265,50 +401,3 @@ class ReconstructionLoss(nn.Module):
         for b in self.deep_loss_backbones:
             for m in b.modules():
                 m.eval()
-
-    def crop_boxes(self, pred_imgs, gt_imgs, boxes, min_size=12):
-        boxes_per_img = [len(b) for b in boxes]
-        new_image_shape = pred_imgs.shape[-2:]
-
-        # resize boxes based on reconstructed img size
-        boxes = torch.cat(boxes).round()
-        if boxes.shape[0] == 0:
-            return [[]], [[]], boxes
-
-        # pad small boxes
-        small_box_inds_x = torch.nonzero((boxes[:, 2] - boxes[:, 0]) < min_size).flatten()
-        small_box_inds_y = torch.nonzero((boxes[:, 3] - boxes[:, 1]) < min_size).flatten()
-        if small_box_inds_x.shape[0] > 0:
-            # pad to at least min_size x min_size box
-            x1 = boxes[small_box_inds_x, 0]
-            x2 = boxes[small_box_inds_x, 2]
-            h_pad = min_size - (x2 - x1)
-            new_x2 = torch.minimum(x2 + h_pad, torch.ones(1).to(boxes) * new_image_shape[1])
-            extra_h_pad = min_size - (new_x2 - x1)
-            new_x1 = torch.maximum(x1 - extra_h_pad, torch.zeros_like(x1))
-
-            boxes[small_box_inds_x, 0] = new_x1
-            boxes[small_box_inds_x, 2] = new_x2
-
-        if small_box_inds_y.shape[0] > 0:
-            # pad to at least min_sizexmin_size box
-            y1 = boxes[small_box_inds_y, 1]
-            y2 = boxes[small_box_inds_y, 3]
-            v_pad = min_size - (y2 - y1)
-            new_y2 = torch.minimum(y2 + v_pad, torch.ones(1).to(boxes) * new_image_shape[0])
-            extra_v_pad = min_size - (new_y2 - y1)
-            new_y1 = torch.maximum(y1 - extra_v_pad, torch.zeros_like(y1))
-
-            boxes[small_box_inds_y, 1] = new_y1
-            boxes[small_box_inds_y, 3] = new_y2
-
-        # cast and split
-        boxes = boxes.int().split(boxes_per_img)
-
-        # get all gt and pred patches (List[List[Tensor]])
-        all_pred_patches = [[img[:, b[1]:b[3], b[0]:b[2]] for b in boxes[ind]] \
-                for ind, img in enumerate(pred_imgs)]
-        all_gt_patches = [[img[:, b[1]:b[3], b[0]:b[2]] for b in boxes[ind]] \
-                for ind, img in enumerate(gt_imgs)]
-
-        return all_pred_patches, all_gt_patches, boxes
@@ -0,0 +1,150 @@
+from collections import OrderedDict
+from typing import Callable, List, Optional, Sequence, Tuple
+import torch
+from torch import Tensor
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+from .layers import apply_mlp
+
+class SemanticFeatEncoder:
+    """Batched encoder of node and edge semantic feats (normalized boxes, one-hot classes,
+    normalized mask polygons and scores of nodes, normalized boxes and class logits of edges),
+    shared by LGDetector and SV2LSTG.
+
+    The projectors are owned (and saved) by LGDetector, the encoder only holds references to
+    them. When the projectors are frozen (eval mode, and no grad), encoded feats of frames
+    with a frame id are cached, so that frames seen before (e.g. in overlapping clips) are not
+    re-encoded. Frame ids must be unique across datasets (e.g. img paths), and only be given
+    when the inputs are not augmented; the cache is cleared whenever it is not used (frozen
+    projectors and frame ids), e.g. at each training iteration.
+
+    Args:
+        node_projector (nn.Module): node semantic feat projector.
+        edge_projector (nn.Module): edge semantic feat projector.
+        num_classes (int): number of object classes.
+        use_bboxes (bool): encode boxes.
+        use_class_logits (bool): encode (one-hot) classes.
+        use_masks (bool): encode mask polygons.
+        masks_to_polygons (Callable): converts a list of masks to a list of polygons.
+        cache_size (int): max number of cached frames, 0 to disable the cache.
+    """
+    def __init__(self, node_projector: nn.Module, edge_projector: nn.Module, num_classes: int,
+            use_bboxes: bool = True, use_class_logits: bool = True, use_masks: bool = False,
+            masks_to_polygons: Callable = None, cache_size: int = 0):
+        self.node_projector = node_projector
+        self.edge_projector = edge_projector
+        self.num_classes = num_classes
+        self.use_bboxes = use_bboxes
+        self.use_class_logits = use_class_logits
+        self.use_masks = use_masks
+        self.masks_to_polygons = masks_to_polygons
+        self.cache_size = cache_size
+
+        # frame id -> (node feats, edge feats)
+        self.cache = OrderedDict()
+        self.padding_cache = {}
+
+    def is_frozen(self) -> bool:
+        projectors = [self.node_projector, self.edge_projector]
+        return not any(p.training for p in projectors) and (not torch.is_grad_enabled() or \
+                not any(x.requires_grad for p in projectors for x in p.parameters()))
+
+    def encode_nodes(self, boxes: List[Tensor], classes: List[Tensor], scores: List[Tensor],
+            masks: Optional[List[Tensor]], img_shape: Sequence) -> Tensor:
+        """Semantic feats (B x N x D) of the (padded) nodes of B frames."""
+        device = boxes[0].device
+        c = pad_sequence(classes, batch_first=True)
+        b = pad_sequence(boxes, batch_first=True)
+        s = pad_sequence(scores, batch_first=True)
+        b_norm = b / Tensor(img_shape).flip(0).repeat(2).to(device)
+        c_one_hot = F.one_hot(c.long(), num_classes=self.num_classes)
+
+        sem_feat_input = []
+        if self.use_bboxes:
+            sem_feat_input.append(b_norm)
+
+        if self.use_class_logits:
+            sem_feat_input.append(c_one_hot)
+
+        # process masks
+        if self.use_masks:
+            polygon_masks = pad_sequence(self.masks_to_polygons(masks), batch_first=True) # B x N x P x 2
+            polygon_masks_norm = polygon_masks / Tensor(img_shape).flip(0).to(device)
+            sem_feat_input.append(polygon_masks_norm.flatten(start_dim=-2))
+
+        sem_feat_input.append(s.unsqueeze(-1))
+
+        sem_feat_input = torch.cat(sem_feat_input, -1)
+        feats = apply_mlp(self.node_projector, sem_feat_input.flatten(end_dim=1))
+
+        return feats.view(*sem_feat_input.shape[:2], feats.shape[-1])
+
+    def encode_edges(self, boxes: Tensor, class_logits: Tensor, img_shape: Sequence) -> Tensor:
+        """Semantic feats (E x D) of E edges."""
+        eb_norm = boxes / Tensor(img_shape).flip(0).repeat(2).to(boxes.device) # make 0-1
+        edge_sem_input = torch.cat([eb_norm, class_logits.detach()], -1) # detach class logits to prevent backprop
+
+        return apply_mlp(self.edge_projector, edge_sem_input)
+
+    def __call__(self, boxes: List[Tensor], classes: List[Tensor], scores: List[Tensor],
+            masks: Optional[List[Tensor]], edge_boxes: List[Tensor],
+            edge_class_logits: List[Tensor], img_shape: Sequence, edge_img_shape: Sequence,
+            frame_ids: Optional[List] = None) -> Tuple[Tensor, Tensor]:
+        """Node (B x N x D, padded) and edge (sum of E_i x D) semantic feats of B frames,
+        with the nodes and edges of each frame given as lists. Frames are looked up in the
+        cache by frame id (if provided)."""
+        use_cache = self.cache_size > 0 and frame_ids is not None and self.is_frozen()
+        if not use_cache:
+            self.cache.clear()
+            self.padding_cache.clear()
+            node_feats = self.encode_nodes(boxes, classes, scores, masks, img_shape)
+            edge_feats = self.encode_edges(torch.cat(edge_boxes), torch.cat(edge_class_logits),
+                    edge_img_shape)
+
+            return node_feats, edge_feats
+
+        # encode frames that are not cached
+        frame_feats = {f: self.cache[f] for f in frame_ids if f in self.cache}
+        missing = [i for i, f in enumerate(frame_ids) if f not in frame_feats]
+        if len(missing) > 0:
+            select = lambda x: [x[i] for i in missing]
+            node_feats = self.encode_nodes(select(boxes), select(classes), select(scores),
+                    select(masks) if masks is not None else None, img_shape)
+            edge_feats = self.encode_edges(torch.cat(select(edge_boxes)),
+                    torch.cat(select(edge_class_logits)), edge_img_shape)
+
+            edges_per_frame = [len(edge_boxes[i]) for i in missing]
+            for i, n, e in zip(missing, node_feats, edge_feats.split(edges_per_frame)):
+                frame_feats[frame_ids[i]] = (n[:len(boxes[i])], e)
+
+        for f in frame_ids:
+            self.cache[f] = frame_feats[f]
+            self.cache.move_to_end(f)
+
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        # pad node feats with feats of padded nodes (as encoded by encode_nodes)
+        N = max(len(b) for b in boxes)
+        node_feats = []
+        for f in frame_ids:
+            n = frame_feats[f][0]
+            if n.shape[0] < N:
+                n = torch.cat([n, self.padding_feat(n.device).expand(N - n.shape[0], -1)])
+
+            node_feats.append(n)
+
+        return torch.stack(node_feats), torch.cat([frame_feats[f][1] for f in frame_ids])
+
+    def padding_feat(self, device: torch.device) -> Tensor:
+        # feat of a padded node (zero box, polygon and score, with class 0)
+        if 'padding' not in self.padding_cache:
+            first_layer = next(m for m in self.node_projector.modules() if isinstance(m, nn.Linear))
+            x = torch.zeros(1, first_layer.in_features, device=device)
+            if self.use_class_logits:
+                x[0, 4 if self.use_bboxes else 0] = 1
+
+            self.padding_cache['padding'] = apply_mlp(self.node_projector, x)[0]
+
+        return self.padding_cache['padding']
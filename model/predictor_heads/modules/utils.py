@@ -5,6 +5,24 @@ import cv2
 from pycocotools import mask
 import numpy as np
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import math
+import os
+
+_contour_pool = None
+_contour_pool_pid = None
+
+def get_contour_pool() -> ThreadPoolExecutor:
+    # thread pool for contour extraction (cv2 releases the gil), one per process
+    global _contour_pool, _contour_pool_pid
+    if _contour_pool is None or _contour_pool_pid != os.getpid():
+        _contour_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1),
+                thread_name_prefix='contours')
+        _contour_pool_pid = os.getpid()
+
+    return _contour_pool
 
 def box_union(boxes1: torch.Tensor, boxes2: torch.Tensor) -> torch.Tensor:
     # calculate top-left and bottom-right
@@ -115,3 +133,174 @@ def dense_mask_to_polygon_mask(dense_instance_mask, N):
         downsampled_polygon_mask = F.interpolate(polygon_mask.T.unsqueeze(-1).unsqueeze(0), size=(N, 1))[0][..., 0].T
 
     return downsampled_polygon_mask
+
+def largest_contour(dense_instance_mask: np.ndarray) -> np.ndarray:
+    # points (L x 2) of the contour of a mask with the most points (first one if tied)
+    contours = cv2.findContours(dense_instance_mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[0]
+    if len(contours) == 0:
+        return np.zeros((0, 2), dtype=np.float32)
+
+    lengths = [c.shape[0] for c in contours]
+
+    return contours[lengths.index(max(lengths))].reshape(-1, 2).astype(np.float32)
+
+def resample_polygons(polygons: torch.Tensor, lengths: torch.Tensor, N: int,
+        arc_length: bool = False) -> torch.Tensor:
+    """Resample padded closed polygons (M x L x 2, with L_i valid points each) to N points.
+
+    By default, points are picked by index (as nearest neighbor F.interpolate over the
+    points), otherwise they are evenly spaced along the arc length of the polygons. Empty
+    polygons are resampled to zeros.
+    """
+    M = polygons.shape[0]
+    device = polygons.device
+    if M == 0 or polygons.shape[1] == 0:
+        return torch.zeros(M, N, 2, device=device)
+
+    L = lengths.clamp(min=1)
+    if not arc_length:
+        # same (float32) index computation as nearest F.interpolate
+        scale = L.float() / N
+        inds = (torch.arange(N, device=device).float() * scale.unsqueeze(1)).floor().long()
+        inds = torch.minimum(inds, (L - 1).unsqueeze(1))
+        resampled = polygons.gather(1, inds.unsqueeze(-1).expand(-1, -1, 2))
+
+    else:
+        # length of each segment (from each point to the next, wrapping around)
+        point_inds = torch.arange(polygons.shape[1], device=device).unsqueeze(0)
+        next_inds = (point_inds + 1) % L.unsqueeze(1)
+        next_points = polygons.gather(1, next_inds.unsqueeze(-1).expand(-1, -1, 2))
+        seg_lengths = (next_points - polygons).norm(dim=-1)
+        seg_lengths = seg_lengths * (point_inds < L.unsqueeze(1)) # ignore padding
+
+        # arc length at the start of each segment, and arc length of each sample point
+        cum_lengths = torch.cumsum(seg_lengths, 1)
+        starts = cum_lengths - seg_lengths
+        total = cum_lengths[:, -1:]
+        targets = torch.arange(N, device=device).float().unsqueeze(0) * total / N
+
+        # find segment of each sample point, and interpolate along it
+        seg_inds = torch.searchsorted(cum_lengths.contiguous(), targets.contiguous(), right=True)
+        seg_inds = torch.minimum(seg_inds, (L - 1).unsqueeze(1))
+        t = (targets - starts.gather(1, seg_inds)) / seg_lengths.gather(1, seg_inds).clamp(min=1e-6)
+        p0 = polygons.gather(1, seg_inds.unsqueeze(-1).expand(-1, -1, 2))
+        p1 = next_points.gather(1, seg_inds.unsqueeze(-1).expand(-1, -1, 2))
+        resampled = p0 + t.clamp(0, 1).unsqueeze(-1) * (p1 - p0)
+
+    return resampled * (lengths > 0).view(-1, 1, 1)
+
+def batched_mask_to_polygon_mask(dense_instance_masks: torch.Tensor, N: int,
+        arc_length: bool = False) -> torch.Tensor:
+    """Batched dense_mask_to_polygon_mask (M x H x W masks to M x N x 2 polygons): masks are
+    copied to the host at once, contours are extracted in a thread pool, and resampled in one
+    vectorized pass (see resample_polygons).
+    """
+    device = dense_instance_masks.device
+    if dense_instance_masks.shape[0] == 0:
+        return torch.zeros(0, N, 2, device=device)
+
+    masks = dense_instance_masks.detach().to(torch.uint8).cpu().numpy()
+    contours = list(get_contour_pool().map(largest_contour, masks))
+
+    # pad contours, and resample on device
+    lengths = torch.tensor([c.shape[0] for c in contours])
+    polygons = np.zeros((len(contours), max(lengths.max().item(), 1), 2), dtype=np.float32)
+    for i, c in enumerate(contours):
+        polygons[i, :c.shape[0]] = c
+
+    polygons = torch.from_numpy(polygons).to(device)
+
+    return resample_polygons(polygons, lengths.to(device), N, arc_length)
+
+def radial_mask_to_polygon_mask(dense_instance_masks: torch.Tensor, N: int) -> torch.Tensor:
+    """On-device approximation of mask polygons (M x H x W masks to M x N x 2): N boundary
+    points at evenly spaced angles around the mask centroid (from the mask moments), at the
+    distance of the furthest mask pixel in each angle bin. Empty masks give zeros.
+    """
+    M, H, W = dense_instance_masks.shape
+    device = dense_instance_masks.device
+    if M == 0:
+        return torch.zeros(0, N, 2, device=device)
+
+    masks = dense_instance_masks.flatten(1) > 0
+    area = masks.sum(1)
+
+    # centroid from first order moments
+    ys, xs = torch.meshgrid(torch.arange(H, device=device).float(),
+            torch.arange(W, device=device).float(), indexing='ij')
+    xs, ys = xs.flatten(), ys.flatten()
+    cx = (masks * xs).sum(1) / area.clamp(min=1)
+    cy = (masks * ys).sum(1) / area.clamp(min=1)
+
+    # angle bin and distance of each pixel to the centroid
+    dx, dy = xs - cx.unsqueeze(1), ys - cy.unsqueeze(1)
+    bins = ((torch.atan2(dy, dx) + math.pi) / (2 * math.pi) * N).long().clamp(max=N - 1)
+    dists = torch.sqrt(dx ** 2 + dy ** 2) * masks
+
+    # furthest mask pixel per bin
+    radii = torch.zeros(M, N, device=device).scatter_reduce_(1, bins, dists, 'amax')
+    angles = (torch.arange(N, device=device).float() + 0.5) / N * 2 * math.pi - math.pi
+    polygons = torch.stack([cx.unsqueeze(1) + radii * angles.cos(),
+        cy.unsqueeze(1) + radii * angles.sin()], -1)
+
+    return polygons * (area > 0).view(-1, 1, 1)
+
+def rasterize_boxes(boxes: torch.Tensor, size) -> torch.Tensor:
+    """Masks of (rounded) boxes (... x 4, xyxy), ... x H x W, built by comparing box
+    coords against coordinate grids."""
+    b = boxes.round().int()
+    ys = torch.arange(size[0], device=boxes.device)
+    xs = torch.arange(size[1], device=boxes.device)
+    in_y = (ys >= b[..., 1:2]) & (ys < b[..., 3:4]) # ... x H
+    in_x = (xs >= b[..., 0:1]) & (xs < b[..., 2:3]) # ... x W
+
+    return in_y.unsqueeze(-1) & in_x.unsqueeze(-2)
+
+def rasterize_layout(instance_masks: torch.Tensor, labels: torch.Tensor,
+        num_classes: int) -> torch.Tensor:
+    """Class layout (B x num_classes + 1 x H x W) of a stack of instance masks (B x N x H x W)
+    with 0-indexed labels (B x N), i.e. the max over instances of the one-hot encoded
+    instance layouts: channel l + 1 is set where an instance of class l is, and channel 0 where
+    at least one of the N instances is not.
+    """
+    B, N, H, W = instance_masks.shape
+    layout = torch.zeros(B, num_classes + 1, H * W, device=instance_masks.device)
+
+    # scatter instance masks to class channels, without materializing one-hot layouts
+    inds = (labels.long() + 1).clamp(min=0).view(B, N, 1).expand(B, N, H * W)
+    layout.scatter_reduce_(1, inds, instance_masks.view(B, N, H * W).float(), 'amax')
+    layout = layout.view(B, num_classes + 1, H, W)
+    layout[:, 0] = (instance_masks.sum(1) < N).float()
+
+    return layout
+
+def construct_layout(classes: List[torch.Tensor], boxes: List[torch.Tensor], size,
+        num_nodes: int, num_classes: int, masks: List[torch.Tensor] = None) -> Tuple:
+    """Box layout, layout (from masks if provided, else boxes) and per-instance box masks of
+    a batch of detections (B x num_classes + 1 x H x W, B x num_classes + 1 x H x W, and
+    B x num_nodes x H x W).
+    """
+    device = boxes[0].device
+    B = len(boxes)
+    size = [int(s) for s in size]
+
+    # pad instances of each img to num_nodes
+    padded_boxes = torch.zeros(B, num_nodes, 4, device=device)
+    padded_labels = torch.zeros(B, num_nodes, dtype=torch.long, device=device)
+    for ind, (label, box) in enumerate(zip(classes, boxes)):
+        padded_boxes[ind, :box.numel() // 4] = box.view(-1, 4)
+        padded_labels[ind, :label.numel()] = label.long()
+
+    # stack of instance box masks, and box layout
+    box_masks = rasterize_boxes(padded_boxes, size)
+    box_layout = rasterize_layout(box_masks, padded_labels, num_classes)
+
+    if masks is not None:
+        # pad to max number of instances in batch
+        instance_masks = pad_sequence([m != 0 for m in masks], batch_first=True)
+        layout = rasterize_layout(instance_masks, padded_labels[:, :instance_masks.shape[1]],
+                num_classes)
+    else:
+        layout = box_layout.clone()
+
+    return box_layout, layout, box_masks.int()
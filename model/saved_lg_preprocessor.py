@@ -1,17 +1,133 @@
 from mmdet.models.data_preprocessors import TrackDataPreprocessor
-from typing import Dict
+from mmengine.dataset import pseudo_collate
+from mmengine.registry import FUNCTIONS
+from mmengine.structures import BaseDataElement
+from collections import defaultdict
+from typing import Dict, List, Sequence, Tuple, Union
 from mmdet.registry import MODELS
+import torch
+from torch import Tensor
+
+def _get_lg_tensors(lg: Union[BaseDataElement, Tensor], path: Tuple = ()) -> List[Tuple]:
+    # (path, tensor) of each tensor in a saved graph (with nested nodes/edges elements)
+    if isinstance(lg, Tensor):
+        return [(path, lg)]
+
+    tensors = []
+    for k, v in lg.items():
+        if isinstance(v, (Tensor, BaseDataElement)):
+            tensors.extend(_get_lg_tensors(v, path + (k,)))
+
+    return tensors
+
+def _set_lg_field(lg: BaseDataElement, path: Tuple, value) -> None:
+    for k in path[:-1]:
+        lg = lg.get(k)
+
+    setattr(lg, path[-1], value)
+
+def pack_lgs(lgs: List[Union[BaseDataElement, Tensor]]) -> Tuple[Dict[str, Tensor], List]:
+    """Flatten the tensors of a list of saved graphs into one contiguous buffer per dtype.
+
+    Returns:
+        buffers (Dict[str, Tensor]): flat buffer of each dtype.
+        layout (List): for each graph, (path, dtype, offset, shape) of each of its tensors.
+    """
+    flat_tensors = defaultdict(list)
+    offsets = defaultdict(int)
+    layout = []
+    for lg in lgs:
+        lg_layout = []
+        for path, t in _get_lg_tensors(lg):
+            key = str(t.dtype).split('.')[-1]
+            lg_layout.append((path, key, offsets[key], tuple(t.shape)))
+            flat_tensors[key].append(t.reshape(-1))
+            offsets[key] += t.numel()
+
+        layout.append(lg_layout)
+
+    buffers = {k: torch.cat(v) for k, v in flat_tensors.items()}
+
+    return buffers, layout
+
+def unpack_lg(lg: Union[BaseDataElement, Tensor], lg_layout: List,
+        buffers: Dict[str, Tensor]) -> Union[BaseDataElement, Tensor]:
+    """Set the tensors of a saved graph to views of the (packed) buffers."""
+    for path, key, offset, shape in lg_layout:
+        numel = 1
+        for s in shape:
+            numel *= s
+
+        t = buffers[key][offset:offset + numel].view(shape)
+        if len(path) == 0:
+            return t
+
+        _set_lg_field(lg, path, t)
+
+    return lg
+
+@FUNCTIONS.register_module()
+def lg_collate(data_batch: Sequence) -> dict:
+    """pseudo_collate, which also packs the saved graphs of all frames of the batch into one
+    buffer per dtype in the dataloader workers (see SavedLGPreprocessor)."""
+    data = pseudo_collate(data_batch)
+    lgs = [x.metainfo['lg'] for s in data['data_samples'] for x in s.video_data_samples]
+    data['lg_buffers'], data['lg_layout'] = pack_lgs(lgs)
+
+    # drop packed tensors from graphs, so that they are not sent to the main process twice
+    for lg, lg_layout in zip(lgs, data['lg_layout']):
+        for path, *_ in lg_layout:
+            if len(path) > 0:
+                _set_lg_field(lg, path, None)
+
+    return data
 
 @MODELS.register_module()
 class SavedLGPreprocessor(TrackDataPreprocessor):
+    """Preprocessor for batches of saved latent graphs (LoadLG), which only casts data to the
+    device. Batches without imgs (inputs is empty) are passed to the model with inputs=None.
+
+    The tensors of the saved graphs of all frames are transferred in one non-blocking copy
+    per dtype, from pinned buffers, and viewed back into per-frame graphs on the device. The
+    buffers are packed in the dataloader workers with collate_fn=dict(type='lg_collate')
+    (and pinned by the dataloader with pin_memory=True), otherwise they are packed here.
+
+    Args:
+        drop_inputs (bool): drop imgs in the batch instead of moving them to the device, e.g.
+            when the pipeline still loads imgs but the model only uses saved graphs.
+    """
+    def __init__(self, drop_inputs: bool = False, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.drop_inputs = drop_inputs
+
     def forward(self, data: dict, training: bool = False) -> Dict:
+        data = dict(data)
+        lg_buffers = data.pop('lg_buffers', None)
+        lg_layout = data.pop('lg_layout', None)
+
+        # batches of saved graphs only have no imgs (empty inputs)
+        inputs = data.get('inputs', None)
+        if self.drop_inputs or inputs is None or \
+                (isinstance(inputs, (dict, list, tuple)) and len(inputs) == 0):
+            data['inputs'] = None
+
         data = self.cast_data(data)
 
         # now make sure lg is cast
-        for b_id in range(len(data['data_samples'])):
-            for f_id in range(len(data['data_samples'][b_id].video_data_samples)):
-                cast_lg = data['data_samples'][b_id].video_data_samples[f_id].metainfo['lg'].to(self.device)
-                data['data_samples'][b_id].video_data_samples[f_id].set_metainfo({'lg': cast_lg})
+        video_data_samples = [x for s in data['data_samples'] for x in s.video_data_samples]
+        lgs = [x.metainfo['lg'] for x in video_data_samples]
+        if lg_buffers is None:
+            lg_buffers, lg_layout = pack_lgs(lgs)
+
+        device_buffers = {}
+        for k, b in lg_buffers.items():
+            if torch.device(self.device).type == 'cuda' and not b.is_pinned():
+                b = b.pin_memory()
+
+            device_buffers[k] = b.to(self.device, non_blocking=True)
+
+        for x, lg, l in zip(video_data_samples, lgs, lg_layout):
+            x.set_metainfo({'lg': unpack_lg(lg, l, device_buffers)})
 
         imgs, data_samples = data['inputs'], data['data_samples']
 
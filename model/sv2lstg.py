@@ -14,8 +14,7 @@ from mmengine.structures import BaseDataElement, InstanceData
 from mmdet.utils import ConfigType, OptConfigType, OptMultiConfig
 from mmdet.registry import MODELS
 from .lg import LGDetector
-from .predictor_heads.modules.layers import build_mlp
-from .predictor_heads.modules.utils import apply_sparse_mask, get_sparse_mask_inds
+from .predictor_heads.modules.layers import build_mlp, apply_mlp
 
 @MODELS.register_module()
 class SV2LSTG(BaseDetector):
@@ -28,7 +27,8 @@ class SV2LSTG(BaseDetector):
             sem_feat_use_masks: bool = False, sem_feat_use_temporal_window: bool = True,
             num_sim_topk: int = 2, temporal_edge_ranges: str = 'exp', edge_max_temporal_range: int = -1,
             use_max_iou_only: bool = True, use_temporal_edges_only: bool = False,
-            per_video: bool = False, **kwargs):
+            per_video: bool = False, chunk_size: int = -1, chunk_history: int = 0,
+            chunk_context: int = 0, num_train_chunks: int = 1, **kwargs):
         super().__init__(**kwargs)
 
         # init lg detector
@@ -93,6 +93,14 @@ class SV2LSTG(BaseDetector):
         # set prediction params
         self.per_video = per_video
 
+        # chunked processing of long videos (per_video only): each chunk predicts chunk_size
+        # frames, with an st graph that also covers the chunk_history preceding frames, and the
+        # temporal model gets pooled img feats of up to chunk_context earlier frames as context
+        self.chunk_size = chunk_size
+        self.chunk_history = chunk_history
+        self.chunk_context = chunk_context
+        self.num_train_chunks = num_train_chunks
+
         # init ds head
         ds_head.per_video = per_video
         ds_head.num_temp_frames = clip_size
@@ -106,6 +114,12 @@ class SV2LSTG(BaseDetector):
         else:
             filtered_batch_data_samples = batch_data_samples
 
+        if self.per_video and self.chunk_size > 0:
+            ds_losses = self._chunked_loss(batch_inputs, filtered_batch_data_samples, losses)
+            losses.update(ds_losses)
+
+            return losses
+
         # extract frame-wise graphs by running lg detector on all images and reshape values
         feats, graphs, clip_results, _ = self.extract_feat(batch_inputs, filtered_batch_data_samples, losses)
 
@@ -125,6 +139,9 @@ class SV2LSTG(BaseDetector):
         else:
             filtered_batch_data_samples = batch_data_samples
 
+        if self.per_video and self.chunk_size > 0:
+            return self._chunked_predict(batch_inputs, filtered_batch_data_samples)
+
         # extract frame-wise graphs by running lg detector on all images and reshape values
         feats, graphs, clip_results, results = self.extract_feat(batch_inputs,
                 filtered_batch_data_samples)
@@ -140,42 +157,140 @@ class SV2LSTG(BaseDetector):
 
         # only keep keyframes
         if self.per_video:
-            # upsample predictions if needed
-            if len(filtered_batch_data_samples[0]) < len(batch_data_samples[0]):
-                # compute upsample factor
-                upsample_factor = int(np.ceil(len(batch_data_samples[0]) / len(filtered_batch_data_samples[0])))
+            # drop predictions on padded frames (videos in batch may differ in length), then
+            # assign remaining predictions to keyframe results in order
+            frames_per_video = [len(x) for x in filtered_batch_data_samples]
+            valid = torch.arange(ds_preds.shape[1]) < torch.tensor(frames_per_video).unsqueeze(-1)
+            for r, p in zip(results, ds_preds[valid.to(ds_preds.device)]):
+                r.pred_ds = p
+
+        else:
+            results = results[T-1::T]
+            for r, p in zip(results, ds_preds):
+                r.pred_ds = p
+
+        return results
 
-                # pad predictions
-                ds_preds = ds_preds.repeat_interleave(upsample_factor, dim=1)[:,
-                        :len(batch_data_samples[0])]
+    def _chunked_loss(self, batch_inputs: Tensor, batch_data_samples: SampleList,
+            losses: dict) -> dict:
+        """Compute ds losses on num_train_chunks randomly selected chunks of the videos in the
+        batch (averaged over chunks), so that memory is bounded by the chunk size rather than
+        the video length. Temporal context is truncated to the chunk history, plus the pooled
+        img feats of earlier frames when they are stored in the saved lgs. History frames are
+        only context, they are scored as target frames of the previous chunk.
+        """
+        chunks = self._get_chunks(max(len(b) for b in batch_data_samples))
+        selected_chunks = random.sample(chunks, min(self.num_train_chunks, len(chunks)))
+        lgs = self._pop_lgs(batch_data_samples)
 
-                # pad results and add ds_preds
-                padded_results = []
-                dummy_instance_data = InstanceData(bboxes=torch.zeros(0, 4),
-                        scores=torch.zeros(0), labels=torch.zeros(0)).to(ds_preds.device)
+        ds_losses = {}
+        for chunk in selected_chunks:
+            video_inds, chunk_inputs, chunk_samples = self._get_chunk_inputs(batch_inputs,
+                    batch_data_samples, lgs, chunk)
 
-                for ind, (b, ds) in enumerate(zip(batch_data_samples[0], ds_preds.flatten(end_dim=1))):
-                    if ind % upsample_factor == 0:
-                        r = results[ind // upsample_factor]
+            feats, graphs, clip_results, _ = self.extract_feat(chunk_inputs, chunk_samples, losses)
 
-                    else:
-                        r = DetDataSample(metainfo=b.metainfo,
-                                pred_instances=dummy_instance_data)
+            # img feats of frames before the chunk (without running the backbone)
+            start = chunk[0]
+            context_start = max(0, start - self.chunk_context)
+            if lgs is not None and start > context_start:
+                feats.temporal_context = torch.stack([torch.stack([l.img_feats.view(-1) \
+                        for l in lgs[i][context_start:start]]) for i in video_inds])
 
-                    r.pred_ds = ds
-                    padded_results.append(r)
+            # only score the frames of the chunk, not its history
+            feats.num_history_frames = chunk[1] - start
 
-            else:
-                for r in results:
-                    for r, p in zip(results, ds_preds.view(-1, ds_preds.shape[-1])):
-                        r.pred_ds = p
+            st_graphs = self.build_st_graph(graphs, clip_results)
+            for k, v in self.ds_head.loss(st_graphs, feats, chunk_samples).items():
+                ds_losses[k] = ds_losses.get(k, 0) + v / len(selected_chunks)
+
+        return ds_losses
+
+    def _chunked_predict(self, batch_inputs: Tensor, batch_data_samples: SampleList) -> SampleList:
+        """Predict on whole videos chunk by chunk. The pooled img feats of processed frames are
+        carried from chunk to chunk as temporal context, and the predictions on the frames of
+        each chunk (excluding its history) are stitched back together.
+        """
+        B = len(batch_data_samples)
+        chunks = self._get_chunks(max(len(b) for b in batch_data_samples))
+        lgs = self._pop_lgs(batch_data_samples)
+
+        video_results = [[] for _ in range(B)]
+        img_context = [None] * B # pooled img feats of the frames before the current chunk
+        for chunk in chunks:
+            start, chunk_start, end = chunk
+            num_history = chunk_start - start
+            video_inds, chunk_inputs, chunk_samples = self._get_chunk_inputs(batch_inputs,
+                    batch_data_samples, lgs, chunk)
+
+            feats, graphs, clip_results, results = self.extract_feat(chunk_inputs, chunk_samples)
+
+            # all videos in chunk have processed the same frames, so contexts have equal length
+            if self.chunk_context > 0 and start > 0:
+                feats.temporal_context = torch.stack([img_context[i][:img_context[i].shape[0] - \
+                        num_history][-self.chunk_context:] for i in video_inds])
+
+            pooled_img_feats = feats.bb_feats[-1].detach().mean((-2, -1))
 
+            st_graphs = self.build_st_graph(graphs, clip_results)
+            ds_preds, _ = self.ds_head.predict(st_graphs, feats)
+
+            # stitch predictions on the frames of this chunk, and update context
+            frames_per_video = [len(x) for x in chunk_samples]
+            result_starts = np.cumsum([0] + frames_per_video[:-1])
+            for j, (i, result_start) in enumerate(zip(video_inds, result_starts)):
+                chunk_results = results[result_start + num_history:result_start + frames_per_video[j]]
+                for r, p in zip(chunk_results, ds_preds[j, num_history:frames_per_video[j]]):
+                    r.pred_ds = p
+
+                video_results[i].extend(chunk_results)
+
+                if self.chunk_context > 0:
+                    chunk_img_feats = pooled_img_feats[j, num_history:frames_per_video[j]]
+                    if img_context[i] is not None:
+                        chunk_img_feats = torch.cat([img_context[i], chunk_img_feats])
+
+                    img_context[i] = chunk_img_feats[-(self.chunk_context + self.chunk_history):]
+
+        return [r for v in video_results for r in v]
+
+    def _get_chunks(self, num_frames: int) -> List[Tuple[int]]:
+        # (first frame incl. history, first frame predicted by chunk, end of chunk)
+        return [(max(0, s - self.chunk_history), s, min(s + self.chunk_size, num_frames)) \
+                for s in range(0, num_frames, self.chunk_size)]
+
+    def _pop_lgs(self, batch_data_samples: SampleList) -> List:
+        if 'lg' not in batch_data_samples[0][0].metainfo:
+            return None
+
+        return [[x.pop('lg') for x in vds] for vds in batch_data_samples]
+
+    def _get_chunk_inputs(self, batch_inputs: Tensor, batch_data_samples: SampleList,
+            lgs: List, chunk: Tuple[int]) -> Tuple:
+        start, chunk_start, end = chunk
+
+        # videos in batch may be shorter than the chunk grid
+        video_inds = [i for i, vds in enumerate(batch_data_samples) if len(vds) > chunk_start]
+        chunk_samples = [batch_data_samples[i][start:end] for i in video_inds]
+
+        if lgs is not None:
+            # extract_feat consumes the lg of each frame (and may perturb its boxes), and history
+            # frames are shared by consecutive chunks, so give each chunk its own copy
+            for i in video_inds:
+                for x, l in zip(batch_data_samples[i][start:end], lgs[i][start:end]):
+                    chunk_lg = l.clone()
+                    chunk_lg.nodes = l.nodes.clone()
+                    x.set_metainfo({'lg': chunk_lg})
+
+        if isinstance(batch_inputs, Tensor) and batch_inputs.dim() == 5:
+            chunk_inputs = batch_inputs[video_inds, start:end]
+        elif lgs is not None:
+            chunk_inputs = None # imgs are not used with saved graphs
         else:
-            results = results[T-1::T]
-            for r, p in zip(results, ds_preds):
-                r.pred_ds = p
+            raise ValueError('Chunked per-video processing needs saved graphs (lg) or a B x T x '
+                    'C x H x W img tensor')
 
-        return results
+        return video_inds, chunk_inputs, chunk_samples
 
     def reshape_as_clip(self, feats: BaseDataElement, graphs: BaseDataElement, results: SampleList, B: int, T: int) -> Tuple[BaseDataElement]: # reshape quantities in feats by clip
         feats.bb_feats = [x.view(B, T, *x.shape[1:]) for x in feats.bb_feats]
@@ -238,174 +353,137 @@ class SV2LSTG(BaseDetector):
         node_boxes = pad_sequence([pad_sequence([x.pred_instances.bboxes for x in cr]) \
                 for cr in clip_results], batch_first=True).transpose(1, 2)
 
+        # pack nodes of each clip (flat nodes + per-img offsets) so that temporal edges are
+        # built over the nodes actually present in the clip rather than T x N padded slots
+        packed_nodes = self._pack_clip_nodes(graphs, node_boxes)
+
         viz_graph, spat_graph = None, None
         if self.use_viz_graph:
-            viz_graph = self._build_visual_edges(graphs)
+            viz_graph = self._build_visual_edges(packed_nodes)
 
         if self.use_spat_graph:
-            spat_graph = self._build_spatial_edges(node_boxes)
+            spat_graph = self._build_spatial_edges(packed_nodes)
 
         if viz_graph is not None or spat_graph is not None:
             # add viz and spat edges to st_graph, being mindful of indexing, and extract edge features
-            st_graph = self._featurize_st_graph(spat_graph, viz_graph, node_boxes,
+            st_graph = self._featurize_st_graph(spat_graph, viz_graph, packed_nodes,
                     graphs, clip_results[0][0].ori_shape)
         else:
             st_graph = graphs
 
         return st_graph
 
-    def _featurize_st_graph(self, spat_graph: Tensor, viz_graph: Tensor, node_boxes: Tensor,
+    def _pack_clip_nodes(self, graphs: BaseDataElement, node_boxes: Tensor) -> BaseDataElement:
+        """Pack padded B x T x N node quantities into B x M tensors, where M is the max number
+        of nodes in a clip. Nodes are stored frame by frame, so the packed index of a node is
+        its node index within the clip (same indexing as temporal edge flats).
+        """
+        B, T, N = graphs.nodes.feats.shape[:3]
+        device = graphs.nodes.feats.device
+        npi = torch.stack(graphs.nodes.nodes_per_img).long().to(device) # B x T
+        nodes_per_clip = npi.sum(-1)
+        M = int(nodes_per_clip.max())
+
+        frame_ids = torch.arange(T, device=device).view(1, T, 1).expand(B, T, N)
+
+        packed_nodes = BaseDataElement(
+            feats=self._pack(graphs.nodes.feats, npi, M),
+            bboxes=self._pack(node_boxes, npi, M),
+            frame_ids=self._pack(frame_ids, npi, M, fill_value=-1),
+            valid=torch.arange(M, device=device) < nodes_per_clip.unsqueeze(-1),
+            nodes_per_clip=nodes_per_clip,
+            num_frames=T,
+        )
+
+        return packed_nodes
+
+    def _pack(self, x: Tensor, npi: Tensor, M: int, fill_value: float = 0) -> Tensor:
+        B, T, N = x.shape[:3]
+        valid = torch.arange(N, device=x.device) < npi.unsqueeze(-1) # B x T x N
+        img_offsets = torch.cumsum(npi, -1) - npi
+        packed_inds = (img_offsets.unsqueeze(-1) + torch.arange(N, device=x.device))[valid]
+        clip_inds = torch.arange(B, device=x.device).view(B, 1, 1).expand_as(valid)[valid]
+
+        packed = x.new_full((B, M, *x.shape[3:]), fill_value)
+        packed[clip_inds, packed_inds] = x[valid]
+
+        return packed
+
+    def _featurize_st_graph(self, spat_graph: Tensor, viz_graph: Tensor, packed_nodes: BaseDataElement,
             graphs: BaseDataElement, box_shape: Tensor):
         # extract shape quantities, device
-        B, T, N, _ = node_boxes.shape
-        M = T * N
+        B, M = packed_nodes.valid.shape
+        T = packed_nodes.num_frames
 
         if M == 0: # no fg objects in batch
             # leave graphs as is (node feats contain some dummy features which will be used for classification)
             graphs.edges.edges_per_clip = [sum(x) for x in graphs.edges.edges_per_img]
             return graphs
 
-        device = spat_graph.device if spat_graph is not None else viz_graph.device
-
-        # define graphs to use
-        graphs_to_use = []
-        if spat_graph is not None:
-            graphs_to_use.append(spat_graph)
-        if viz_graph is not None:
-            graphs_to_use.append(viz_graph)
-
-        # pad spat graph if needed
-        if len(graphs_to_use) == 2 and graphs_to_use[0].shape[-1] != graphs_to_use[1].shape[-1]:
-            padded_spat_graph = torch.sparse_coo_tensor(graphs_to_use[0].indices(),
-                    graphs_to_use[0].values(), size=graphs_to_use[1].shape)
-            graphs_to_use[0] = padded_spat_graph
-
-            # pad node_boxes
-            pad_dim = (padded_spat_graph.shape[-1] - M) // T
-            node_boxes = F.pad(node_boxes, (0, 0, 0, pad_dim))
-
-            # recompute dims
-            B, T, N, _ = node_boxes.shape
-            M = T * N
-
-        # create meshgrid to store node indices corresponding to each edge
-        edge_inds = torch.arange(M).to(device)
-
-        # calculate offsets to add to the meshgrid computed indices based on the number of nodes in each graph in each clip
-        batch_nodes_per_img = torch.stack(graphs.nodes.nodes_per_img)
-        offsets = torch.cumsum(torch.cat([torch.zeros(batch_nodes_per_img.shape[0], 1).to(device),
-            batch_nodes_per_img[:, :-1].to(device)], -1), -1).unsqueeze(-1).repeat(1, 1, N)
-
-        # get corrected edge indices
-        edge_inds = (edge_inds - N * torch.arange(T).repeat_interleave(N).to(device)).unsqueeze(0) + \
-                offsets.view(B, -1)
+        device = packed_nodes.valid.device
 
-        # stack graphs to use to get temporal_edge_class
+        # stack graphs to use to get temporal_edge_class (B x M x M x E)
+        graphs_to_use = [g for g in [spat_graph, viz_graph] if g is not None]
         temporal_edge_class = torch.stack(graphs_to_use, -1)
 
-        # upper triangular mask
-        mask = torch.triu(torch.ones(*temporal_edge_class.shape[:-1]), diagonal=1).to_sparse().to(device)
-
-        # apply mask
-        temporal_edge_class = apply_sparse_mask(temporal_edge_class, mask)
-
-        # set invalid inds to 0 (based on nodes per img)
-        npi = graphs.nodes.nodes_per_img
-        npi_mask = torch.stack([pad_sequence(list(torch.ones(T).repeat_interleave(n.int()).split(
-            n.int().tolist())) + [torch.zeros(N)], batch_first=True)[:-1].view(M,).to_sparse() for n in npi]).to(device)
-        valid_edge_inds = npi_mask.float()
-
-        # mask out invalid_edge_inds on both axes
-        temporal_edge_class = temporal_edge_class * valid_edge_inds.to_dense().view(B, -1, 1, 1)
-        temporal_edge_class = temporal_edge_class * valid_edge_inds.to_dense().view(B, 1, -1, 1)
-        temporal_edge_class = torch.masked._combine_input_and_mask(sum, temporal_edge_class,
-                temporal_edge_class)
+        # keep upper triangular edges between valid (non-padded) nodes
+        valid = packed_nodes.valid
+        edge_mask = torch.triu(torch.ones(M, M, dtype=torch.bool, device=device), diagonal=1) & \
+                valid.unsqueeze(-1) & valid.unsqueeze(1)
+        temporal_edge_class = temporal_edge_class * edge_mask.unsqueeze(-1)
+
+        # edges are ordered by clip, then source node, then target node
+        edge_clip_inds, src, dst = (temporal_edge_class != 0).any(-1).nonzero(as_tuple=True)
+        extra_edges_per_clip = torch.bincount(edge_clip_inds, minlength=B).tolist()
+
+        # add img id for temporal edges (set as T, 0 to T-1 being the frame ids); src, dst are
+        # already node indices within the clip
+        extra_edge_flats = torch.stack([torch.full_like(src, T), src, dst], -1).long()
+
+        # class logits of edge types that are not present are set to 1
+        extra_edge_class_logits = temporal_edge_class[edge_clip_inds, src, dst]
+        extra_edge_class_logits = torch.where(extra_edge_class_logits != 0, extra_edge_class_logits,
+                torch.ones_like(extra_edge_class_logits))
+        extra_edge_class_logits = torch.cat([torch.zeros(extra_edge_class_logits.shape[0],
+            self.num_spatial_edge_classes).to(device), extra_edge_class_logits], 1)
+
+        # boxes
+        extra_boxesA = packed_nodes.bboxes[edge_clip_inds, src]
+        extra_boxesB = packed_nodes.bboxes[edge_clip_inds, dst]
+        extra_edge_boxes = self._box_union(extra_boxesA, extra_boxesB)
+
+        # viz feats
+        extra_edge_viz_feats = (packed_nodes.feats[edge_clip_inds, src] + \
+                packed_nodes.feats[edge_clip_inds, dst]) / 2
+
+        extra_edges = {'edge_flats': extra_edge_flats, 'class_logits': extra_edge_class_logits,
+                'boxes': extra_edge_boxes, 'boxesA': extra_boxesA, 'boxesB': extra_boxesB,
+                'feats': extra_edge_viz_feats}
+
+        if self.semantic_feat_size > 0:
+            # temporal window size for each edge
+            frame_ids = packed_nodes.frame_ids
+            edge_temporal_windows = F.one_hot((frame_ids[edge_clip_inds, dst] - \
+                    frame_ids[edge_clip_inds, src]).abs(), num_classes=T)
+
+            # compute sem feats for all clips at once
+            extra_edges['semantic_feats'] = self._compute_st_sem_feats(extra_edge_boxes,
+                    extra_edge_class_logits[:, -self.num_temp_edge_classes:],
+                    edge_temporal_windows, box_shape)
 
         # update graphs.edges with temporal edge quantities
-        for ind, ec in enumerate(temporal_edge_class):
-            # get information from ec
-            all_nonzero_vals = ec._values()
-            all_nonzero_inds = ec._indices()
-            nonzero_uids, nonzero_idx, _ = torch.unique(all_nonzero_inds[:2],
-                    dim=-1, sorted=True, return_inverse=True, return_counts=True)
-
-            # UPDATE EDGE FLATS
-            extra_edge_flats = edge_inds[ind][nonzero_uids]
-
-            # add img id for temporal edges (set as T, 0 to T-1 being the frame ids)
-            extra_edge_flats = torch.cat([torch.ones(1, extra_edge_flats.shape[-1]).to(device) * T,
-                extra_edge_flats]).T.long()
-
-            if self.use_temporal_edges_only:
-                graphs.edges.edge_flats[ind] = extra_edge_flats
-            else:
-                graphs.edges.edge_flats[ind] = torch.cat([graphs.edges.edge_flats[ind],
-                    extra_edge_flats])
-
-            # UPDATE CLASS LOGITS
-
-            # define extra_edge_class_logits
-            extra_edge_class_logits = torch.ones(nonzero_uids.shape[-1], ec.shape[-1]).to(device)
-
-            # loop through edge type and populate class logits
-            for i in range(ec.shape[-1]):
-                inds_i = (all_nonzero_inds[-1] == i)
-
-                # find target index for each edge, assign value
-                extra_edge_class_logits[nonzero_idx[inds_i], i] = all_nonzero_vals[inds_i]
-
-            if self.use_temporal_edges_only:
-                extra_edge_class_logits = torch.cat([torch.zeros(extra_edge_class_logits.shape[0],
-                    self.num_spatial_edge_classes).to(device), extra_edge_class_logits], 1)
-                graphs.edges.class_logits[ind] = extra_edge_class_logits
-            else:
-                extra_edge_class_logits = torch.cat([torch.zeros(extra_edge_class_logits.shape[0],
-                    self.num_spatial_edge_classes).to(device), extra_edge_class_logits], 1)
-                graphs.edges.class_logits[ind] = torch.cat([graphs.edges.class_logits[ind],
-                        extra_edge_class_logits])
-
-            # update boxes
-            extra_boxesA = node_boxes[ind].flatten(end_dim=1)[nonzero_uids[0]]
-            extra_boxesB = node_boxes[ind].flatten(end_dim=1)[nonzero_uids[1]]
-            extra_edge_boxes = self._box_union(extra_boxesA, extra_boxesB)
-            if self.use_temporal_edges_only:
-                graphs.edges.boxes[ind] = extra_edge_boxes
-                graphs.edges.boxesA[ind] = extra_boxesA
-                graphs.edges.boxesB[ind] = extra_boxesB
-            else:
-                graphs.edges.boxes[ind] = torch.cat([graphs.edges.boxes[ind], extra_edge_boxes])
-                graphs.edges.boxesA[ind] = torch.cat([graphs.edges.boxesA[ind], extra_boxesA])
-                graphs.edges.boxesB[ind] = torch.cat([graphs.edges.boxesB[ind], extra_boxesB])
-
-            # update viz feats
-            extra_edge_viz_feats = graphs.nodes.feats[ind].view(M, -1)[nonzero_uids.T].mean(1)
-
-            if self.semantic_feat_size > 0:
-                # compute map storing the temporal window size for each edge
-                edge_to_window_val = torch.abs(torch.arange(T) - torch.arange(T).repeat(T, 1).T).to(nonzero_uids.device)
-                nonzero_uids_frame = nonzero_uids // N
-                edge_temporal_windows = F.one_hot(edge_to_window_val[nonzero_uids_frame[0],
-                        nonzero_uids_frame[1]], num_classes=T)
-
-                # compute sem feats
-                extra_edge_sem_feats = self._compute_st_sem_feats(extra_edge_boxes,
-                        extra_edge_class_logits[:, -self.num_temp_edge_classes:],
-                        edge_temporal_windows, box_shape)
-
-            if self.use_temporal_edges_only:
-                graphs.edges.feats[ind] = extra_edge_viz_feats
-                if self.semantic_feat_size > 0:
-                    graphs.edges.semantic_feats[ind] = extra_edge_sem_feats
-
-            else:
-                graphs.edges.feats[ind] = torch.cat([graphs.edges.feats[ind], extra_edge_viz_feats])
-                if self.semantic_feat_size > 0:
-                    graphs.edges.semantic_feats[ind] = torch.cat([graphs.edges.semantic_feats[ind],
-                        extra_edge_sem_feats])
+        for k, v in extra_edges.items():
+            clip_vals = graphs.edges.get(k)
+            for ind, extra_v in enumerate(v.split(extra_edges_per_clip)):
+                if self.use_temporal_edges_only:
+                    clip_vals[ind] = extra_v
+                else:
+                    clip_vals[ind] = torch.cat([clip_vals[ind], extra_v])
 
-            # update edges per img, temporal edges are grouped into one category
+        # update edges per img, temporal edges are grouped into one category
+        for ind, num_extra_edges in enumerate(extra_edges_per_clip):
             graphs.edges.edges_per_img[ind] = torch.cat([graphs.edges.edges_per_img[ind],
-                Tensor([extra_edge_viz_feats.shape[0]]).to(graphs.edges.edges_per_img[ind])])
+                Tensor([num_extra_edges]).to(graphs.edges.edges_per_img[ind])])
 
         # update edges per clip after adding temporal edges
         graphs.edges.edges_per_clip = [sum(x) for x in graphs.edges.edges_per_img]
@@ -427,10 +505,7 @@ class SV2LSTG(BaseDetector):
 
         sem_feat_input = torch.cat(sem_feat_input, -1)
 
-        if sem_feat_input.shape[0] == 1:
-            sem_feats = self.temporal_edge_semantic_feat_projector(sem_feat_input.repeat(2, 1))[0].unsqueeze(0)
-        else:
-            sem_feats = self.temporal_edge_semantic_feat_projector(sem_feat_input)
+        sem_feats = apply_mlp(self.temporal_edge_semantic_feat_projector, sem_feat_input)
 
         return sem_feats
 
@@ -459,17 +534,19 @@ class SV2LSTG(BaseDetector):
 
         return union_boxes
 
-    def _build_visual_edges(self, graphs: BaseDataElement):
-        # store components of shape
-        B, T, N, _ = graphs.nodes.feats.size()
+    def _build_visual_edges(self, packed_nodes: BaseDataElement):
+        feats = packed_nodes.feats
+        B, M, _ = feats.size()
+        if M == 0:
+            return None
 
         # run kernel fns
         if self.learn_sim_graph:
-            sim1 = self.sim_embed1(graphs.nodes.feats).flatten(start_dim=1, end_dim=2)
-            sim2 = self.sim_embed2(graphs.nodes.feats).flatten(start_dim=1, end_dim=2).transpose(1, 2)
+            sim1 = self.sim_embed1(feats)
+            sim2 = self.sim_embed2(feats).transpose(1, 2)
         else:
-            sim1 = graphs.nodes.feats.flatten(start_dim=1, end_dim=2)
-            sim2 = graphs.nodes.feats.flatten(start_dim=1, end_dim=2).transpose(1, 2)
+            sim1 = feats
+            sim2 = feats.transpose(1, 2)
 
         # COSINE SIMILARITY
         # compute pairwise dot products
@@ -477,46 +554,31 @@ class SV2LSTG(BaseDetector):
         sm_graph_norm_factor = torch.bmm(torch.linalg.norm(sim1, dim=-1, keepdim=True),
                 torch.linalg.norm(sim2, dim=1, keepdim=True)) + 1e-5
         sm_graph = torch.clamp(sm_graph / sm_graph_norm_factor, 0, 1)
-        if sm_graph.shape[-1] == 0:
-            return sm_graph.to_sparse()
-
-        # 0 out intra-frame edges
-        intra_frame_inds = (torch.stack(torch.meshgrid(torch.arange(N),
-            torch.arange(N))).to(graphs.nodes.feats.device).unsqueeze(-1) + \
-                    torch.arange(T).to(graphs.nodes.feats.device) * N).flatten(start_dim=1).long()
-        sm_graph[torch.arange(sm_graph.shape[0]).view(-1, 1, 1), intra_frame_inds[0], intra_frame_inds[1]] -= 50
-
-        # 0 out padded edges in both directions
-        npi_all = graphs.nodes.nodes_per_img
-        for ind, npi_clip in enumerate(npi_all):
-            for n in npi_clip:
-                offset = ind * N
-                sm_graph[ind, offset + n.int():offset + N, offset:offset + N] -= 50
-                sm_graph[ind, offset:offset + N, offset + n.int():offset + N] -= 50
+
+        # 0 out intra-frame and padded edges
+        frame_ids, valid = packed_nodes.frame_ids, packed_nodes.valid
+        invalid_edges = (frame_ids.unsqueeze(-1) == frame_ids.unsqueeze(1)) | \
+                ~(valid.unsqueeze(-1) & valid.unsqueeze(1))
+        sm_graph = sm_graph - 50 * invalid_edges
 
         # only keep topk most similar edges per node
         topk_sm_graph = torch.zeros_like(sm_graph)
-        topk_vals, inds = sm_graph.topk(self.num_sim_topk, dim=-1)
+        topk_vals, inds = sm_graph.topk(min(self.num_sim_topk, M), dim=-1)
 
         # now concatenate arange with inds to get proper indices
         topk_vals_norm = topk_vals / (topk_vals.sum(-1).unsqueeze(-1) + 1e-5)
         topk_sm_graph.scatter_(-1, inds, topk_vals_norm)
 
-        return topk_sm_graph.to_sparse()
-
-    def _build_spatial_edges(self, boxes: Tensor):
-        B, T, N, _ = boxes.size()
-        M = T*N
+        return topk_sm_graph
 
-        front_graph = torch.zeros(B, M, M).to(boxes.device)
-        back_graph = torch.zeros(B, M, M).to(boxes.device)
+    def _build_spatial_edges(self, packed_nodes: BaseDataElement):
+        boxes, frame_ids, valid = packed_nodes.bboxes, packed_nodes.frame_ids, packed_nodes.valid
+        B, M = valid.shape
+        T = packed_nodes.num_frames
 
         if M == 0:
             return None
 
-        areas = (boxes[:,:,:,3] - boxes[:,:,:,1] + 1) * \
-                (boxes[:,:,:,2] - boxes[:,:,:,0] + 1)
-
         # set temporal edge ranges
         edge_max_temporal_range = self.edge_max_temporal_range if self.edge_max_temporal_range > 0 else T
         if self.temporal_edge_ranges == 'exp':
@@ -524,54 +586,70 @@ class SV2LSTG(BaseDetector):
         else:
             ranges = range(1, edge_max_temporal_range + 1)
 
-        for r in ranges:
-            for t in range(T-1, 0, -1): # build starting at last (latest) node
-                if t - r < 0:
-                    continue
-                for i in range(N):
-                    ious = self._compute_iou(boxes[:,t,i], boxes[:,t-r], areas[:,t,i:i+1],
-                            areas[:,t-r]).nan_to_num(0)
-                    if self.use_max_iou_only:
-                        norm_iou = F.one_hot(ious.argmax(-1), num_classes=N)
-                    else:
-                        norm_iou = ious / (ious.sum(-1).unsqueeze(-1) + 1e-5)
-
-                    front_graph[:, t*N + i, (t-r)*N:(t-r+1)*N] = norm_iou
-                    back_graph[:, (t-r)*N:(t-r+1)*N, t*N + i] = ious
-
-                # normalize back graph by sum of all incoming edges for each pair in temporal range r
-                if self.use_max_iou_only:
-                    bg_vals = back_graph[:, (t-r)*N:(t-r+1)*N, t*N:(t+1)*N]
-                    back_graph[:, (t-r)*N:(t-r+1)*N, t*N:(t+1)*N] = F.one_hot(bg_vals.argmax(-1),
-                            num_classes=N)
+        # front_mask[b, i, j] is True if node j is r frames before node i, for r in ranges
+        frame_diff = frame_ids.unsqueeze(-1) - frame_ids.unsqueeze(1)
+        front_mask = torch.isin(frame_diff, torch.tensor(list(ranges), device=frame_diff.device)) & \
+                valid.unsqueeze(-1) & valid.unsqueeze(1)
 
-                else:
-                    back_graph[:, (t-r)*N:(t-r+1)*N, t*N:(t+1)*N] /= back_graph[:,
-                            (t-r)*N:(t-r+1)*N, t*N:(t+1)*N].sum(-1).unsqueeze(-1)
+        ious = self._compute_pairwise_iou(boxes).nan_to_num(0)
+
+        # front graph: each node connects to nodes in earlier frames, back graph: each node connects
+        # to nodes in later frames (both normalized over the nodes of each target frame)
+        if self.use_max_iou_only:
+            front_graph = self._frame_argmax(ious, front_mask, frame_ids, T)
+            back_graph = self._frame_argmax(ious.transpose(1, 2), front_mask.transpose(1, 2), frame_ids, T)
+        else:
+            front_graph = self._frame_normalize(ious, front_mask, frame_ids, T, eps=1e-5)
+            back_graph = self._frame_normalize(ious.transpose(1, 2), front_mask.transpose(1, 2), frame_ids, T)
 
         # combine forward and backward graph
-        fb_graph = torch.maximum(front_graph.transpose(1, 2), back_graph).to_sparse()
+        fb_graph = torch.maximum(front_graph.transpose(1, 2), back_graph)
 
         return fb_graph
 
-    def _compute_iou(self, roi, rois, area, areas):
-        y_min = torch.max(roi[:,0:1], rois[:,:,0])
-        x_min = torch.max(roi[:,1:2], rois[:,:,1])
-        y_max = torch.min(roi[:,2:3], rois[:,:,2])
-        x_max = torch.min(roi[:,3:4], rois[:,:,3])
-        axis0 = x_max - x_min + 1
-        axis1 = y_max - y_min + 1
-        axis0[axis0 < 0] = 0
-        axis1[axis1 < 0] = 0
-        intersection = axis0 * axis1
-        iou = intersection / (areas + area - intersection)
+    def _frame_argmax(self, scores: Tensor, mask: Tensor, frame_ids: Tensor, T: int) -> Tensor:
+        # one-hot of the (first) max score for each row within each frame of the columns
+        B, M, _ = scores.shape
+        col_frames = frame_ids.clamp(min=0).unsqueeze(1).expand(B, M, M)
+        scores = scores.masked_fill(~mask, float('-inf'))
+        frame_max = scores.new_full((B, M, T), float('-inf')).scatter_reduce(2, col_frames, scores, 'amax')
+        is_max = mask & (scores == frame_max.gather(2, col_frames))
+
+        col_inds = torch.arange(M, device=scores.device).expand(B, M, M)
+        first_max = col_inds.new_full((B, M, T), M).scatter_reduce(2, col_frames,
+                col_inds.masked_fill(~is_max, M), 'amin')
+
+        return (is_max & (col_inds == first_max.gather(2, col_frames))).float()
+
+    def _frame_normalize(self, scores: Tensor, mask: Tensor, frame_ids: Tensor, T: int,
+            eps: float = 0) -> Tensor:
+        # normalize scores of each row by their sum within each frame of the columns (0 if sum is 0)
+        B, M, _ = scores.shape
+        col_frames = frame_ids.clamp(min=0).unsqueeze(1).expand(B, M, M)
+        scores = scores * mask
+        frame_sum = scores.new_zeros(B, M, T).scatter_add(2, col_frames, scores)
+
+        frame_sum = frame_sum.gather(2, col_frames)
+
+        return scores / (frame_sum + eps).masked_fill(frame_sum == 0, 1)
+
+    def _compute_pairwise_iou(self, boxes: Tensor) -> Tensor:
+        # boxes: B x M x 4, returns B x M x M
+        areas = (boxes[..., 3] - boxes[..., 1] + 1) * (boxes[..., 2] - boxes[..., 0] + 1)
+        top_left = torch.max(boxes.unsqueeze(2)[..., :2], boxes.unsqueeze(1)[..., :2])
+        bottom_right = torch.min(boxes.unsqueeze(2)[..., 2:], boxes.unsqueeze(1)[..., 2:])
+        wh = (bottom_right - top_left + 1).clamp(min=0)
+        intersection = wh[..., 0] * wh[..., 1]
+        iou = intersection / (areas.unsqueeze(2) + areas.unsqueeze(1) - intersection)
 
         return iou
 
     def extract_feat(self, batch_inputs: Tensor, batch_data_samples: SampleList,
             losses: dict = None) -> Tuple[BaseDataElement]:
+        # videos in a batch can have different lengths (per_video), they are padded to the max
         B = len(batch_data_samples)
-        T = len(batch_data_samples[0])
+        frames_per_video = [len(b) for b in batch_data_samples]
+        T = max(frames_per_video)
         if 'lg' in batch_data_samples[0][0].metainfo:
             lg_list = [x.pop('lg') for b in batch_data_samples for x in b]
 
@@ -587,7 +665,12 @@ class SV2LSTG(BaseDetector):
             graphs.edges = BaseDataElement()
 
             if self.reencode_semantics:
-                self.compute_lg_semantic_feat(lg_list, graphs)
+                # frames are cached by img path (unique across splits/datasets, unlike img
+                # ids), only at eval time, since training inputs are augmented (box
+                # perturbation, mask polygon rolls)
+                frame_ids = None if self.training else \
+                        [x.img_path for b in batch_data_samples for x in b]
+                self.compute_lg_semantic_feat(lg_list, graphs, frame_ids)
 
             # collate node info
             graphs.nodes.viz_feats = pad_sequence([l.nodes.viz_feats \
@@ -599,12 +682,12 @@ class SV2LSTG(BaseDetector):
                         for l in lg_list], batch_first=True)
                 graphs.nodes.feats = self.node_viz_feat_projector(torch.cat(
                     [graphs.nodes.viz_feats, graphs.nodes.gnn_viz_feats], -1).flatten(end_dim=1)).view(
-                            B*T, graphs.nodes.viz_feats.shape[1], self.viz_feat_size)
+                            -1, graphs.nodes.viz_feats.shape[1], self.viz_feat_size)
             else:
                 graphs.nodes.feats = self.node_viz_feat_projector(graphs.nodes.viz_feats.flatten(end_dim=1)).view(
-                            B*T, graphs.nodes.viz_feats.shape[1], self.viz_feat_size)
+                            -1, graphs.nodes.viz_feats.shape[1], self.viz_feat_size)
 
-            if 'semantic_feats' in lg_list[0].nodes:
+            if 'semantic_feats' in lg_list[0].nodes and not self.reencode_semantics:
                 graphs.nodes.semantic_feats = pad_sequence([l.nodes.semantic_feats \
                         for l in lg_list], batch_first=True)
 
@@ -627,7 +710,7 @@ class SV2LSTG(BaseDetector):
                     [graphs.edges.viz_feats, graphs.edges.gnn_viz_feats], -1))
             else:
                 graphs.edges.feats = self.edge_viz_feat_projector(graphs.edges.viz_feats)
-            if 'semantic_feats' in lg_list[0].edges:
+            if 'semantic_feats' in lg_list[0].edges and not self.reencode_semantics:
                 graphs.edges.semantic_feats = torch.cat([l.edges.semantic_feats for l in lg_list])
 
             graphs.edges.boxes = torch.cat([l.edges.boxes for l in lg_list])
@@ -654,6 +737,10 @@ class SV2LSTG(BaseDetector):
             results = [DetDataSample(pred_instances=p, metainfo=m) for p, m in zip(pred_instances, metainfo)]
 
         else:
+            # graph-only batches (SavedLGPreprocessor) have no imgs
+            if batch_inputs is None:
+                raise ValueError('Batch has neither saved graphs (lg) nor imgs')
+
             feats, graphs, detached_results, results, _, _ = self.lg_detector.extract_lg(
                     batch_inputs.flatten(end_dim=1),
                     [x for y in batch_data_samples for x in y],
@@ -680,75 +767,83 @@ class SV2LSTG(BaseDetector):
                 input_node_viz_feat = torch.cat([graphs.nodes.viz_feats,
                     graphs.nodes.gnn_viz_feats], -1)
                 graphs.nodes.feats = self.node_viz_feat_projector(
-                        input_node_viz_feat.flatten(end_dim=1)).view(B*T, N, self.viz_feat_size)
+                        input_node_viz_feat.flatten(end_dim=1)).view(-1, N, self.viz_feat_size)
                 input_edge_viz_feat = torch.cat([graphs.edges.viz_feats,
                     graphs.edges.gnn_viz_feats], -1)
                 graphs.edges.feats = self.edge_viz_feat_projector(input_edge_viz_feat)
             else:
                 graphs.nodes.feats = self.node_viz_feat_projector(
-                        graphs.nodes.viz_feats.flatten(end_dim=1)).view(B*T, N, self.viz_feat_size)
+                        graphs.nodes.viz_feats.flatten(end_dim=1)).view(-1, N, self.viz_feat_size)
                 graphs.edges.feats = self.edge_viz_feat_projector(graphs.edges.viz_feats)
 
+        # pad videos to the same length
+        if any(t != T for t in frames_per_video):
+            feats, graphs, padded_results = self._pad_videos(feats, graphs, results, frames_per_video)
+        else:
+            padded_results = results
+
         # reorganize feats and graphs by clip
-        feats, graphs, clip_results = self.reshape_as_clip(feats, graphs, results, B, T)
+        feats, graphs, clip_results = self.reshape_as_clip(feats, graphs, padded_results, B, T)
 
         return feats, graphs, clip_results, results
 
-    def compute_lg_semantic_feat(self, lg_list: List, graphs: BaseDataElement) -> Tensor:
-        device = lg_list[0].nodes.viz_feats.device
-        boxes = [l.nodes.bboxes for l in lg_list]
-        classes = [l.nodes.labels for l in lg_list]
-        scores = [l.nodes.scores for l in lg_list]
+    def _pad_videos(self, feats: BaseDataElement, graphs: BaseDataElement, results: SampleList,
+            frames_per_video: List[int]) -> Tuple:
+        """Pad frame-wise quantities of a batch of videos with different lengths, so that each
+        video has T = max(frames_per_video) frames. Padded frames are appended at the end of
+        each video and have no nodes, no edges and zero features. The number of frames of each
+        video is stored in feats.frames_per_video, so that the temporal model can ignore padded
+        frames."""
+        B, T = len(frames_per_video), max(frames_per_video)
+        num_frames = sum(frames_per_video)
+        valid_frames = torch.arange(T) < torch.tensor(frames_per_video).unsqueeze(-1)
+        frame_inds = valid_frames.flatten().nonzero().squeeze(-1) # padded index of each frame
+
+        def pad(x: Tensor) -> Tensor:
+            padded = x.new_zeros(B * T, *x.shape[1:])
+            padded[frame_inds.to(x.device)] = x
+            return padded
+
+        feats.frames_per_video = frames_per_video
+        feats.bb_feats = [pad(x) for x in feats.bb_feats]
+        feats.neck_feats = [pad(x) for x in feats.neck_feats]
+        feats.instance_feats = pad(feats.instance_feats)
+        if 'semantic_feats' in feats:
+            feats.semantic_feats = pad(feats.semantic_feats)
+
+        graphs.nodes.nodes_per_img = pad(Tensor([float(n) for n in graphs.nodes.nodes_per_img]))
+        for k, v in graphs.nodes.items():
+            if isinstance(v, Tensor) and k != 'nodes_per_img' and v.shape[0] == num_frames:
+                graphs.nodes.set_field(pad(v), k)
+
+        graphs.edges.edges_per_img = pad(graphs.edges.edges_per_img)
+        graphs.edges.edge_flats[:, 0] = frame_inds.to(graphs.edges.edge_flats)[
+                graphs.edges.edge_flats[:, 0].long()]
+
+        # dummy results for padded frames
+        padded_results = []
+        video_starts = np.cumsum([0] + frames_per_video[:-1])
+        for start, num_video_frames in zip(video_starts, frames_per_video):
+            video_results = results[start:start + num_video_frames]
+            dummy_result = DetDataSample(metainfo=video_results[-1].metainfo,
+                    pred_instances=InstanceData(bboxes=torch.zeros(0, 4), scores=torch.zeros(0),
+                        labels=torch.zeros(0).long()).to(feats.instance_feats.device))
+            padded_results.extend(video_results + [dummy_result] * (T - num_video_frames))
+
+        return feats, graphs, padded_results
+
+    def compute_lg_semantic_feat(self, lg_list: List, graphs: BaseDataElement,
+            frame_ids: List = None) -> Tensor:
         masks = None
         if 'masks' in lg_list[0].nodes:
             masks = [l.nodes.masks for l in lg_list]
 
-        # compute semantic feat
-        c = pad_sequence(classes, batch_first=True)
-        b = pad_sequence(boxes, batch_first=True)
-        s = pad_sequence(scores, batch_first=True)
-        b_norm = b / Tensor(lg_list[0].ori_shape).flip(0).repeat(2).to(device)
-        c_one_hot = F.one_hot(c, num_classes=self.lg_detector.num_classes)
-
-        sem_feat_input = []
-        if self.sem_feat_use_bboxes:
-            sem_feat_input.append(b_norm)
-
-        if self.sem_feat_use_class_logits:
-            sem_feat_input.append(c_one_hot)
-
-        # process masks
-        if self.sem_feat_use_masks:
-            # iterate through masks and convert to polygon mask
-            polygon_masks = self.lg_detector.masks_to_polygons(masks)
-
-            # process masks
-            polygon_masks = pad_sequence(polygon_masks, batch_first=True) # B x N x P x 2
-            polygon_masks_norm = polygon_masks / Tensor(lg_list[0].ori_shape).flip(0).to(device)
-
-            sem_feat_input.append(polygon_masks_norm.flatten(start_dim=-2))
-
-        sem_feat_input.append(s.unsqueeze(-1))
-
-        sem_feat_input = torch.cat(sem_feat_input, -1).flatten(end_dim=1)
-        if sem_feat_input.shape[0] == 1:
-            s = self.lg_detector.semantic_feat_projector(torch.cat([sem_feat_input, sem_feat_input]))[0]
-        else:
-            s = self.lg_detector.semantic_feat_projector(sem_feat_input)
-
-        # add node sem feats to graph
-        graphs.nodes.semantic_feats = s.view(b_norm.shape[0], b_norm.shape[1], s.shape[-1])
-
-        # compute edge semantic feats
-        eb_norm = torch.cat([l.edges.boxes for l in lg_list]) / Tensor(lg_list[0].batch_input_shape).flip(0).repeat(2).to(device) # make 0-1
-        ec = torch.cat([l.edges.class_logits for l in lg_list])
-        edge_sem_input = torch.cat([eb_norm, ec], -1) # detach class logits to prevent backprop
-        if edge_sem_input.shape[1] == 1:
-            edge_sem_feats = self.lg_detector.edge_semantic_feat_projector(edge_sem_input.repeat(2, 1))[0].unsqueeze(0)
-        else:
-            edge_sem_feats = self.lg_detector.edge_semantic_feat_projector(edge_sem_input)
-
-        graphs.edges.semantic_feats = edge_sem_feats
+        # encode node and edge semantic feats (frames are cached by frame id if projectors are frozen)
+        graphs.nodes.semantic_feats, graphs.edges.semantic_feats = self.lg_detector.semantic_encoder(
+                [l.nodes.bboxes for l in lg_list], [l.nodes.labels for l in lg_list],
+                [l.nodes.scores for l in lg_list], masks, [l.edges.boxes for l in lg_list],
+                [l.edges.class_logits for l in lg_list], lg_list[0].ori_shape,
+                lg_list[0].batch_input_shape, frame_ids=frame_ids)
 
     def _forward(self, batch_inputs: Tensor, batch_data_samples: OptSampleList = None):
         raise NotImplementedError
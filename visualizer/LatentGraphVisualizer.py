@@ -1,20 +1,79 @@
 from mmdet.registry import VISUALIZERS
 from mmdet.visualization import DetLocalVisualizer
 from mmdet.structures import DetDataSample
-from mmengine.structures import InstanceData
+from mmengine.dist import get_rank
+from mmengine.structures import BaseDataElement, InstanceData
 from typing import Dict, List, Optional, Tuple, Union, Sequence
+from model.saved_lg_preprocessor import pack_lgs, unpack_lg
+from visualizer.graph_render import init_render_worker, render_graph
 import numpy as np
-import networkx as nx
-import matplotlib.pyplot as plt
 import os
+import torch
+from torch import Tensor
+from io import BytesIO
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import atexit
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+
+def _lg_skeleton(lg: Union[BaseDataElement, Tensor]) -> Optional[BaseDataElement]:
+    # copy of the structure of a graph without its tensors (filled in by unpack_lg)
+    if isinstance(lg, Tensor):
+        return None
+
+    skeleton = lg.__class__(metainfo=lg.metainfo)
+    for k, v in lg.items():
+        if isinstance(v, BaseDataElement):
+            v = _lg_skeleton(v)
+        elif isinstance(v, Tensor):
+            v = None
+
+        skeleton.set_data({k: v})
+
+    return skeleton
 
 @VISUALIZERS.register_module()
 class LatentGraphVisualizer(DetLocalVisualizer):
+    """Visualizer that draws detections and latent graphs, and/or saves latent graphs.
+
+    Saved graphs are written in the background: the tensors of each graph are copied to
+    pinned host buffers without syncing the device, and a bounded queue feeds writer threads,
+    which serialize the graphs and write them to {img id}.npz files or, with
+    shard_graphs=True, append them to shard files (lg_{export}_{rank}_{writer}_{shard}.lgs,
+    with a .idx index of img id -> byte range). The graphs written by each rank are listed in
+    a manifest (lg_{export}_{rank}.manifest) when flushed; LoadLG only reads graphs listed in
+    manifests, and those of later exports (export = start time) override earlier ones.
+
+    Drawn graphs are reduced to their nodes (label, color, position) and edges (color), and
+    rendered in a process pool (see graph_render.py), with matplotlib/networkx or with a fast
+    cv2 renderer. Pending writes and renders are flushed by flush, which is called by the
+    FlushLGWriter hook after test (and at exit).
+
+    Args:
+        save_graphs (bool): save latent graphs to latent_graphs/{dataset}/{detector}.
+        num_writers (int): number of writer threads.
+        max_pending_graphs (int): max number of graphs staged for writing, add_datasample
+            blocks when the writers fall behind.
+        shard_graphs (bool): append graphs to shard files instead of one file per graph.
+        graphs_per_shard (int): max number of graphs per shard file.
+        renderer (str): graph renderer, 'matplotlib' or 'cv2' (png/jpg only).
+        render_format (str): file format of rendered graphs (pdf, png, ...).
+        render_dpi (int): dpi of rendered graphs.
+        num_render_workers (int): number of render processes, 0 to render synchronously.
+        max_pending_renders (int): max number of graphs queued for rendering.
+    """
     def __init__(self, name: str, dataset: str = 'endoscapes',
             detector: str = 'faster_rcnn', results_dir: str = 'results',
             data_prefix: str = 'test', save_graphs: bool = False,
             gt_graph_use_pred_instances: bool = False, draw: bool = False,
-            **kwargs):
+            num_writers: int = 2, max_pending_graphs: int = 64, shard_graphs: bool = False,
+            graphs_per_shard: int = 4096, renderer: str = 'matplotlib',
+            render_format: str = 'pdf', render_dpi: int = 100, num_render_workers: int = 4,
+            max_pending_renders: int = 64, **kwargs):
         super().__init__(**kwargs)
         self.save_dir = os.path.join('latent_graphs', dataset, detector)
 
@@ -28,6 +87,20 @@ class LatentGraphVisualizer(DetLocalVisualizer):
             if not os.path.exists(self.save_dir):
                 os.makedirs(self.save_dir)
 
+            # background writers (started on first graph)
+            self.num_writers = max(num_writers, 1)
+            self.max_pending_graphs = max(max_pending_graphs, 1)
+            self.shard_graphs = shard_graphs
+            self.graphs_per_shard = graphs_per_shard
+            self.graph_writers = None
+            self.shards_per_writer = [0] * self.num_writers
+
+            # graphs written by this export (listed in its manifest)
+            self.export_id = time.time_ns()
+            self.written_shards = []
+            self.written_img_ids = []
+            atexit.register(self.flush_graphs)
+
         if self.draw:
             viz_dir = os.path.join(results_dir, '{}_preds'.format(dataset), data_prefix)
 
@@ -44,6 +117,19 @@ class LatentGraphVisualizer(DetLocalVisualizer):
             # visualize gt or pred detections in graph
             self.gt_graph_use_pred_instances = gt_graph_use_pred_instances
 
+            # graph rendering
+            if renderer == 'cv2' and render_format not in ['png', 'jpg']:
+                raise ValueError("cv2 renderer only supports png and jpg render_format")
+
+            self.renderer = renderer
+            self.render_format = render_format
+            self.render_dpi = render_dpi
+            self.num_render_workers = num_render_workers
+            self.max_pending_renders = max_pending_renders
+            self.render_pool = None
+            self.pending_renders = deque()
+            atexit.register(self.flush_renders)
+
     def _init_graph_viz_info(self):
         # Define self.colors
         cvs_datasets = ['endoscapes', 'wc', 'small_wc', 'italy']
@@ -146,11 +232,8 @@ class LatentGraphVisualizer(DetLocalVisualizer):
             out_file: Optional[str] = None, **kwargs):
 
         if self.save_graphs:
-            # create filename
-            graph_filename = str(data_sample.img_id) + '.npz'
-
-            # save latent graph
-            np.savez(os.path.join(self.save_dir, graph_filename), data_sample.lg.numpy())
+            # stage latent graph, written in the background
+            self.save_graph(data_sample.img_id, data_sample.lg)
 
         if self.draw:
             # extract img prefix
@@ -161,129 +244,216 @@ class LatentGraphVisualizer(DetLocalVisualizer):
                     out_file=os.path.join(self.det_viz_dir, img_prefix + '.jpg'), **kwargs)
 
             # now draw graph
-            self.graphs_to_networkx(data_sample, img_prefix, pred_score_thr) # convert graphs to networkx
-
-    def graphs_to_networkx(self, data_sample: DetDataSample, img_prefix: str,
-            pred_score_thr: float):
-        # Create an empty NetworkX graph for ground truth
-        gt_graph = nx.Graph()
-
-        # Get ground truth instances
-        if self.gt_graph_use_pred_instances or not data_sample.is_det_keyframe:
-            labels, boxes = data_sample.pred_instances.labels, data_sample.pred_instances.bboxes
-        else:
-            labels, boxes = data_sample.gt_instances.labels, data_sample.gt_instances.bboxes
-
-        # Add nodes to the ground truth graph for each ground truth instance
+            self.render_graphs(data_sample, img_prefix, pred_score_thr)
+
+    def save_graph(self, img_id, lg: BaseDataElement) -> None:
+        if self.graph_writers is None:
+            self._start_graph_writers()
+
+        # pack tensors of graph into one buffer per dtype
+        skeleton = _lg_skeleton(lg)
+        buffers, layout = pack_lgs([lg])
+
+        event, slot = None, None
+        if any(b.is_cuda for b in buffers.values()):
+            # copy to pinned host buffers without syncing, writer waits for the copy (blocks
+            # when all buffers are in use)
+            slot = self.free_slots.get()
+            host_buffers = {}
+            for k, b in buffers.items():
+                if k not in slot or slot[k].numel() < b.numel():
+                    slot[k] = torch.empty(2 * b.numel(), dtype=b.dtype, pin_memory=True)
+
+                host_buffers[k] = slot[k][:b.numel()]
+                host_buffers[k].copy_(b, non_blocking=True)
+
+            event = torch.cuda.Event()
+            event.record()
+            buffers = host_buffers
+
+        self.graph_queue.put((img_id, skeleton, layout[0], buffers, event, slot))
+
+    def flush_graphs(self) -> None:
+        """Wait for all staged graphs to be written, and close shard files."""
+        if not self.save_graphs or self.graph_writers is None:
+            return
+
+        for _ in self.graph_writers:
+            self.graph_queue.put(None)
+
+        for w in self.graph_writers:
+            w.join()
+
+        self.graph_writers = None
+        if len(self.writer_errors) > 0:
+            raise self.writer_errors[0]
+
+        self._write_manifest()
+
+    def _write_manifest(self) -> None:
+        manifest_path = os.path.join(self.save_dir, 'lg_{}_{:03d}.manifest'.format(
+            self.export_id, get_rank()))
+        with open(manifest_path + '.tmp', 'wb') as f:
+            pickle.dump(dict(shards=sorted(self.written_shards),
+                npz_img_ids=self.written_img_ids), f)
+
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def _start_graph_writers(self) -> None:
+        self.graph_queue = queue.Queue(maxsize=self.max_pending_graphs)
+        self.writer_errors = []
+
+        # recycled pinned staging buffers (dtype -> buffer), one per graph in flight
+        self.free_slots = queue.Queue()
+        for _ in range(self.max_pending_graphs + self.num_writers):
+            self.free_slots.put({})
+
+        self.graph_writers = [threading.Thread(target=self._write_graphs, args=(i,),
+            daemon=True) for i in range(self.num_writers)]
+        for w in self.graph_writers:
+            w.start()
+
+    def _write_graphs(self, writer_id: int) -> None:
+        shard_file, shard_path, shard_index = None, None, {}
+        while True:
+            item = self.graph_queue.get()
+            if item is None:
+                break
+
+            img_id, skeleton, layout, buffers, event, slot = item
+            try:
+                if event is not None:
+                    event.synchronize()
+
+                # serialize graph (before its staging buffers are released)
+                lg = unpack_lg(skeleton, layout, buffers).numpy()
+                graph_bytes = BytesIO()
+                np.savez(graph_bytes, lg)
+                graph_bytes = graph_bytes.getvalue()
+
+                if not self.shard_graphs:
+                    with open(os.path.join(self.save_dir, str(img_id) + '.npz'), 'wb') as f:
+                        f.write(graph_bytes)
+
+                    self.written_img_ids.append(str(img_id))
+                    continue
+
+                # append to shard, starting a new one when full
+                if shard_file is not None and len(shard_index) >= self.graphs_per_shard:
+                    self._close_shard(shard_file, shard_path, shard_index)
+                    shard_file, shard_index = None, {}
+
+                if shard_file is None:
+                    shard_path = os.path.join(self.save_dir, 'lg_{}_{:03d}_{:02d}_{:05d}.lgs'.format(
+                        self.export_id, get_rank(), writer_id, self.shards_per_writer[writer_id]))
+                    shard_file = open(shard_path, 'wb')
+                    self.shards_per_writer[writer_id] += 1
+
+                shard_index[str(img_id)] = (shard_file.tell(), len(graph_bytes))
+                shard_file.write(graph_bytes)
+
+            except Exception as e:
+                self.writer_errors.append(e)
+
+            finally:
+                if slot is not None:
+                    self.free_slots.put(slot)
+
+        if shard_file is not None:
+            self._close_shard(shard_file, shard_path, shard_index)
+
+    def _close_shard(self, shard_file, shard_path: str, shard_index: Dict) -> None:
+        shard_file.close()
+        with open(shard_path.replace('.lgs', '.idx'), 'wb') as f:
+            pickle.dump(shard_index, f)
+
+        self.written_shards.append(os.path.basename(shard_path))
+
+    def render_graphs(self, data_sample: DetDataSample, img_prefix: str,
+            pred_score_thr: float) -> None:
+        gt_graph, pred_graph = self._graph_render_data(data_sample, pred_score_thr)
+        for graph, subdir in zip([gt_graph, pred_graph], ['gt', 'pred']):
+            out_file = os.path.join(self.graph_viz_dir, subdir,
+                    '{}.{}'.format(img_prefix, self.render_format))
+            render_args = (graph, out_file, self.figsize, self.renderer, self.render_dpi)
+            if self.num_render_workers == 0:
+                render_graph(*render_args)
+                continue
+
+            # render in background, waiting for the oldest renders if too many are pending
+            self.pending_renders.append(self.get_render_pool().submit(render_graph, *render_args))
+            self.flush_renders(self.max_pending_renders)
+
+    def get_render_pool(self) -> ProcessPoolExecutor:
+        if self.render_pool is None:
+            # spawn, since the test loop process holds cuda state and io threads
+            self.render_pool = ProcessPoolExecutor(self.num_render_workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=init_render_worker)
+
+        return self.render_pool
+
+    def flush_renders(self, max_pending: int = 0) -> None:
+        """Wait for pending renders, until at most max_pending are left."""
+        if not self.draw:
+            return
+
+        while len(self.pending_renders) > max_pending:
+            self.pending_renders.popleft().result()
+
+    def flush(self) -> None:
+        """Wait for all graphs to be saved and rendered."""
+        self.flush_graphs()
+        self.flush_renders()
+
+    def _graph_render_data(self, data_sample: DetDataSample,
+            pred_score_thr: float) -> Tuple[Dict, Dict]:
+        # minimal gt and pred graph data (see render_graph), computed on cpu in one pass
         height, width = data_sample.ori_shape
-        for i, (b, l) in enumerate(zip(boxes, labels)):
-            label = self.obj_id_to_label_short[int(l.item()) + 1]
 
-            # compute center and make sure y is from bottom left, not top right
-            center = [int((b[0] + b[2]) / 2), int((b[1] + b[3]) / 2)]
-            center[1] = height - center[1]
+        def node_positions(boxes: np.ndarray) -> np.ndarray:
+            # center of boxes, normalized, with y from bottom left instead of top left
+            centers = ((boxes[:, :2] + boxes[:, 2:4]) / 2).astype(int)
+            centers[:, 1] = height - centers[:, 1]
 
-            # normalize
-            center[0] /= width
-            center[1] /= height
+            return centers / np.array([width, height])
 
-            # add to graph
-            gt_graph.add_node(i, label=label, color=self.colors[int(l.item()) + 1],
-                    pos=center)
+        def graph_data(labels: np.ndarray, pos: np.ndarray, keep: np.ndarray,
+                edge_flats: np.ndarray, edge_colors: List) -> Dict:
+            # reindex kept nodes, dropping edges of removed nodes
+            new_ids = np.cumsum(keep) - 1
+            nodes = [(self.obj_id_to_label_short[l], self.colors[l], tuple(p.tolist())) \
+                    for l, p in zip(labels[keep], pos[keep])]
+            edges = [(int(new_ids[u]), int(new_ids[v]), c) for (u, v), c in \
+                    zip(edge_flats, edge_colors) if keep[u] and keep[v]]
 
-        # Add edges to the ground truth graph for ground truth edges
-        gt_edges = data_sample.gt_edges
+            return dict(nodes=nodes, edges=edges)
+
+        # gt graph (add 1 to labels to account for bg)
+        if self.gt_graph_use_pred_instances or not data_sample.is_det_keyframe:
+            instances = data_sample.pred_instances
+        else:
+            instances = data_sample.gt_instances
 
-        for edge, rel in zip(gt_edges['edge_flats'], gt_edges['relations']):
-            u, v = edge
-            gt_graph.add_edge(int(u.item()), int(v.item()), color=self.sem_id_to_color[int(rel.item())],
-                    relation=self.sem_id_to_label[int(rel.item())])
+        gt_labels = instances.labels.cpu().numpy().astype(int) + 1
+        gt_pos = node_positions(instances.bboxes.cpu().numpy())
+        gt_edge_flats = data_sample.gt_edges['edge_flats'].cpu().numpy().astype(int).reshape(-1, 2)
+        gt_edge_colors = [self.sem_id_to_color[int(r)] for r in \
+                data_sample.gt_edges['relations'].cpu().numpy()]
 
         # remove nodes with 0 degree (they were filtered out in gt graph gen based on score)
-        gt_graph.remove_nodes_from(list(nx.isolates(gt_graph)))
-
-        # Visualize the ground truth graph
-        gt_pos = nx.get_node_attributes(gt_graph, 'pos')
-        gt_node_colors = [data['color'] for _, data in gt_graph.nodes(data=True)]
-        gt_edge_colors = [data['color'] for _, _, data in gt_graph.edges(data=True)]
-        gt_labels = {node: data['label'] for node, data in gt_graph.nodes(data=True)}
-        edge_labels = nx.get_edge_attributes(gt_graph, 'relation')
-        edge_colors = [data['color'] for _, _, data in gt_graph.edges(data=True)]
-
-        plt.figure(figsize=(self.figsize, self.figsize))
-        nx.draw_networkx_nodes(gt_graph, gt_pos, node_color=gt_node_colors,
-                node_size=5000, alpha=1.0)
-        nx.draw_networkx_edges(gt_graph, gt_pos, edge_color=gt_edge_colors,
-                width=10, alpha=0.8)
-
-        nx.draw_networkx_labels(gt_graph, gt_pos, gt_labels, font_size=44,
-                font_color='black', font_family='calibri.ttf')
-
-        plt.axis('off')
-
-        # Save the ground truth graph image
-        plt.savefig(os.path.join(self.graph_viz_dir, 'gt', f'{img_prefix}.pdf'),
-                format='pdf', transparent=True)
-
-        # Clear the figure to free up memory
-        plt.clf()
-        plt.close()
-
-        # Create an empty NetworkX graph for predicted instances
-        pred_graph = nx.Graph()
-
-        # Get pred instances (add 1 to labels to account for bg)
-        pred_labels, pred_boxes = data_sample.pred_instances.labels + 1, data_sample.pred_instances.bboxes
-
-        # Add nodes to the predicted graph for each predicted instance
-        for i, (b, l) in enumerate(zip(pred_boxes, pred_labels)):
-            label = self.obj_id_to_label_short[int(l.item())]
-
-            # compute center and make sure y is from bottom left, not top right
-            center = [int((b[0] + b[2]) / 2), int((b[1] + b[3]) / 2)]
-            center[1] = height - center[1]
-
-            # normalize
-            center[0] /= width
-            center[1] /= height
-
-            pred_graph.add_node(i, label=label, color=self.colors[int(l.item())],
-                    pos=center)
-
-        # Add edges to the predicted graph for predicted edges
-        pred_edges = data_sample.pred_edges
-
-        for edge, rel in zip(pred_edges['edge_flats'], pred_edges['relations']):
-            u, v = edge
-            r = rel[1:].argmax(0).int().item() + 1
-            pred_graph.add_edge(int(u.item()), int(v.item()), color=self.sem_id_to_color[r],
-                    relation=self.sem_id_to_label[r])
-
-        # filter nodes based on score and remove associated edges
-        inds_to_remove = data_sample.pred_instances.scores < pred_score_thr
-        pred_graph.remove_nodes_from(inds_to_remove.tolist())
-
-        # Visualize the pred graph
-        pred_pos = nx.get_node_attributes(pred_graph, 'pos')
-        pred_node_colors = [data['color'] for _, data in pred_graph.nodes(data=True)]
-        pred_edge_colors = [data['color'] for _, _, data in pred_graph.edges(data=True)]
-        pred_labels = {node: data['label'] for node, data in pred_graph.nodes(data=True)}
-        edge_labels = nx.get_edge_attributes(pred_graph, 'relation')
-        edge_colors = [data['color'] for _, _, data in pred_graph.edges(data=True)]
-
-        plt.figure(figsize=(self.figsize, self.figsize))
-        nx.draw_networkx_nodes(pred_graph, pred_pos, node_color=pred_node_colors,
-                node_size=5000, alpha=1.0)
-        nx.draw_networkx_edges(pred_graph, pred_pos, edge_color=pred_edge_colors,
-                width=10, alpha=0.8)
-        nx.draw_networkx_labels(pred_graph, pred_pos, pred_labels, font_size=44,
-                font_color='black', font_family='calibri.ttf')
-        plt.axis('off')
-
-        # Save the pred graph
-        plt.savefig(os.path.join(self.graph_viz_dir, 'pred', f'{img_prefix}.pdf'),
-                format='pdf', transparent=True)
-
-        # Clear the figure to free up memory
-        plt.clf()
-        plt.close()
+        gt_degree = np.bincount(gt_edge_flats.reshape(-1), minlength=len(gt_labels))
+        gt_keep = gt_degree[:len(gt_labels)] > 0
+        gt_graph = graph_data(gt_labels, gt_pos, gt_keep, gt_edge_flats, gt_edge_colors)
+
+        # pred graph, keeping nodes above score thr (and their edges)
+        pred_labels = data_sample.pred_instances.labels.cpu().numpy().astype(int) + 1
+        pred_pos = node_positions(data_sample.pred_instances.bboxes.cpu().numpy())
+        pred_keep = data_sample.pred_instances.scores.cpu().numpy() >= pred_score_thr
+        pred_edge_flats = data_sample.pred_edges['edge_flats'].cpu().numpy().astype(int).reshape(-1, 2)
+        pred_rels = data_sample.pred_edges['relations'][:, 1:].argmax(1).cpu().numpy() + 1
+        pred_edge_colors = [self.sem_id_to_color[int(r)] for r in pred_rels]
+        pred_graph = graph_data(pred_labels, pred_pos, pred_keep, pred_edge_flats,
+                pred_edge_colors)
+
+        return gt_graph, pred_graph
@@ -1,19 +1,155 @@
 from mmdet.registry import VISUALIZERS
 from mmdet.visualization import DetLocalVisualizer
 from mmdet.structures import DetDataSample
+from mmengine.dist import get_rank
 from mmengine.structures import InstanceData
 from typing import Dict, List, Optional, Tuple, Union, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
 import numpy as np
 import torch
 import os
+import json
+import atexit
 from segment_anything.utils.amg import coco_encode_rle, mask_to_rle_pytorch, area_from_rle
 
+def encode_masks(raw_masks: torch.Tensor) -> List[Dict]:
+    mask_rles = mask_to_rle_pytorch(raw_masks)
+    coco_rles = [coco_encode_rle(m) for m in mask_rles]
+    mask_anns = []
+    for idx in range(len(coco_rles)):
+        ann = {
+            "segmentation": coco_rles[idx],
+        }
+        mask_anns.append(ann)
+
+    return mask_anns
+
+def write_query_shard(shard_dir: str, frames: List[Dict]) -> None:
+    """Write the queries of a list of frames to a shard directory, with one .npy file per
+    column (see load_sam_queries)."""
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # per-frame offsets of queries (rows of the columns)
+    num_queries = [f['bboxes'].shape[0] for f in frames]
+    frame_offsets = np.cumsum([0] + num_queries).astype(np.int64)
+
+    # rle blob table, with per-query byte offsets and mask sizes
+    rles = [m['segmentation'] for f in frames for m in f['masks'].result()]
+    rle_bytes = [r['counts'].encode() if isinstance(r['counts'], str) else bytes(r['counts']) \
+            for r in rles]
+    rle_offsets = np.cumsum([0] + [len(b) for b in rle_bytes]).astype(np.int64)
+    rle_blob = np.frombuffer(b''.join(rle_bytes), dtype=np.uint8)
+    rle_sizes = np.array([r['size'] for r in rles], dtype=np.int32).reshape(-1, 2)
+
+    columns = dict(
+        frame_offsets=frame_offsets,
+        img_ids=np.array([f['img_id'] for f in frames]),
+        bboxes=np.concatenate([f['bboxes'] for f in frames]),
+        feats=np.concatenate([f['feats'] for f in frames]),
+        graph_feats=np.concatenate([f['graph_feats'] for f in frames]),
+        rle_blob=rle_blob,
+        rle_offsets=rle_offsets,
+        rle_sizes=rle_sizes,
+    )
+    for k, v in columns.items():
+        np.save(os.path.join(shard_dir, k + '.npy'), v)
+
+    with open(os.path.join(shard_dir, 'img_paths.json'), 'w') as fp:
+        json.dump([f['img_path'] for f in frames], fp)
+
+def load_sam_queries(save_dir: str, mmap: bool = True, decode_masks: bool = False) -> Dict:
+    """Load the queries of all shards in save_dir (shard_queries=True in SAMQueryVisualizer).
+
+    Args:
+        save_dir (str): directory of the shards.
+        mmap (bool): memory-map the columns of each shard (only copied when concatenating
+            shards).
+        decode_masks (bool): also return the COCO RLE masks of all queries, otherwise they
+            are left in the blob table.
+
+    Returns:
+        Dict: columns of all queries (bboxes, feats, graph_feats, rle_*), and of all frames
+            (img_ids, img_paths, frame_offsets into the query columns).
+    """
+    shard_dirs = sorted(os.path.join(save_dir, d) for d in os.listdir(save_dir) \
+            if d.startswith('queries_'))
+
+    shards = []
+    for shard_dir in shard_dirs:
+        shard = {k.replace('.npy', ''): np.load(os.path.join(shard_dir, k),
+            mmap_mode='r' if mmap else None) for k in os.listdir(shard_dir) if k.endswith('.npy')}
+        with open(os.path.join(shard_dir, 'img_paths.json')) as f:
+            shard['img_paths'] = json.load(f)
+
+        shards.append(shard)
+
+    # concatenate shards, shifting offsets
+    queries = {}
+    for k in ['bboxes', 'feats', 'graph_feats', 'img_ids', 'rle_blob', 'rle_sizes']:
+        queries[k] = np.concatenate([s[k] for s in shards]) if len(shards) > 0 else np.zeros(0)
+
+    for k, n in [('frame_offsets', 'bboxes'), ('rle_offsets', 'rle_blob')]:
+        offsets = np.cumsum([0] + [s[n].shape[0] for s in shards[:-1]])
+        queries[k] = np.concatenate([[0]] + [s[k][1:] + o for s, o in zip(shards, offsets)])
+
+    queries['img_paths'] = [p for s in shards for p in s['img_paths']]
+
+    if decode_masks:
+        blob, offsets = queries['rle_blob'], queries['rle_offsets']
+        queries['masks'] = [{'size': s.tolist(), 'counts': blob[o0:o1].tobytes().decode()} \
+                for s, o0, o1 in zip(queries['rle_sizes'], offsets[:-1], offsets[1:])]
+
+    return queries
+
 @VISUALIZERS.register_module()
 class SAMQueryVisualizer(DetLocalVisualizer):
-    def __init__(self, name: str, prefix: str = 'endoscapes', draw: bool = False, **kwargs):
+    """Visualizer that saves SAM queries (bboxes, feats, graph feats, and COCO RLE masks).
+
+    Masks are RLE-encoded in a thread pool. Queries are saved to one {img id}.npz file per
+    frame or, with shard_queries=True, to columnar shards (queries_{rank}_{shard}), with fp16
+    feats, one blob table of the RLE counts, and per-frame offsets into the query columns
+    (see load_sam_queries). Shards are written in the background, pending writes are flushed
+    by flush, which is called by the FlushLGWriter hook after test (and at exit).
+
+    Args:
+        prefix (str): queries are saved to sam_queries/{prefix}.
+        draw (bool): draw detections.
+        shard_queries (bool): save queries to columnar shards instead of one file per frame.
+        frames_per_shard (int): number of frames per shard.
+        num_workers (int): number of threads for RLE encoding and writing.
+    """
+    def __init__(self, name: str, prefix: str = 'endoscapes', draw: bool = False,
+            shard_queries: bool = False, frames_per_shard: int = 4096, num_workers: int = 8,
+            **kwargs):
         super().__init__(**kwargs)
         self.prefix = prefix
         self.draw = draw
+        self.shard_queries = shard_queries
+        self.frames_per_shard = frames_per_shard
+        self.num_workers = num_workers
+
+        self.save_dir = os.path.join('sam_queries', self.prefix)
+        if not os.path.exists(self.save_dir):
+            os.makedirs(self.save_dir)
+
+        # frames of current shard, and pending writes
+        self.shard_frames = []
+        self.num_shards = 0
+        self.pending_writes = []
+        self.pending_encodes = deque()
+        self.pool = None
+        self.writer = None
+        atexit.register(self.flush)
+
+    def get_pool(self) -> ThreadPoolExecutor:
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=self.num_workers,
+                    thread_name_prefix='sam_query_rle')
+            # single writer, so that waiting on rle futures can't starve the encoding pool
+            self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sam_query_write')
+
+        return self.pool
 
     def add_datasample(self, name: str, image: np.ndarray,
             data_sample: Optional['DetDataSample'] = None,
@@ -22,29 +158,66 @@ class SAMQueryVisualizer(DetLocalVisualizer):
         if self.draw:
             super().add_datasample(name, image, data_sample, out_file=out_file, **kwargs)
 
-        save_dir = os.path.join('sam_queries', self.prefix)
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
-        query_filename = str(data_sample.img_id) + '.npz'
+        # encode masks in the background
+        masks = self.get_pool().submit(encode_masks, data_sample.pred_instances.masks.cpu())
+
+        if not self.shard_queries:
+            query_filename = str(data_sample.img_id) + '.npz'
+            data_subsample = dict(
+                    img_path=data_sample.img_path,
+                    bboxes=data_sample.pred_instances.bboxes.cpu().numpy(),
+                    feats=data_sample.pred_instances.feats.cpu().numpy(),
+                    graph_feats=data_sample.pred_instances.graph_feats.cpu().numpy(),
+            )
+            self.pending_writes.append(self.writer.submit(self.save_queries,
+                os.path.join(self.save_dir, query_filename), data_subsample, masks))
+            self.resolve_pending_writes(self.num_workers * 8)
 
-        mask_anns = self.encode_masks(data_sample.pred_instances.masks)
-        data_subsample = dict(
+            return
+
+        self.shard_frames.append(dict(
+                img_id=data_sample.img_id,
                 img_path=data_sample.img_path,
                 bboxes=data_sample.pred_instances.bboxes.cpu().numpy(),
-                feats=data_sample.pred_instances.feats.cpu().numpy(),
-                graph_feats=data_sample.pred_instances.graph_feats.cpu().numpy(),
-                masks=mask_anns,
-        )
-        np.savez(os.path.join(save_dir, query_filename), data_subsample)
+                feats=data_sample.pred_instances.feats.cpu().numpy().astype(np.float16),
+                graph_feats=data_sample.pred_instances.graph_feats.cpu().numpy().astype(np.float16),
+                masks=masks,
+        ))
+        if len(self.shard_frames) >= self.frames_per_shard:
+            self.write_shard()
+
+        # bound raw masks waiting to be encoded (encoded rles are small)
+        self.pending_encodes.append(masks)
+        while len(self.pending_encodes) > self.num_workers * 8:
+            self.pending_encodes.popleft().result()
 
     def encode_masks(self, raw_masks):
-        mask_rles = mask_to_rle_pytorch(raw_masks)
-        coco_rles = [coco_encode_rle(m) for m in mask_rles]
-        mask_anns = []
-        for idx in range(len(coco_rles)):
-            ann = {
-                "segmentation": coco_rles[idx],
-            }
-            mask_anns.append(ann)
-
-        return mask_anns
+        return encode_masks(raw_masks)
+
+    def save_queries(self, query_file: str, data_subsample: Dict, masks: Future) -> None:
+        data_subsample['masks'] = masks.result()
+        np.savez(query_file, data_subsample)
+
+    def write_shard(self) -> None:
+        if len(self.shard_frames) == 0:
+            return
+
+        shard_dir = os.path.join(self.save_dir, 'queries_{:03d}_{:05d}'.format(get_rank(),
+            self.num_shards))
+        self.pending_writes.append(self.writer.submit(write_query_shard, shard_dir,
+            self.shard_frames))
+        self.shard_frames = []
+        self.num_shards += 1
+
+        # keep at most one shard waiting to be written
+        self.resolve_pending_writes(1)
+
+    def resolve_pending_writes(self, max_pending: int = 0) -> None:
+        while len(self.pending_writes) > max_pending:
+            self.pending_writes.pop(0).result()
+
+    def flush(self) -> None:
+        """Write the current shard, and wait for all pending writes."""
+        self.write_shard()
+        self.resolve_pending_writes()
+        self.pending_encodes.clear()
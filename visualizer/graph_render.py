@@ -0,0 +1,124 @@
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib import font_manager
+import networkx as nx
+import numpy as np
+import cv2
+from typing import Dict, List, Tuple
+
+# drawing params (in points, as in networkx)
+NODE_SIZE = 5000
+EDGE_WIDTH = 10
+EDGE_ALPHA = 0.8
+FONT_SIZE = 44
+
+def init_render_worker() -> None:
+    """Initializer of render worker processes, which registers the system fonts (incl.
+    calibri.ttf) as in CocoMetricRGD, since spawned workers don't inherit them."""
+    try:
+        font_dirs = ['/usr/share/fonts']
+        font_files = font_manager.findSystemFonts(fontpaths=font_dirs)
+        fe = [font_manager.FontEntry(
+            fname=x,
+            name=x.split('/')[-1]) for x in font_files]
+        font_manager.fontManager.ttflist += fe
+        plt.rcParams['font.family'] = 'calibri.ttf'
+        plt.rcParams['text.usetex'] = False
+        plt.rcParams['mathtext.fontset'] = 'cm'
+    except:
+        print("FAILED TO SET VIZ FONT TO CALIBRI")
+
+def render_graph(graph: Dict, out_file: str, figsize: float, renderer: str = 'matplotlib',
+        dpi: int = 100) -> None:
+    """Render a graph (see LatentGraphVisualizer._graph_render_data) to a file.
+
+    Only takes plain python/numpy data, so that graphs can be rendered in a process pool.
+
+    Args:
+        graph (Dict): nodes (list of (label, rgb color, (x, y) normalized pos from bottom left))
+            and edges (list of (u, v, rgb color)).
+        out_file (str): output file, format given by the extension.
+        figsize (float): size of the (square) figure in inches.
+        renderer (str): 'matplotlib' (networkx drawing), or 'cv2' (fast, png/jpg only).
+        dpi (int): dots per inch.
+    """
+    if renderer == 'matplotlib':
+        render_graph_matplotlib(graph, out_file, figsize, dpi)
+    elif renderer == 'cv2':
+        render_graph_cv2(graph, out_file, figsize, dpi)
+    else:
+        raise NotImplementedError
+
+def render_graph_matplotlib(graph: Dict, out_file: str, figsize: float, dpi: int) -> None:
+    g = nx.Graph()
+    for i, (label, color, pos) in enumerate(graph['nodes']):
+        g.add_node(i, label=label, color=color, pos=pos)
+
+    for u, v, color in graph['edges']:
+        g.add_edge(u, v, color=color)
+
+    pos = nx.get_node_attributes(g, 'pos')
+    node_colors = [data['color'] for _, data in g.nodes(data=True)]
+    edge_colors = [data['color'] for _, _, data in g.edges(data=True)]
+    labels = {node: data['label'] for node, data in g.nodes(data=True)}
+
+    plt.figure(figsize=(figsize, figsize))
+    nx.draw_networkx_nodes(g, pos, node_color=node_colors, node_size=NODE_SIZE, alpha=1.0)
+    nx.draw_networkx_edges(g, pos, edge_color=edge_colors, width=EDGE_WIDTH, alpha=EDGE_ALPHA)
+    nx.draw_networkx_labels(g, pos, labels, font_size=FONT_SIZE, font_color='black',
+            font_family='calibri.ttf')
+    plt.axis('off')
+
+    plt.savefig(out_file, format=out_file.split('.')[-1], dpi=dpi, transparent=True)
+
+    # clear the figure to free up memory
+    plt.clf()
+    plt.close()
+
+def render_graph_cv2(graph: Dict, out_file: str, figsize: float, dpi: int) -> None:
+    size = int(round(figsize * dpi))
+    pt = dpi / 72 # pixels per point
+    margin = 0.1 * size
+
+    # node centers in pixels (y from top left)
+    if len(graph['nodes']) > 0:
+        pos = np.array([p for _, _, p in graph['nodes']], dtype=np.float64).reshape(-1, 2)
+    else:
+        pos = np.zeros((0, 2))
+
+    centers = np.stack([margin + pos[:, 0] * (size - 2 * margin),
+        size - margin - pos[:, 1] * (size - 2 * margin)], 1).round().astype(int)
+
+    def bgr(c: Tuple) -> Tuple:
+        return tuple(int(round(255 * x)) for x in c[::-1])
+
+    # draw edges on a separate layer, blended with alpha
+    img = np.zeros((size, size, 3), dtype=np.uint8)
+    alpha = np.zeros((size, size), dtype=np.float32)
+    for u, v, color in graph['edges']:
+        cv2.line(img, tuple(centers[u]), tuple(centers[v]), bgr(color),
+                max(int(round(EDGE_WIDTH * pt)), 1), cv2.LINE_AA)
+        cv2.line(alpha, tuple(centers[u]), tuple(centers[v]), EDGE_ALPHA,
+                max(int(round(EDGE_WIDTH * pt)), 1), cv2.LINE_AA)
+
+    # nodes (opaque) and labels on top
+    radius = max(int(round(np.sqrt(NODE_SIZE / np.pi) * pt)), 1)
+    font_scale = FONT_SIZE * pt / 30 # hershey simplex is ~30 px high at scale 1
+    thickness = max(int(round(font_scale * 2)), 1)
+    for (_, color, _), c in zip(graph['nodes'], centers):
+        cv2.circle(img, tuple(c), radius, bgr(color), -1, cv2.LINE_AA)
+        cv2.circle(alpha, tuple(c), radius, 1.0, -1, cv2.LINE_AA)
+
+    for (label, _, _), c in zip(graph['nodes'], centers):
+        (w, h), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+        cv2.putText(img, label, (int(c[0] - w / 2), int(c[1] + h / 2)),
+                cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 0), thickness, cv2.LINE_AA)
+
+    # transparent background where supported
+    if out_file.lower().endswith('.png'):
+        img = np.concatenate([img, (alpha * 255).round().astype(np.uint8)[..., None]], -1)
+    else:
+        img = (img * alpha[..., None] + 255 * (1 - alpha[..., None])).round().astype(np.uint8)
+
+    cv2.imwrite(out_file, img)